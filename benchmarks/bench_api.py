@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the Tailscale client against a local fake API.
+
+Every method family is called against tailscale_agent.fakeapi, which serves
+a synthetic tailnet with realistically sized payloads. The fake API runs in a
+separate process so its work does not show up in the client's timings or memory.
+For each tailnet size and operation the benchmark reports:
+
+  - per-call latency percentiles (p50, p95, p99) in milliseconds
+  - throughput in calls per second, for calls made one after another
+  - peak memory (tracemalloc) allocated by the client during one call, in KiB
+
+Results can be saved as a baseline, and later runs are compared with it.
+An operation counts as a regression when its p50 latency or peak memory is more
+than --tolerance above the baseline (latency must also have grown by more than
+--min-delta-ms, so jitter on sub-millisecond calls is ignored), and the benchmark
+then exits with status 1.
+Latency depends on the machine, so regenerate the baseline on the machine
+that makes the comparisons.
+
+--transport picks what the client sends requests through (see tailscale_agent.transport):
+requests (the default), urllib3, or memory. The memory transport calls an in-process
+fake API without sockets or HTTP, so its timings are the client's own overhead plus
+the fake API's routing; its peak memory includes the fake API's response bodies.
+Each transport has its own default baseline file.
+
+Run with: python benchmarks/bench_api.py [--sizes 1000,10000,100000] [--transport urllib3] [--save-baseline]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline_api.json')
+TRANSPORTS = ('requests', 'urllib3', 'memory')
+
+POLICY = '{"acls": [{"action": "accept", "src": ["group:eng"], "dst": ["tag:server:22,443"]}], "groups": {"group:eng": ["user1@example.com"]}}'
+START, END = '2025-01-01T00:00:00Z', '2025-01-02T00:00:00Z'
+
+
+def operations(ctx):
+    """ The benchmarked calls, as (family, name, call, scales_with_tailnet) tuples
+
+    :param ctx: Setup data: cycling iterators of existing object IDs
+
+    """
+
+    device = ctx['devices']
+    user = ctx['users']
+    key = ctx['keys']
+
+    return [
+        ('acl', 'get_acls', lambda c: c.get_acls(), False),
+        ('acl', 'validate_acls', lambda c: c.validate_acls(POLICY), False),
+        ('acl', 'update_acls(skip_unchanged)', lambda c: c.update_acls(POLICY, skip_unchanged=True), False),
+        ('acl', 'preview_acl_rules', lambda c: c.preview_acl_rules(POLICY, 'user', 'user1@example.com'), False),
+        ('devices', 'get_devices', lambda c: c.get_devices(), True),
+        ('devices', 'get_device', lambda c: c.get_device(next(device)), False),
+        ('devices', 'set_device_name', lambda c: c.set_device_name(next(device), 'renamed'), False),
+        ('devices', 'update_device_tags', lambda c: c.update_device_tags(next(device), ['tag:server']), False),
+        ('routes', 'get_device_routes', lambda c: c.get_device_routes(next(device)), False),
+        ('routes', 'set_device_routes', lambda c: c.set_device_routes(next(device), ['10.0.0.0/24']), False),
+        ('posture', 'get_device_posture_attributes', lambda c: c.get_device_posture_attributes(next(device)), False),
+        ('posture', 'set_device_posture_attribute',
+         lambda c: c.set_device_posture_attribute(next(device), 'custom:tier', 'gold'), False),
+        ('invites', 'list_device_invites', lambda c: c.list_device_invites(next(device)), False),
+        ('invites', 'list_user_invites', lambda c: c.list_user_invites(), False),
+        ('keys', 'get_authorization_keys', lambda c: c.get_authorization_keys(), False),
+        ('keys', 'get_key', lambda c: c.get_key(next(key)), False),
+        ('dns', 'get_dns_configuration', lambda c: c.get_dns_configuration(), False),
+        ('dns', 'get_nameservers', lambda c: c.get_nameservers(), False),
+        ('dns', 'update_split_dns', lambda c: c.update_split_dns({'corp.example.com': ['10.0.0.53']}), False),
+        ('logs', 'get_audit_logs', lambda c: c.get_audit_logs(START, END), False),
+        ('logs', 'get_network_logs', lambda c: c.get_network_logs(START, END), False),
+        ('tailnet', 'get_tailnet_settings', lambda c: c.get_tailnet_settings(), False),
+        ('tailnet', 'get_contacts', lambda c: c.get_contacts(), False),
+        ('tailnet', 'list_posture_integrations', lambda c: c.list_posture_integrations(), False),
+        ('users', 'get_users', lambda c: c.get_users(), True),
+        ('users', 'get_user', lambda c: c.get_user(next(user)), False),
+        ('webhooks', 'list_webhooks', lambda c: c.list_webhooks(), False),
+    ]
+
+
+def percentile(samples, pct):
+
+    ordered = sorted(samples)
+    index = (len(ordered) - 1) * pct / 100
+    low = int(index)
+    high = min(low + 1, len(ordered) - 1)
+
+    return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def measure(client, call, iterations):
+    """ Time a call and measure the client's peak memory for one more call
+
+    :return: dict of latency percentiles (ms), throughput (calls/s) and peak memory (KiB)
+
+    """
+
+    call(client)  # warm up the connection and any caches
+
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        response = call(client)
+        samples.append((time.perf_counter() - t0) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{response.request.method} {response.url} returned {response.status_code}')
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        call(client)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'calls': iterations,
+        'p50_ms': round(percentile(samples, 50), 3),
+        'p95_ms': round(percentile(samples, 95), 3),
+        'p99_ms': round(percentile(samples, 99), 3),
+        'throughput': round(iterations / elapsed, 1),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def fake_api(devices, transport):
+    """ Start a fake API and a client for it that uses the given transport
+
+    :return: A context manager yielding a Tailscale client
+
+    """
+
+    import contextlib
+
+    from tailscale_agent.fakeapi import FakeTailscaleAPI, spawn
+    from tailscale_agent.tailscale_agent import Tailscale
+    from tailscale_agent.transport import MemoryTransport, RequestsTransport, Urllib3Transport
+
+    users = max(devices // 20, 10)
+    if transport == 'memory':
+        api = FakeTailscaleAPI(devices=devices, users=users)
+        return contextlib.nullcontext(Tailscale('tskey-bench', 'http://fake.invalid/api/v2', api.tailnet,
+                                                transport=MemoryTransport(api)))
+
+    @contextlib.contextmanager
+    def spawned():
+        with spawn(devices=devices, users=users) as api:
+            backend = RequestsTransport() if transport == 'requests' else Urllib3Transport()
+            try:
+                yield Tailscale('tskey-bench', api.base_url, api.tailnet, transport=backend)
+            finally:
+                backend.close()
+
+    return spawned()
+
+
+def run_size(devices, iterations, families, transport='requests'):
+    """ Benchmark every operation against a tailnet with the given number of devices """
+
+    sys.path.insert(0, ROOT)
+
+    with fake_api(devices, transport) as client:
+
+        device_ids = [d['id'] for d in client.get_devices().json()['devices'][:500]]
+        user_ids = [u['id'] for u in client.get_users().json()['users'][:100]]
+        key_ids = [k['id'] for k in client.get_authorization_keys().json()['keys']]
+        client.create_webhook('https://hooks.example.com/tailscale', ['nodeCreated'])
+        client.create_user_invites([{'role': 'member', 'email': 'new@example.com'}])
+        ctx = {'devices': itertools.cycle(device_ids), 'users': itertools.cycle(user_ids),
+               'keys': itertools.cycle(key_ids)}
+
+        results = {}
+        for family, name, call, scales in operations(ctx):
+            if families and family not in families:
+                continue
+            # Listing a whole tailnet gets slower with its size, so it is called less often
+            count = max(5, iterations * 1000 // devices) if scales else iterations
+            results[name] = {'family': family, **measure(client, call, count)}
+
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """ Return a list of regression messages for results that are worse than the baseline """
+
+    slack = {'p50_ms': min_delta_ms, 'peak_kib': 0}
+
+    regressions = []
+    for size, operations_ in results.items():
+        for name, result in operations_.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            for metric in ('p50_ms', 'peak_kib'):
+                limit = max(previous[metric] * (1 + tolerance), previous[metric] + slack[metric])
+                if previous[metric] and result[metric] > limit:
+                    regressions.append(f'{size} devices, {name}: {metric} {result[metric]} '
+                                       f'vs baseline {previous[metric]} (+{result[metric] / previous[metric] - 1:.0%})')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated tailnet sizes in devices')
+    parser.add_argument('--iterations', type=int, default=50, help='calls per operation')
+    parser.add_argument('--families', default='', help='comma separated method families to run (default: all)')
+    parser.add_argument('--transport', choices=TRANSPORTS, default='requests',
+                        help='what the client sends requests through (default: requests)')
+    parser.add_argument('--baseline', help='baseline file to compare with or save to '
+                                           '(default: benchmarks/baseline_api.json, or baseline_api_TRANSPORT.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression (default: 0.25 = 25%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                        help='smallest p50 increase in ms that can count as a regression (default: 0.5)')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+    if args.baseline is None:
+        args.baseline = DEFAULT_BASELINE if args.transport == 'requests' else \
+            DEFAULT_BASELINE.replace('.json', f'_{args.transport}.json')
+
+    families = set(filter(None, args.families.split(',')))
+    results = {}
+    for size in (int(s) for s in args.sizes.split(',')):
+        results[str(size)] = run_size(size, args.iterations, families, args.transport)
+
+        print(f'\n{size} devices ({args.transport} transport)')
+        print(f'{"operation":<34}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"calls/s":>10}{"peak KiB":>11}')
+        for name, r in results[str(size)].items():
+            print(f'{name:<34}{r["p50_ms"]:>9.2f}{r["p95_ms"]:>9.2f}{r["p99_ms"]:>9.2f}'
+                  f'{r["throughput"]:>10.1f}{r["peak_kib"]:>11.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nSaved baseline to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}; run with --save-baseline to create one')
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+
+    print()
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+    if not regressions:
+        print(f'No regressions against {os.path.relpath(args.baseline)} (tolerance {args.tolerance:.0%})')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
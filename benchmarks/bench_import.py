@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Import-time and construction-time benchmark for tailscale_agent.
+
+Importing tailscale_agent.tailscale_agent and constructing a Tailscale client
+must stay cheap, because CLI wrappers do both on every invocation. Heavy
+dependencies such as requests are only imported when the first request is sent.
+
+The benchmark fails (exit status 1) when a measurement exceeds its budget, or
+when importing and constructing a client pulls in one of the deferred modules.
+
+Run with: python benchmarks/bench_import.py [--runs N]
+"""
+
+import argparse
+import compileall
+import os
+import statistics
+import subprocess
+import sys
+import timeit
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Regression budgets. Measured on a laptop the import takes ~1ms and construction
+# ~1us; the budgets leave headroom for slow CI machines.
+IMPORT_BUDGET_MS = 15
+CONSTRUCT_BUDGET_US = 50
+
+# Modules that importing the package and constructing a client must not load
+DEFERRED_MODULES = ('requests', 'urllib3', 'concurrent.futures', 'hashlib', 'json')
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import tailscale_agent.tailscale_agent as ts
+elapsed = time.perf_counter() - start
+ts.Tailscale('tskey-bench', 'https://api.tailscale.com/api/v2', 'example.com')
+print(elapsed)
+print(' '.join(m for m in {deferred!r} if m in sys.modules))
+"""
+
+
+def measure_import(runs):
+    """ Import the module in fresh interpreters and return the median time in ms and any deferred modules loaded """
+
+    # Make sure bytecode exists, so the measurement excludes compiling the source
+    compileall.compile_dir(os.path.join(ROOT, 'tailscale_agent'), quiet=1)
+
+    script = IMPORT_SCRIPT.format(deferred=DEFERRED_MODULES)
+    env = {**os.environ, 'PYTHONPATH': ROOT}
+    # Anything the bare interpreter already loads (e.g. via site hooks) is not our doing
+    baseline = f'import sys; print(" ".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))'
+    out = subprocess.run([sys.executable, '-c', baseline], env=env, capture_output=True, text=True, check=True)
+    preloaded = set(out.stdout.split())
+
+    timings, loaded = [], set()
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, check=True)
+        elapsed, _, modules = out.stdout.partition('\n')
+        timings.append(float(elapsed) * 1000)
+        loaded.update(modules.split())
+
+    return statistics.median(timings), sorted(loaded - preloaded)
+
+
+def measure_construct(number=20000):
+    """ Return the mean time in microseconds to construct a Tailscale client """
+
+    sys.path.insert(0, ROOT)
+    from tailscale_agent.tailscale_agent import Tailscale
+
+    timer = timeit.Timer(lambda: Tailscale('tskey-bench', 'https://api.tailscale.com/api/v2', 'example.com'))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=15, help='number of fresh interpreters to time the import in')
+    args = parser.parse_args()
+
+    import_ms, loaded = measure_import(args.runs)
+    construct_us = measure_construct()
+
+    failures = []
+    print(f'import tailscale_agent.tailscale_agent: {import_ms:8.2f} ms  (budget {IMPORT_BUDGET_MS} ms)')
+    print(f'Tailscale(...) construction:           {construct_us:8.2f} us  (budget {CONSTRUCT_BUDGET_US} us)')
+    if import_ms > IMPORT_BUDGET_MS:
+        failures.append('import time over budget')
+    if construct_us > CONSTRUCT_BUDGET_US:
+        failures.append('construction time over budget')
+    if loaded:
+        failures.append(f'deferred modules loaded at import/construction: {", ".join(loaded)}')
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Profile the client's CPU and memory use on recorded API traffic.
+
+Every call in a recording made with Tailscale.record() is replayed through a
+Tailscale client backed by a ReplaySession, so no network access is needed and
+the payloads are the real ones. Each response body is decoded as JSON, as
+callers do. The benchmark reports the replay time and peak memory, the functions
+with the most cumulative CPU time (cProfile), and the lines that allocated the
+most memory (tracemalloc).
+
+Run with: python benchmarks/bench_replay.py RECORDING [--speed 0] [--repeat 5] [--top 15]
+"""
+
+import argparse
+import cProfile
+import io
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+from urllib.parse import urlsplit
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='file written by Tailscale.record()')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed: 1 waits as long as the original responses, 0 (default) not at all')
+    parser.add_argument('--repeat', type=int, default=5, help='how many times to replay the whole recording')
+    parser.add_argument('--top', type=int, default=15, help='number of functions and allocation sites to show')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from tailscale_agent.recording import ReplaySession, load_recording
+    from tailscale_agent.tailscale_agent import Tailscale
+
+    entries = load_recording(args.recording)
+    base_url = 'http://replay.invalid'
+    client = Tailscale('tskey-replay', base_url, None, session=ReplaySession(entries, speed=args.speed))
+    calls = []
+    for entry in entries:
+        parts = urlsplit(entry['url'])
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        calls.append((entry['method'].lower(), base_url + path, entry.get('request_body'),
+                      entry.get('request_headers')))
+
+    def replay_call(method, url, body, headers):
+        response = client._request(method, url, headers={**client._headers, **headers} if headers else None,
+                                   data=body)
+        try:
+            return response, response.json()
+        except ValueError:
+            return response, None
+
+    # Warm up imports and caches so they do not show up in the measurements
+    for call in calls:
+        replay_call(*call)
+
+    # CPU: profile the replays without tracemalloc, which would distort the timings
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    for _ in range(args.repeat):
+        for call in calls:
+            replay_call(*call)
+    profiler.disable()
+    elapsed = time.perf_counter() - started
+
+    total = len(calls) * args.repeat
+    print(f'{total} calls replayed in {elapsed:.3f} s ({total / elapsed:.1f} calls/s, profiler overhead included)')
+
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(args.top)
+    print(out.getvalue())
+
+    # Memory: find the call that allocates the most, and where, while its result is alive
+    tracemalloc.start(10)
+    heaviest = (0, None, None)
+    for method, url, body, headers in calls:
+        before = tracemalloc.take_snapshot()
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = replay_call(method, url, body, headers)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        if peak > heaviest[0]:
+            heaviest = (peak, f'{method.upper()} {urlsplit(url).path}',
+                        tracemalloc.take_snapshot().compare_to(before, 'lineno'))
+        del result
+    tracemalloc.stop()
+
+    size, call, stats = heaviest
+    if call is not None:
+        print(f'Heaviest call: {call}, peak {size / 1024:.1f} KiB. Top {args.top} allocation sites held by its result:')
+        for stat in stats[:args.top]:
+            print(f'  {stat}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
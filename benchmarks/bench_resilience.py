@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Load and failure benchmark of the Tailscale client against a local fake API.
+
+Concurrent workers share one Tailscale client and fetch devices from a fake API
+(tailscale_agent.fakeapi) that adds latency, enforces a rate limit, throttles in
+bursts and fails a share of requests with 5xx errors, as configured. The benchmark
+reports how many calls eventually succeeded, the statuses of those that did not,
+and end-to-end latency percentiles and throughput including the client's retries.
+
+Run with, for example:
+
+    python benchmarks/bench_resilience.py --workers 16 --calls 2000 \\
+        --latency lognormal:40,0.5 --error-rate 0.05 --rate-limit 200 --max-retries 3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, pct):
+
+    ordered = sorted(samples)
+    index = (len(ordered) - 1) * pct / 100
+    low = int(index)
+    high = min(low + 1, len(ordered) - 1)
+
+    return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=10000, help='tailnet size')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent callers')
+    parser.add_argument('--calls', type=int, default=1000, help='total get_device calls')
+    parser.add_argument('--latency', help="server latency spec, e.g. 'lognormal:40,0.5' (ms)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests the server fails with 5xx')
+    parser.add_argument('--rate-limit', type=float, help='requests per second the server allows')
+    parser.add_argument('--throttle-burst', metavar='EVERY,DURATION', help='server 429 bursts')
+    parser.add_argument('--max-retries', type=int, default=3, help='client max_retries')
+    parser.add_argument('--client-rate', type=float, help='client-side RateLimiter rate (requests per second)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import requests
+    from requests.adapters import HTTPAdapter
+    from tailscale_agent.fakeapi import spawn
+    from tailscale_agent.tailscale_agent import RateLimiter, Tailscale
+
+    throttle_burst = tuple(float(v) for v in args.throttle_burst.split(',')) if args.throttle_burst else None
+
+    with spawn(devices=args.devices, latency=args.latency, error_rate=args.error_rate,
+               rate_limit=args.rate_limit, throttle_burst=throttle_burst) as api:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=args.workers))
+        rate_limiter = RateLimiter(args.client_rate) if args.client_rate else None
+        client = Tailscale('tskey-bench', api.base_url, api.tailnet, session=session,
+                           rate_limiter=rate_limiter, max_retries=args.max_retries)
+        # Device IDs are sequential from this base (see tailscale_agent.fakeapi.make_device)
+        device_ids = [str(1000000000000000 + i % args.devices) for i in range(args.calls)]
+
+        def call(device_id):
+            t0 = time.perf_counter()
+            try:
+                status = client.get_device(device_id).status_code
+            except requests.RequestException as error:
+                status = type(error).__name__
+            return status, (time.perf_counter() - t0) * 1000
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            outcomes = list(executor.map(call, device_ids))
+        elapsed = time.perf_counter() - started
+
+    statuses = Counter(status for status, _ in outcomes)
+    latencies = [ms for _, ms in outcomes]
+    succeeded = statuses.pop(200, 0)
+
+    print(f'calls:       {len(outcomes)} with {args.workers} workers in {elapsed:.2f} s '
+          f'({len(outcomes) / elapsed:.1f} calls/s)')
+    print(f'succeeded:   {succeeded} ({succeeded / len(outcomes):.1%})')
+    print(f'failed:      {dict(statuses) or "none"}')
+    print(f'latency ms:  p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  '
+          f'p99 {percentile(latencies, 99):.1f}  max {max(latencies):.1f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1541 @@
+"""
+An in-process stand-in for api.tailscale.com, for tests and benchmarks.
+
+FakeTailscaleAPI serves the endpoints used by tailscale_agent.tailscale_agent.Tailscale
+from a synthetic tailnet held in memory, with payloads shaped like the real API's.
+It runs a threaded HTTP server on localhost:
+
+    with FakeTailscaleAPI(devices=10000) as api:
+        client = Tailscale('tskey-fake', api.base_url, api.tailnet)
+        client.get_devices()
+
+It can also be started as a separate process with ``python -m tailscale_agent.fakeapi``,
+or from Python with spawn().
+
+To see how clients behave under load and failures, the server can add latency drawn
+from a distribution, enforce a rate limit, answer bursts of requests with 429 and a
+Retry-After header, and fail a share of requests with 5xx errors:
+
+    api = FakeTailscaleAPI(devices=100000, latency='lognormal:40,0.5', error_rate=0.02,
+                           rate_limit=100, throttle_burst=(30, 5))
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from tailscale_agent.tailscale_agent import _strip_hujson
+
+
+API_PREFIX = '/api/v2'
+
+_OPERATING_SYSTEMS = ('linux', 'windows', 'macOS', 'iOS', 'android')
+_ROLES = ('member', 'member', 'member', 'admin', 'it-admin', 'network-admin', 'auditor')
+_USER_STATUSES = ('active', 'active', 'active', 'idle', 'suspended', 'needs-approval')
+_REGIONS = ('Frankfurt', 'New York City', 'San Francisco', 'Singapore', 'London')
+
+DEFAULT_POLICY = b'''{
+  // Allow all connections by default
+  "acls": [{"action": "accept", "src": ["*"], "dst": ["*:*"]}],
+  "tagOwners": {"tag:server": ["autogroup:admin"]},
+}'''
+
+
+def latency_distribution(spec):
+    """ Build a latency sampler from a spec string
+
+        Supported specs, with times in milliseconds:
+
+        - 'fixed:MS'
+        - 'uniform:LOW,HIGH'
+        - 'normal:MEAN,STDDEV' (negative samples count as 0)
+        - 'lognormal:MEDIAN,SIGMA', a long-tailed distribution like real API latency
+        - 'pareto:MINIMUM,ALPHA', an even heavier tail
+
+    :param spec: The spec string
+
+    :return: A function taking a random.Random and returning a delay in seconds
+
+    """
+
+    kind, _, args = spec.partition(':')
+    try:
+        values = [float(v) for v in args.split(',')] if args else []
+    except ValueError:
+        raise ValueError(f'invalid latency spec {spec!r}') from None
+
+    samplers = {
+        ('fixed', 1): lambda rng: values[0],
+        ('uniform', 2): lambda rng: rng.uniform(values[0], values[1]),
+        ('normal', 2): lambda rng: max(rng.gauss(values[0], values[1]), 0),
+        ('lognormal', 2): lambda rng: rng.lognormvariate(math.log(values[0]), values[1]),
+        ('pareto', 2): lambda rng: values[0] * rng.paretovariate(values[1]),
+    }
+    sampler = samplers.get((kind, len(values)))
+    if sampler is None:
+        raise ValueError(f'invalid latency spec {spec!r}')
+
+    return lambda rng: sampler(rng) / 1000
+
+
+def _timestamp(rng, year=2025):
+
+    return (f'{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T'
+            f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}Z')
+
+
+def _hex(rng, bits=256):
+
+    return f'{rng.getrandbits(bits):0{bits // 4}x}'
+
+
+def make_user(rng, index, tailnet):
+    """ Build a user record shaped like the API's
+
+    :param rng: random.Random instance to draw values from
+    :param index: Sequence number of the user, used to make its IDs unique
+    :param tailnet: The tailnet name
+
+    :return: The user dict
+
+    """
+
+    return {
+        'id': f'u{100000 + index}CNTRL',
+        'displayName': f'User {index}',
+        'loginName': f'user{index}@{tailnet}',
+        'profilePicUrl': f'https://avatars.example.com/{index}.png',
+        'tailnetId': f't{rng.getrandbits(40)}CNTRL',
+        'created': _timestamp(rng, 2023),
+        'type': 'member' if index % 25 else 'shared',
+        'role': 'owner' if index == 0 else rng.choice(_ROLES),
+        'status': 'active' if index == 0 else rng.choice(_USER_STATUSES),
+        'deviceCount': rng.randint(0, 6),
+        'lastSeen': _timestamp(rng),
+        'currentlyConnected': rng.random() < 0.3,
+    }
+
+
+def make_device(rng, index, tailnet, users):
+    """ Build a device record shaped like the API's (roughly 1.5KB of JSON)
+
+    :param rng: random.Random instance to draw values from
+    :param index: Sequence number of the device, used to make its IDs and addresses unique
+    :param tailnet: The tailnet name
+    :param users: List of user dicts to pick the owner from
+
+    :return: The device dict
+
+    """
+
+    hostname = f'host-{index:06d}'
+    tags = [] if index % 3 else [f'tag:{rng.choice(("server", "ci", "db", "web"))}']
+    advertised = [f'10.{index % 256}.{rng.randint(0, 255)}.0/24'] if index % 10 == 0 else []
+
+    return {
+        'addresses': [f'100.{64 + index // 65536 % 64}.{index // 256 % 256}.{index % 256}',
+                      f'fd7a:115c:a1e0::{index:x}'],
+        'id': str(1000000000000000 + index),
+        'nodeId': f'n{index:010d}CNTRL',
+        'user': rng.choice(users)['loginName'] if users else f'admin@{tailnet}',
+        'name': f'{hostname}.tail{index % 97:04x}.ts.net',
+        'hostname': hostname,
+        'clientVersion': f'1.{rng.randint(70, 82)}.{rng.randint(0, 4)}-t{_hex(rng, 28)}-g{_hex(rng, 36)}',
+        'updateAvailable': rng.random() < 0.2,
+        'os': rng.choice(_OPERATING_SYSTEMS),
+        'created': _timestamp(rng, 2024),
+        'lastSeen': _timestamp(rng),
+        'keyExpiryDisabled': bool(tags),
+        'expires': '0001-01-01T00:00:00Z' if tags else _timestamp(rng, 2026),
+        'authorized': True,
+        'isExternal': False,
+        'machineKey': f'mkey:{_hex(rng)}',
+        'nodeKey': f'nodekey:{_hex(rng)}',
+        'blocksIncomingConnections': False,
+        'enabledRoutes': list(advertised),
+        'advertisedRoutes': advertised,
+        'clientConnectivity': {
+            'endpoints': [f'203.0.113.{rng.randint(1, 254)}:41641', f'192.168.{rng.randint(0, 255)}.{rng.randint(1, 254)}:41641'],
+            'mappingVariesByDestIP': False,
+            'latency': {region: {'latencyMs': round(rng.uniform(2, 200), 3), 'preferred': i == 0}
+                        for i, region in enumerate(rng.sample(_REGIONS, 3))},
+            'clientSupports': {'hairPinning': False, 'ipv6': rng.random() < 0.5, 'pcp': False,
+                               'pmp': False, 'udp': True, 'upnp': rng.random() < 0.2},
+        },
+        'tags': tags,
+        'tailnetLockError': '',
+        'tailnetLockKey': f'tlpub:{_hex(rng)}',
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without TCP_NODELAY small responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        status, headers, payload = self.server.api.handle(self.command, self.path, self.headers, body)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class FakeTailscaleAPI:
+    """ A local HTTP server imitating the Tailscale API over a synthetic tailnet """
+
+    def __init__(self, tailnet='example.com', devices=100, users=20, keys=10, seed=0,
+                 host='127.0.0.1', port=0, api_keys=None, latency=None, error_rate=0.0,
+                 error_statuses=(500, 502, 503), rate_limit=None, throttle_burst=None):
+        """ Constructor for the FakeTailscaleAPI class
+
+        :param tailnet: The tailnet name the API serves
+        :param devices: Number of synthetic devices to generate
+        :param users: Number of synthetic users to generate
+        :param keys: Number of synthetic auth keys to generate
+        :param seed: Seed for the data generator, so datasets are reproducible
+        :param host: Address to listen on
+        :param port: Port to listen on (0 picks a free port)
+        :param api_keys: Optional set of accepted API keys. By default any key is accepted,
+            but requests without credentials are still rejected with 401
+        :param latency: Optional delay added to every response: a spec string for
+            latency_distribution, or a function taking a random.Random and returning seconds
+        :param error_rate: Share of requests (0-1) answered with a random status from error_statuses
+        :param error_statuses: The 5xx statuses used for injected errors
+        :param rate_limit: Optional requests per second the API allows (burst of the same
+            size); requests over the limit get 429 with the Retry-After to wait
+        :param throttle_burst: Optional (every, duration) in seconds: for the first duration
+            seconds of every period of every seconds, all requests get 429 with Retry-After
+
+        The fault settings are plain attributes and can be changed while the server runs.
+        Counts of the statuses served so far are kept in status_counts.
+
+        """
+
+        if isinstance(latency, str):
+            latency_distribution(latency)  # fail early on a bad spec
+
+        self.tailnet = tailnet
+        self._host = host
+        self._port = port
+        self._api_keys = set(api_keys) if api_keys is not None else None
+        self._server = None
+        self._thread = None
+        self._lock = threading.RLock()
+        self._rng = random.Random(seed)
+        self._devices_body = None
+        self.request_count = 0
+        self.status_counts = {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.rate_limit = rate_limit
+        self.throttle_burst = throttle_burst
+        self._chaos_rng = random.Random(seed)
+        self._bucket = None
+        self._started_at = time.monotonic()
+
+        rng = self._rng
+        user_list = [make_user(rng, i, tailnet) for i in range(users)]
+        self.users = {user['id']: user for user in user_list}
+        self.devices = {}
+        for i in range(devices):
+            device = make_device(rng, i, tailnet, user_list)
+            self.devices[device['id']] = device
+        self.node_ids = {device['nodeId']: device['id'] for device in self.devices.values()}
+        self.attributes = {}
+        self.keys = {}
+        for _ in range(keys):
+            self._new_key({'devices': {'create': {'reusable': False, 'ephemeral': False,
+                                                  'preauthorized': True, 'tags': ['tag:server']}}},
+                          rng.choice((3600, 86400, 7776000)), 'generated')
+        self.policy = DEFAULT_POLICY
+        self.dns = {'nameservers': ['8.8.8.8'], 'searchPaths': [], 'splitDNS': {},
+                    'preferences': {'magicDNS': True}}
+        self.settings = {
+            'aclsExternallyManagedOn': False, 'aclsExternalLink': '', 'devicesApprovalOn': False,
+            'devicesAutoUpdatesOn': True, 'devicesKeyDurationDays': 180, 'usersApprovalOn': False,
+            'usersRoleAllowedToJoinExternalTailnets': 'member', 'networkFlowLoggingOn': False,
+            'regionalRoutingOn': False, 'postureIdentityCollectionOn': False, 'httpsEnabled': True,
+        }
+        self.contacts = {kind: {'email': f'{kind}@{tailnet}', 'fallbackEmail': '', 'needsVerification': False}
+                         for kind in ('account', 'support', 'security')}
+        self.posture_integrations = {}
+        self.log_streams = {}
+        self._log_pages = {}
+        self.device_invites = {}
+        self.user_invites = {}
+        self.webhooks = {}
+        self._routes = self._build_routes()
+
+
+    def __repr__(self):
+
+        return f'FakeTailscaleAPI(base_url={self.base_url}, tailnet={self.tailnet}, devices={len(self.devices)})'
+
+
+    def __enter__(self):
+
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+    @property
+    def base_url(self):
+        """ The URL to pass to Tailscale as base_url """
+
+        port = self._server.server_address[1] if self._server else self._port
+        return f'http://{self._host}:{port}{API_PREFIX}'
+
+
+    def start(self):
+        """ Start serving in a background thread
+
+        :return: self
+
+        """
+
+        self._server = _Server((self._host, self._port), _Handler)
+        self._server.api = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-tailscale-api', daemon=True)
+        self._thread.start()
+
+        return self
+
+
+    def stop(self):
+        """ Stop serving and close the listening socket
+
+        """
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+
+    def serve_forever(self):
+        """ Serve in the calling thread until interrupted
+
+        """
+
+        self._server = _Server((self._host, self._port), _Handler)
+        self._server.api = self
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+
+    # ---------------------------------------------------------------------------
+    # Request handling
+    # ---------------------------------------------------------------------------
+
+    def handle(self, method, raw_path, headers, body):
+        """ Produce the response for one request
+
+        :param method: The HTTP verb
+        :param raw_path: The request path including the query string
+        :param headers: The request headers
+        :param body: The raw request body
+
+        :return: A (status, headers dict, body bytes) tuple
+
+        """
+
+        with self._lock:
+            self.request_count += 1
+
+        response = self._inject_fault() or self._route(method, raw_path, headers, body)
+
+        if self.latency is not None:
+            sampler = latency_distribution(self.latency) if isinstance(self.latency, str) else self.latency
+            with self._lock:
+                delay = sampler(self._chaos_rng)
+            time.sleep(delay)
+
+        with self._lock:
+            self.status_counts[response[0]] = self.status_counts.get(response[0], 0) + 1
+
+        return response
+
+
+    def _inject_fault(self):
+        """ Return a throttling or error response if one of the fault settings applies, else None """
+
+        with self._lock:
+            now = time.monotonic()
+
+            if self.throttle_burst:
+                every, duration = self.throttle_burst
+                into_period = (now - self._started_at) % every
+                if into_period < duration:
+                    return _throttled(duration - into_period)
+
+            if self.rate_limit:
+                tokens, updated = self._bucket or (self.rate_limit, now)
+                tokens = min(self.rate_limit, tokens + (now - updated) * self.rate_limit)
+                if tokens < 1:
+                    self._bucket = (tokens, now)
+                    return _throttled((1 - tokens) / self.rate_limit)
+                self._bucket = (tokens - 1, now)
+
+            if self.error_rate and self._chaos_rng.random() < self.error_rate:
+                status = self._chaos_rng.choice(self.error_statuses)
+                return _json(status, {'message': 'injected server error'})
+
+        return None
+
+
+    def _route(self, method, raw_path, headers, body):
+
+        parts = urlsplit(raw_path)
+        path = parts.path[len(API_PREFIX):] if parts.path.startswith(API_PREFIX) else parts.path
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+        if path != '/oauth/token' and not self._authorized(headers):
+            return _json(401, {'message': 'API token invalid'})
+
+        for verb, pattern, handler in self._routes:
+            match = pattern.fullmatch(path)
+            if match and verb == method:
+                request = _Request(method, path, query, headers, body, match.groupdict())
+                try:
+                    with self._lock:
+                        return handler(request)
+                except (ValueError, KeyError, TypeError) as error:
+                    return _json(400, {'message': f'invalid request: {error}'})
+
+        return _json(404, {'message': 'not found'})
+
+
+    def _authorized(self, headers):
+
+        authorization = headers.get('Authorization') or ''
+        if authorization.startswith('Basic '):
+            import base64
+            try:
+                key = base64.b64decode(authorization[6:]).decode('latin1').partition(':')[0]
+            except ValueError:
+                return False
+        elif authorization.startswith('Bearer '):
+            key = authorization[7:]
+        else:
+            return False
+
+        if not key:
+            return False
+
+        return self._api_keys is None or key in self._api_keys
+
+
+    def _build_routes(self):
+
+        t = r'/tailnet/(?P<tailnet>[^/]+)'
+        d = r'/device/(?P<device_id>[^/]+)'
+        table = [
+            ('GET', t + '/acl', self._get_acl),
+            ('POST', t + '/acl', self._set_acl),
+            ('POST', t + '/acl/validate', self._validate_acl),
+            ('POST', t + '/acl/preview', self._preview_acl),
+            ('GET', t + '/devices', self._list_devices),
+            ('GET', d, self._get_device),
+            ('DELETE', d, self._delete_device),
+            ('POST', d + '/authorized', self._authorize_device),
+            ('POST', d + '/expire', self._expire_device),
+            ('POST', d + '/name', self._set_device_field('name')),
+            ('POST', d + '/key', self._set_device_field('keyExpiryDisabled')),
+            ('POST', d + '/ip', self._set_device_ip),
+            ('POST', d + '/tags', self._set_device_field('tags')),
+            ('GET', d + '/routes', self._get_routes),
+            ('POST', d + '/routes', self._set_routes),
+            ('GET', d + '/attributes', self._get_attributes),
+            ('POST', d + r'/attributes/(?P<key>[^/]+)', self._set_attribute),
+            ('DELETE', d + r'/attributes/(?P<key>[^/]+)', self._delete_attribute),
+            ('PATCH', t + '/device-attributes', self._batch_attributes),
+            ('GET', d + '/device-invites', self._list_device_invites),
+            ('POST', d + '/device-invites', self._create_device_invites),
+            ('POST', '/device-invites/-/accept', self._accept_device_invite),
+            ('GET', r'/device-invites/(?P<invite_id>[^/]+)', self._get_invite(self.device_invites)),
+            ('DELETE', r'/device-invites/(?P<invite_id>[^/]+)', self._delete_invite(self.device_invites)),
+            ('POST', r'/device-invites/(?P<invite_id>[^/]+)/resend', self._resend_invite(self.device_invites)),
+            ('GET', t + '/keys', self._list_keys),
+            ('POST', t + '/keys', self._create_key),
+            ('GET', t + r'/keys/(?P<key_id>[^/]+)', self._get_key),
+            ('PUT', t + r'/keys/(?P<key_id>[^/]+)', self._update_key),
+            ('DELETE', t + r'/keys/(?P<key_id>[^/]+)', self._delete_key),
+            ('GET', t + '/dns/nameservers', self._get_nameservers),
+            ('POST', t + '/dns/nameservers', self._set_nameservers),
+            ('GET', t + '/dns/preferences', self._get_dns_preferences),
+            ('POST', t + '/dns/preferences', self._set_dns_preferences),
+            ('GET', t + '/dns/searchpaths', self._get_searchpaths),
+            ('POST', t + '/dns/searchpaths', self._set_searchpaths),
+            ('GET', t + '/dns/split-dns', self._get_split_dns),
+            ('PATCH', t + '/dns/split-dns', self._patch_split_dns),
+            ('PUT', t + '/dns/split-dns', self._put_split_dns),
+            ('GET', t + '/dns/configuration', self._get_dns_configuration),
+            ('POST', t + '/dns/configuration', self._set_dns_configuration),
+            ('GET', t + '/logs', self._get_logs('configuration')),
+            ('GET', t + '/network-logs', self._get_logs('network')),
+            ('GET', t + r'/logging/(?P<log_type>[^/]+)/stream', self._get_log_stream),
+            ('PUT', t + r'/logging/(?P<log_type>[^/]+)/stream', self._set_log_stream),
+            ('DELETE', t + r'/logging/(?P<log_type>[^/]+)/stream', self._delete_log_stream),
+            ('GET', t + r'/logging/(?P<log_type>[^/]+)/stream/status', self._get_log_stream_status),
+            ('POST', t + '/aws-external-id', self._aws_external_id),
+            ('POST', t + r'/aws-external-id/(?P<external_id>[^/]+)/validate-aws-trust-policy', self._ok),
+            ('POST', '/oauth/token', self._oauth_token),
+            ('GET', t + '/settings', self._get_settings),
+            ('PATCH', t + '/settings', self._update_settings),
+            ('GET', t + '/contacts', self._get_contacts),
+            ('PATCH', t + r'/contacts/(?P<contact_type>[^/]+)', self._update_contact),
+            ('POST', t + r'/contacts/(?P<contact_type>[^/]+)/resend-verification-email', self._ok),
+            ('GET', t + '/posture/integrations', self._list_posture_integrations),
+            ('POST', t + '/posture/integrations', self._create_posture_integration),
+            ('GET', r'/posture/integrations/(?P<integration_id>[^/]+)', self._get_posture_integration),
+            ('PATCH', r'/posture/integrations/(?P<integration_id>[^/]+)', self._update_posture_integration),
+            ('DELETE', r'/posture/integrations/(?P<integration_id>[^/]+)', self._delete_posture_integration),
+            ('GET', t + '/users', self._list_users),
+            ('GET', r'/users/(?P<user_id>[^/]+)', self._get_user),
+            ('POST', r'/users/(?P<user_id>[^/]+)/role', self._set_user_role),
+            ('POST', r'/users/(?P<user_id>[^/]+)/approve', self._set_user_status('active')),
+            ('POST', r'/users/(?P<user_id>[^/]+)/suspend', self._set_user_status('suspended')),
+            ('POST', r'/users/(?P<user_id>[^/]+)/restore', self._set_user_status('active')),
+            ('POST', r'/users/(?P<user_id>[^/]+)/delete', self._delete_user),
+            ('GET', t + '/user-invites', self._list_user_invites),
+            ('POST', t + '/user-invites', self._create_user_invites),
+            ('GET', r'/user-invites/(?P<invite_id>[^/]+)', self._get_invite(self.user_invites)),
+            ('DELETE', r'/user-invites/(?P<invite_id>[^/]+)', self._delete_invite(self.user_invites)),
+            ('POST', r'/user-invites/(?P<invite_id>[^/]+)/resend', self._resend_invite(self.user_invites)),
+            ('GET', t + '/webhooks', self._list_webhooks),
+            ('POST', t + '/webhooks', self._create_webhook),
+            ('GET', r'/webhooks/(?P<endpoint_id>[^/]+)', self._get_webhook),
+            ('PATCH', r'/webhooks/(?P<endpoint_id>[^/]+)', self._update_webhook),
+            ('DELETE', r'/webhooks/(?P<endpoint_id>[^/]+)', self._delete_webhook),
+            ('POST', r'/webhooks/(?P<endpoint_id>[^/]+)/rotate', self._rotate_webhook),
+            ('POST', r'/webhooks/(?P<endpoint_id>[^/]+)/test', self._test_webhook),
+        ]
+
+        return [(verb, re.compile(pattern), handler) for verb, pattern, handler in table]
+
+
+    def _ok(self, request):
+
+        return _json(200, {})
+
+
+    # ---------------------------------------------------------------------------
+    # ACL / Policy File
+    # ---------------------------------------------------------------------------
+
+    def _policy_response(self):
+
+        policy = json.loads(_strip_hujson(self.policy.decode('utf-8')))
+        etag = f'"{hashlib.sha256(self.policy).hexdigest()[:16]}"'
+
+        return _json(200, policy, {'ETag': etag})
+
+
+    def _get_acl(self, request):
+
+        response = self._policy_response()
+        if request.headers.get('If-None-Match') == response[1]['ETag']:
+            return 304, {'ETag': response[1]['ETag']}, b''
+
+        return response
+
+
+    def _set_acl(self, request):
+
+        if_match = request.headers.get('If-Match')
+        if if_match and if_match != self._policy_response()[1]['ETag']:
+            return _json(412, {'message': 'precondition failed, invalid old hash'})
+
+        json.loads(_strip_hujson(request.body.decode('utf-8')))
+        self.policy = request.body
+
+        return self._policy_response()
+
+
+    def _validate_acl(self, request):
+
+        try:
+            json.loads(_strip_hujson(request.body.decode('utf-8')))
+        except ValueError as error:
+            return _json(200, {'message': f'invalid policy: {error}'})
+
+        return _json(200, {})
+
+
+    def _preview_acl(self, request):
+
+        policy = json.loads(_strip_hujson(request.body.decode('utf-8')))
+        matches = [{'users': acl.get('src', []), 'ports': acl.get('dst', []), 'lineNumber': i + 1}
+                   for i, acl in enumerate(policy.get('acls', []))]
+
+        return _json(200, {'matches': matches, 'type': request.query.get('type'),
+                           'previewFor': request.query.get('previewFor')})
+
+
+    # ---------------------------------------------------------------------------
+    # Devices, routes and posture attributes
+    # ---------------------------------------------------------------------------
+
+    def _device(self, request):
+
+        device_id = request.params['device_id']
+        device_id = self.node_ids.get(device_id, device_id)
+
+        return self.devices.get(device_id)
+
+
+    def _device_changed(self):
+
+        self._devices_body = None
+
+
+    def _list_devices(self, request):
+
+        # Serializing a large tailnet is expensive, so the body is reused until a device changes
+        if self._devices_body is None:
+            self._devices_body = json.dumps({'devices': list(self.devices.values())}).encode('utf-8')
+
+        return 200, {'Content-Type': 'application/json'}, self._devices_body
+
+
+    def _get_device(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, device)
+
+
+    def _delete_device(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        del self.devices[device['id']]
+        self.node_ids.pop(device['nodeId'], None)
+        self._device_changed()
+
+        return _json(200, {})
+
+
+    def _authorize_device(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        device['authorized'] = bool(request.json().get('authorized', True))
+        self._device_changed()
+
+        return _json(200, {})
+
+
+    def _expire_device(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        device['expires'] = '2000-01-01T00:00:00Z'
+        self._device_changed()
+
+        return _json(200, {})
+
+
+    def _set_device_field(self, field):
+
+        def handler(request):
+            device = self._device(request)
+            if device is None:
+                return _json(404, {'message': 'not found'})
+
+            device[field] = request.json()[field]
+            self._device_changed()
+
+            return _json(200, {})
+
+        return handler
+
+
+    def _set_device_ip(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        device['addresses'][0] = request.json()['ipv4']
+        self._device_changed()
+
+        return _json(200, {})
+
+
+    def _routes_body(self, device):
+
+        return {'advertisedRoutes': device['advertisedRoutes'], 'enabledRoutes': device['enabledRoutes']}
+
+
+    def _get_routes(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, self._routes_body(device))
+
+
+    def _set_routes(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        device['enabledRoutes'] = list(request.json()['routes'])
+        self._device_changed()
+
+        return _json(200, self._routes_body(device))
+
+
+    def _get_attributes(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        attributes = {'node:os': device['os'], 'node:tsVersion': device['clientVersion'].split('-')[0]}
+        expiries = {}
+        for key, entry in self.attributes.get(device['id'], {}).items():
+            attributes[key] = entry['value']
+            if entry.get('expiry'):
+                expiries[key] = entry['expiry']
+
+        return _json(200, {'attributes': attributes, 'expiries': expiries})
+
+
+    def _set_attribute(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        body = request.json()
+        self.attributes.setdefault(device['id'], {})[request.params['key']] = {
+            'value': body['value'], 'expiry': body.get('expiry')}
+
+        return _json(200, {})
+
+
+    def _delete_attribute(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        self.attributes.get(device['id'], {}).pop(request.params['key'], None)
+
+        return _json(200, {})
+
+
+    def _batch_attributes(self, request):
+
+        for device_id, changes in request.json()['nodes'].items():
+            device_id = self.node_ids.get(device_id, device_id)
+            if device_id not in self.devices:
+                return _json(404, {'message': f'device {device_id} not found'})
+            stored = self.attributes.setdefault(device_id, {})
+            for key, change in changes.items():
+                if change is None or (isinstance(change, dict) and change.get('value') is None):
+                    stored.pop(key, None)
+                elif isinstance(change, dict):
+                    stored[key] = {'value': change['value'], 'expiry': change.get('expiry')}
+                else:
+                    stored[key] = {'value': change, 'expiry': None}
+
+        return _json(200, {})
+
+
+    # ---------------------------------------------------------------------------
+    # Device and user invites
+    # ---------------------------------------------------------------------------
+
+    def _new_invite(self, store, extra, entry):
+
+        invite_id = str(self._rng.getrandbits(52))
+        invite = {'id': invite_id, 'created': _timestamp(self._rng), 'tailnetId': self.tailnet,
+                  'inviterId': 'u100000CNTRL', 'email': entry.get('email', ''),
+                  'lastEmailSentAt': _timestamp(self._rng) if entry.get('email') else '',
+                  'inviteUrl': f'https://login.tailscale.com/admin/invite/{_hex(self._rng, 64)}',
+                  **extra}
+        store[invite_id] = invite
+
+        return invite
+
+
+    def _list_device_invites(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, [i for i in self.device_invites.values() if i['deviceId'] == device['id']])
+
+
+    def _create_device_invites(self, request):
+
+        device = self._device(request)
+        if device is None:
+            return _json(404, {'message': 'not found'})
+
+        entries = request.json()
+        for entry in entries:
+            if 'email' in entry and '@' not in entry['email']:
+                return _json(400, {'message': f'invalid email address {entry["email"]!r}'})
+
+        invites = [self._new_invite(self.device_invites, {
+            'deviceId': device['id'], 'multiUse': bool(entry.get('multiUse')),
+            'allowExitNode': bool(entry.get('allowExitNode')), 'accepted': False}, entry) for entry in entries]
+
+        return _json(200, invites)
+
+
+    def _accept_device_invite(self, request):
+
+        code = request.json()['invite'].rstrip('/').rsplit('/', 1)[-1]
+        for invite in self.device_invites.values():
+            if invite['inviteUrl'].endswith(code):
+                invite['accepted'] = True
+                return _json(200, {'device': self.devices.get(invite['deviceId'])})
+
+        return _json(404, {'message': 'invite not found'})
+
+
+    def _get_invite(self, store):
+
+        def handler(request):
+            invite = store.get(request.params['invite_id'])
+            if invite is None:
+                return _json(404, {'message': 'not found'})
+            return _json(200, invite)
+
+        return handler
+
+
+    def _delete_invite(self, store):
+
+        def handler(request):
+            if store.pop(request.params['invite_id'], None) is None:
+                return _json(404, {'message': 'not found'})
+            return _json(200, {})
+
+        return handler
+
+
+    def _resend_invite(self, store):
+
+        def handler(request):
+            invite = store.get(request.params['invite_id'])
+            if invite is None:
+                return _json(404, {'message': 'not found'})
+            invite['lastEmailSentAt'] = _timestamp(self._rng)
+            return _json(200, {})
+
+        return handler
+
+
+    def _list_user_invites(self, request):
+
+        return _json(200, list(self.user_invites.values()))
+
+
+    def _create_user_invites(self, request):
+
+        entries = request.json()
+        for entry in entries:
+            if 'email' in entry and '@' not in entry['email']:
+                return _json(400, {'message': f'invalid email address {entry["email"]!r}'})
+            if entry.get('role', 'member') not in _ROLES + ('billing-admin',):
+                return _json(400, {'message': f'invalid role {entry["role"]!r}'})
+
+        invites = [self._new_invite(self.user_invites, {'role': entry.get('role', 'member')}, entry)
+                   for entry in entries]
+
+        return _json(200, invites)
+
+
+    # ---------------------------------------------------------------------------
+    # Keys
+    # ---------------------------------------------------------------------------
+
+    def _new_key(self, capabilities, expiry_seconds, description):
+
+        key_id = f'k{_hex(self._rng, 48)}CNTRL'
+        key = {'id': key_id, 'keyType': 'auth', 'description': description or '',
+               'created': _timestamp(self._rng), 'expires': _timestamp(self._rng, 2026),
+               'expirySeconds': expiry_seconds, 'revoked': None, 'invalid': False,
+               'capabilities': capabilities, 'userId': 'u100000CNTRL'}
+        self.keys[key_id] = key
+
+        return key
+
+
+    def _list_keys(self, request):
+
+        return _json(200, {'keys': [{'id': key['id'], 'description': key['description']}
+                                    for key in self.keys.values()]})
+
+
+    def _create_key(self, request):
+
+        body = request.json()
+        key = self._new_key(body['capabilities'], body.get('expirySeconds', 7776000), body.get('description'))
+
+        return _json(200, {**key, 'key': f'tskey-auth-{key["id"]}-{_hex(self._rng, 128)}'})
+
+
+    def _get_key(self, request):
+
+        key = self.keys.get(request.params['key_id'])
+        if key is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, key)
+
+
+    def _update_key(self, request):
+
+        key = self.keys.get(request.params['key_id'])
+        if key is None:
+            return _json(404, {'message': 'not found'})
+
+        key.update(request.json())
+
+        return _json(200, key)
+
+
+    def _delete_key(self, request):
+
+        if self.keys.pop(request.params['key_id'], None) is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, {})
+
+
+    # ---------------------------------------------------------------------------
+    # DNS
+    # ---------------------------------------------------------------------------
+
+    def _get_nameservers(self, request):
+
+        return _json(200, {'dns': self.dns['nameservers']})
+
+
+    def _set_nameservers(self, request):
+
+        self.dns['nameservers'] = list(request.json()['dns'])
+        if not self.dns['nameservers']:
+            self.dns['preferences']['magicDNS'] = False
+
+        return _json(200, {'dns': self.dns['nameservers'], 'magicDNS': self.dns['preferences']['magicDNS']})
+
+
+    def _get_dns_preferences(self, request):
+
+        return _json(200, {'magicDNS': self.dns['preferences']['magicDNS']})
+
+
+    def _set_dns_preferences(self, request):
+
+        self.dns['preferences']['magicDNS'] = bool(request.json()['magicDNS'])
+
+        return _json(200, {'magicDNS': self.dns['preferences']['magicDNS']})
+
+
+    def _get_searchpaths(self, request):
+
+        return _json(200, {'searchPaths': self.dns['searchPaths']})
+
+
+    def _set_searchpaths(self, request):
+
+        self.dns['searchPaths'] = list(request.json()['searchPaths'])
+
+        return _json(200, {'searchPaths': self.dns['searchPaths']})
+
+
+    def _get_split_dns(self, request):
+
+        return _json(200, self.dns['splitDNS'])
+
+
+    def _patch_split_dns(self, request):
+
+        for domain, nameservers in request.json().items():
+            if nameservers is None:
+                self.dns['splitDNS'].pop(domain, None)
+            else:
+                self.dns['splitDNS'][domain] = list(nameservers)
+
+        return _json(200, self.dns['splitDNS'])
+
+
+    def _put_split_dns(self, request):
+
+        self.dns['splitDNS'] = {domain: list(ns) for domain, ns in request.json().items() if ns is not None}
+
+        return _json(200, self.dns['splitDNS'])
+
+
+    def _get_dns_configuration(self, request):
+
+        return _json(200, {
+            'nameservers': [{'address': ns} for ns in self.dns['nameservers']],
+            'searchPaths': self.dns['searchPaths'],
+            'splitDNS': {domain: [{'address': ns} for ns in nameservers]
+                         for domain, nameservers in self.dns['splitDNS'].items()},
+            'preferences': self.dns['preferences'],
+        })
+
+
+    def _set_dns_configuration(self, request):
+
+        def addresses(nameservers):
+            return [ns['address'] if isinstance(ns, dict) else ns for ns in nameservers]
+
+        body = request.json()
+        self.dns = {
+            'nameservers': addresses(body.get('nameservers', [])),
+            'searchPaths': list(body.get('searchPaths', [])),
+            'splitDNS': {domain: addresses(ns) for domain, ns in body.get('splitDNS', {}).items() if ns},
+            'preferences': {'magicDNS': False, **body.get('preferences', {})},
+        }
+
+        return self._get_dns_configuration(request)
+
+
+    # ---------------------------------------------------------------------------
+    # Logs and log streaming
+    # ---------------------------------------------------------------------------
+
+    def _get_logs(self, log_type):
+
+        def handler(request):
+            if 'start' not in request.query or 'end' not in request.query:
+                return _json(400, {'message': 'start and end are required'})
+
+            page_key = (log_type, request.query['start'], request.query['end'])
+            if page_key in self._log_pages:
+                return self._log_pages[page_key]
+
+            rng = random.Random(f'{log_type}{request.query["start"]}{request.query["end"]}')
+            devices = list(self.devices.values())[:100] or [{'nodeId': 'n0CNTRL'}]
+            if log_type == 'configuration':
+                logs = [{'eventGroupID': _hex(rng, 64), 'origin': 'ADMIN_CONSOLE',
+                         'actor': {'id': 'u100000CNTRL', 'type': 'USER', 'loginName': f'admin@{self.tailnet}'},
+                         'type': 'UPDATE', 'target': {'id': rng.choice(devices)['nodeId'], 'type': 'NODE'},
+                         'eventTime': _timestamp(rng), 'action': 'UPDATE'} for _ in range(200)]
+            else:
+                logs = [{'logged': _timestamp(rng), 'nodeId': rng.choice(devices)['nodeId'],
+                         'start': _timestamp(rng), 'end': _timestamp(rng),
+                         'virtualTraffic': [{'proto': 6, 'src': f'100.64.0.{rng.randint(1, 254)}:{rng.randint(1024, 65535)}',
+                                             'dst': f'100.64.1.{rng.randint(1, 254)}:443',
+                                             'txPkts': rng.randint(1, 500), 'txBytes': rng.randint(64, 100000),
+                                             'rxPkts': rng.randint(1, 500), 'rxBytes': rng.randint(64, 100000)}
+                                            for _ in range(5)]} for _ in range(200)]
+            self._log_pages[page_key] = _json(200, {'logs': logs})
+            return self._log_pages[page_key]
+
+        return handler
+
+
+    def _get_log_stream(self, request):
+
+        config = self.log_streams.get(request.params['log_type'])
+        if config is None:
+            return _json(404, {'message': 'log streaming not configured'})
+
+        return _json(200, config)
+
+
+    def _set_log_stream(self, request):
+
+        self.log_streams[request.params['log_type']] = {'logType': request.params['log_type'], **request.json()}
+
+        return _json(200, {})
+
+
+    def _delete_log_stream(self, request):
+
+        self.log_streams.pop(request.params['log_type'], None)
+
+        return _json(200, {})
+
+
+    def _get_log_stream_status(self, request):
+
+        return _json(200, {'lastActivity': _timestamp(self._rng), 'lastError': '', 'maxBodySize': 1048576,
+                           'numBytesSent': 123456789, 'numEntriesSent': 654321, 'numSpoofedEntries': 0,
+                           'numFailedRequests': 3, 'numTotalRequests': 4321, 'rate': 12.5})
+
+
+    def _aws_external_id(self, request):
+
+        return _json(200, {'externalId': str(uuid.UUID(int=self._rng.getrandbits(128))),
+                           'tailscaleAwsAccountId': '123456789012'})
+
+
+    # ---------------------------------------------------------------------------
+    # OAuth, settings and contacts
+    # ---------------------------------------------------------------------------
+
+    def _oauth_token(self, request):
+
+        form = {k: v[-1] for k, v in parse_qs(request.body.decode('utf-8')).items()}
+        if not form.get('client_id') or not form.get('client_secret'):
+            return _json(401, {'error': 'invalid_client'})
+
+        token = f'tskey-api-{_hex(self._rng, 48)}-{_hex(self._rng, 128)}'
+        if self._api_keys is not None:
+            self._api_keys.add(token)
+
+        return _json(200, {'access_token': token, 'token_type': 'Bearer', 'expires_in': 3600,
+                           'scope': form.get('scope', 'all')})
+
+
+    def _get_settings(self, request):
+
+        return _json(200, self.settings)
+
+
+    def _update_settings(self, request):
+
+        self.settings.update(request.json())
+
+        return _json(200, self.settings)
+
+
+    def _get_contacts(self, request):
+
+        return _json(200, self.contacts)
+
+
+    def _update_contact(self, request):
+
+        contact = self.contacts.get(request.params['contact_type'])
+        if contact is None:
+            return _json(404, {'message': 'not found'})
+
+        contact['email'] = request.json()['email']
+        contact['needsVerification'] = True
+
+        return _json(200, {})
+
+
+    # ---------------------------------------------------------------------------
+    # Device posture integrations
+    # ---------------------------------------------------------------------------
+
+    def _list_posture_integrations(self, request):
+
+        return _json(200, {'integrations': list(self.posture_integrations.values())})
+
+
+    def _create_posture_integration(self, request):
+
+        body = request.json()
+        integration_id = f'pcn{_hex(self._rng, 48)}'
+        integration = {'id': integration_id, 'provider': body['provider'], 'clientId': body['clientId'],
+                       'cloudId': body.get('cloudId', ''), 'tenantId': body.get('tenantId', ''),
+                       'configUpdated': _timestamp(self._rng), 'status': {'lastSync': '', 'error': '',
+                                                                          'providerHostCount': 0,
+                                                                          'matchedCount': 0,
+                                                                          'possibleMatchedCount': 0}}
+        self.posture_integrations[integration_id] = integration
+
+        return _json(200, integration)
+
+
+    def _get_posture_integration(self, request):
+
+        integration = self.posture_integrations.get(request.params['integration_id'])
+        if integration is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, integration)
+
+
+    def _update_posture_integration(self, request):
+
+        integration = self.posture_integrations.get(request.params['integration_id'])
+        if integration is None:
+            return _json(404, {'message': 'not found'})
+
+        integration.update({k: v for k, v in request.json().items() if k != 'clientSecret'})
+
+        return _json(200, integration)
+
+
+    def _delete_posture_integration(self, request):
+
+        if self.posture_integrations.pop(request.params['integration_id'], None) is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, {})
+
+
+    # ---------------------------------------------------------------------------
+    # Users
+    # ---------------------------------------------------------------------------
+
+    def _list_users(self, request):
+
+        users = [user for user in self.users.values()
+                 if request.query.get('type') in (None, user['type'])
+                 and request.query.get('role') in (None, user['role'])]
+
+        return _json(200, {'users': users})
+
+
+    def _get_user(self, request):
+
+        user = self.users.get(request.params['user_id'])
+        if user is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, user)
+
+
+    def _set_user_role(self, request):
+
+        user = self.users.get(request.params['user_id'])
+        if user is None:
+            return _json(404, {'message': 'not found'})
+
+        user['role'] = request.json()['role']
+
+        return _json(200, {})
+
+
+    def _set_user_status(self, status):
+
+        def handler(request):
+            user = self.users.get(request.params['user_id'])
+            if user is None:
+                return _json(404, {'message': 'not found'})
+            user['status'] = status
+            return _json(200, {})
+
+        return handler
+
+
+    def _delete_user(self, request):
+
+        if self.users.pop(request.params['user_id'], None) is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, {})
+
+
+    # ---------------------------------------------------------------------------
+    # Webhooks
+    # ---------------------------------------------------------------------------
+
+    def _public_webhook(self, webhook):
+
+        return {k: v for k, v in webhook.items() if k != 'secret'}
+
+
+    def _list_webhooks(self, request):
+
+        return _json(200, {'webhooks': [self._public_webhook(w) for w in self.webhooks.values()]})
+
+
+    def _create_webhook(self, request):
+
+        body = request.json()
+        endpoint_id = _hex(self._rng, 48)
+        webhook = {'endpointId': endpoint_id, 'endpointUrl': body['endpointUrl'],
+                   'providerType': body.get('providerType', ''), 'creatorLoginName': f'admin@{self.tailnet}',
+                   'created': _timestamp(self._rng), 'lastModified': _timestamp(self._rng),
+                   'subscriptions': list(body['subscriptions']), 'secret': f'tskey-webhook-{_hex(self._rng, 128)}'}
+        self.webhooks[endpoint_id] = webhook
+
+        return _json(200, webhook)
+
+
+    def _get_webhook(self, request):
+
+        webhook = self.webhooks.get(request.params['endpoint_id'])
+        if webhook is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, self._public_webhook(webhook))
+
+
+    def _update_webhook(self, request):
+
+        webhook = self.webhooks.get(request.params['endpoint_id'])
+        if webhook is None:
+            return _json(404, {'message': 'not found'})
+
+        webhook['subscriptions'] = list(request.json()['subscriptions'])
+
+        return _json(200, self._public_webhook(webhook))
+
+
+    def _delete_webhook(self, request):
+
+        if self.webhooks.pop(request.params['endpoint_id'], None) is None:
+            return _json(404, {'message': 'not found'})
+
+        return _json(200, {})
+
+
+    def _rotate_webhook(self, request):
+
+        webhook = self.webhooks.get(request.params['endpoint_id'])
+        if webhook is None:
+            return _json(404, {'message': 'not found'})
+
+        webhook['secret'] = f'tskey-webhook-{_hex(self._rng, 128)}'
+
+        return _json(200, webhook)
+
+
+    def _test_webhook(self, request):
+
+        webhook = self.webhooks.get(request.params['endpoint_id'])
+        if webhook is None:
+            return _json(404, {'message': 'not found'})
+
+        self._deliver(webhook, [self._event('test', {}, 'This is a test event')])
+
+        return _json(200, {})
+
+
+    def _event(self, event_type, data, message):
+
+        # Microsecond timestamps, like the real API's, so separate events never look like repeats
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+        return {'timestamp': timestamp, 'version': 1,
+                'type': event_type, 'tailnet': self.tailnet, 'message': message, 'data': data}
+
+
+    def _deliver(self, webhook, events):
+        """ POST events to a webhook endpoint, signed with its secret
+
+        :return: The HTTP status, or the exception raised
+
+        """
+
+        import urllib.error
+        import urllib.request
+
+        from tailscale_agent.webhooks import SIGNATURE_HEADER, sign
+
+        body = json.dumps(events).encode('utf-8')
+        request = urllib.request.Request(webhook['endpointUrl'], data=body, method='POST', headers={
+            'Content-Type': 'application/json', SIGNATURE_HEADER: sign(webhook['secret'], body)})
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except OSError as e:
+            return e
+
+
+    def emit(self, event_type, data, message=''):
+        """ Deliver an event to every webhook subscribed to its type
+
+        :param event_type: The event type, e.g. 'nodeCreated'
+        :param data: The event's data dict, e.g. {'nodeID': ..., 'deviceName': ...}
+        :param message: The event's human-readable message
+
+        :return: A dict of endpoint URL to HTTP status (or the exception raised) for each delivery
+
+        """
+
+        event = self._event(event_type, data, message)
+
+        return {webhook['endpointUrl']: self._deliver(webhook, [event])
+                for webhook in list(self.webhooks.values()) if event_type in webhook['subscriptions']}
+
+
+class _Request:
+    """ The parts of an incoming request the route handlers need """
+
+    def __init__(self, method, path, query, headers, body, params):
+
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.params = params
+
+
+    def json(self):
+
+        return json.loads(self.body or b'null')
+
+
+def _json(status, body, headers=None):
+
+    return status, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(body).encode('utf-8')
+
+
+def _throttled(wait):
+
+    return _json(429, {'message': 'rate limit exceeded'}, {'Retry-After': str(max(math.ceil(wait), 1))})
+
+
+class FakeAPIProcess:
+    """ A fake API running in a child process, as started by spawn() """
+
+    def __init__(self, process, base_url, tailnet):
+
+        self.process = process
+        self.base_url = base_url
+        self.tailnet = tailnet
+
+
+    def __repr__(self):
+
+        return f'FakeAPIProcess(pid={self.process.pid}, base_url={self.base_url})'
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+    def stop(self):
+        """ Terminate the child process and wait for it to exit
+
+        """
+
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+def spawn(tailnet='example.com', devices=100, users=20, keys=10, seed=0, port=0, latency=None,
+          error_rate=0.0, rate_limit=None, throttle_burst=None):
+    """ Start the fake API in a separate Python process
+
+        Running the server in its own process keeps its CPU time and memory out of
+        measurements of the client. The arguments are those of FakeTailscaleAPI;
+        latency must be a spec string.
+
+    :return: A FakeAPIProcess with the base_url to connect to. Call stop() (or use it
+        as a context manager) to shut it down
+
+    """
+
+    args = [sys.executable, '-m', 'tailscale_agent.fakeapi', '--tailnet', tailnet, '--devices', str(devices),
+            '--users', str(users), '--keys', str(keys), '--seed', str(seed), '--port', str(port),
+            '--error-rate', str(error_rate)]
+    if latency is not None:
+        args += ['--latency', latency]
+    if rate_limit is not None:
+        args += ['--rate-limit', str(rate_limit)]
+    if throttle_burst is not None:
+        args += ['--throttle-burst', ','.join(str(v) for v in throttle_burst)]
+
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonpath = os.pathsep.join(filter(None, [package_root, os.environ.get('PYTHONPATH')]))
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, text=True, env={**os.environ, 'PYTHONPATH': pythonpath})
+
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        process.wait()
+        process.stdout.close()
+        raise RuntimeError(f'the fake API exited with status {process.returncode} before serving')
+
+    return FakeAPIProcess(process, base_url, tailnet)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a fake Tailscale API on localhost.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='port to listen on (default: a free port)')
+    parser.add_argument('--tailnet', default='example.com')
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--keys', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', help="added latency, e.g. 'fixed:20' or 'lognormal:40,0.5' (ms)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failed with 5xx')
+    parser.add_argument('--rate-limit', type=float, help='requests per second before answering 429')
+    parser.add_argument('--throttle-burst', metavar='EVERY,DURATION',
+                        help='answer every request with 429 for DURATION seconds out of every EVERY seconds')
+    args = parser.parse_args(argv)
+
+    throttle_burst = tuple(float(v) for v in args.throttle_burst.split(',')) if args.throttle_burst else None
+
+    api = FakeTailscaleAPI(tailnet=args.tailnet, devices=args.devices, users=args.users, keys=args.keys,
+                           seed=args.seed, host=args.host, port=args.port, latency=args.latency,
+                           error_rate=args.error_rate, rate_limit=args.rate_limit, throttle_burst=throttle_burst)
+    api.start()
+    # The first line of output tells a parent process where to connect
+    print(api.base_url, flush=True)
+    try:
+        api._thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
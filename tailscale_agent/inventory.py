@@ -0,0 +1,774 @@
+"""
+A local copy of a tailnet's devices and users, kept current by webhook events.
+
+Instead of polling get_devices() to notice changes, load the inventory once and
+pass it webhook events. Each event about a device refetches only that device with
+get_device(), and each event about a user refetches only that user:
+
+    inventory = Inventory(client).load()
+    receiver = WebhookReceiver(secret, inventory.handle)   # tailscale_agent.webhooks
+    receiver.start()
+
+    inventory.device('n1234CNTRL')          # by nodeId or id, served locally
+    inventory.user('alice@example.com')     # by loginName or id
+
+Webhooks are delivered at least once but can still be missed (for example while the
+receiver is down), so call load() again occasionally, or after a restart, to resynchronise.
+
+A UserDirectory answers questions about users (who are the admins, who is suspended)
+from indexes built once, filling in details missing from the user list with concurrent
+get_user() calls:
+
+    directory = UserDirectory(client).load()
+    directory.find(role='admin', status='active')
+
+A KeyIndex does the same for auth keys, keeping them ordered by expiry:
+
+    keys = KeyIndex(client).load()
+    keys.expiring_within(72 * 3600)
+"""
+
+import bisect
+import threading
+import time
+
+from datetime import datetime
+
+
+# Device events after which the device is fetched again
+DEVICE_EVENTS = frozenset((
+    'nodeCreated', 'nodeNeedsApproval', 'nodeApproved', 'nodeKeyExpiringInOneDay', 'nodeKeyExpired',
+    'nodeNeedsSignature', 'nodeSigned',
+))
+
+# User events after which the user is fetched again
+USER_EVENTS = frozenset((
+    'userCreated', 'userNeedsApproval', 'userApproved', 'userSuspended', 'userRestored', 'userRoleUpdated',
+))
+
+DEVICE_DELETED = 'nodeDeleted'
+USER_DELETED = 'userDeleted'
+
+
+class Inventory:
+    """ Devices and users of a tailnet, held in memory and updated from webhook events """
+
+    def __init__(self, client):
+        """ Constructor for the Inventory class
+
+        :param client: The Tailscale client used to load and refetch devices and users
+
+        """
+
+        self._client = client
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._device_keys = {}
+        self._users = {}
+        self._user_keys = {}
+        # Devices and users whose refetch failed, fetched again with the next batch of events
+        self._stale_devices = set()
+        self._stale_users = set()
+        self.counters = dict.fromkeys(('device_fetches', 'user_fetches', 'removals', 'full_loads', 'ignored',
+                                       'fetch_failures'), 0)
+
+
+    def __repr__(self):
+
+        return f'Inventory(devices={len(self._devices)}, users={len(self._users)})'
+
+
+    # ---------------------------------------------------------------------------
+    # Loading
+    # ---------------------------------------------------------------------------
+
+    def load(self):
+        """ Replace the inventory with full device and user lists from the API
+
+        :return: The inventory
+
+        """
+
+        self._load_devices()
+        self._load_users()
+
+        return self
+
+
+    def _load_devices(self):
+
+        response = self._client.get_devices()
+        response.raise_for_status()
+        devices = response.json()['devices']
+
+        with self._lock:
+            self._devices = {device['nodeId']: device for device in devices}
+            self._device_keys = {device['id']: device['nodeId'] for device in devices}
+            self._stale_devices.clear()
+            self.counters['full_loads'] += 1
+
+
+    def _load_users(self):
+
+        response = self._client.get_users()
+        response.raise_for_status()
+        users = response.json()['users']
+
+        with self._lock:
+            self._users = {user['id']: user for user in users}
+            self._user_keys = {user['loginName']: user['id'] for user in users}
+            self._stale_users.clear()
+            self.counters['full_loads'] += 1
+
+
+    # ---------------------------------------------------------------------------
+    # Lookups
+    # ---------------------------------------------------------------------------
+
+    def device(self, device_id):
+        """ Get a device by nodeId or id
+
+        :return: The device dict, or None if it is not in the inventory
+
+        """
+
+        with self._lock:
+            return self._devices.get(self._device_keys.get(device_id, device_id))
+
+
+    def devices(self):
+        """ List every device in the inventory
+
+        :return: A list of device dicts
+
+        """
+
+        with self._lock:
+            return list(self._devices.values())
+
+
+    def user(self, user_id):
+        """ Get a user by id or loginName
+
+        :return: The user dict, or None if it is not in the inventory
+
+        """
+
+        with self._lock:
+            return self._users.get(self._user_keys.get(user_id, user_id))
+
+
+    def users(self):
+        """ List every user in the inventory
+
+        :return: A list of user dicts
+
+        """
+
+        with self._lock:
+            return list(self._users.values())
+
+
+    # ---------------------------------------------------------------------------
+    # Updates
+    # ---------------------------------------------------------------------------
+
+    def handle(self, events):
+        """ Apply a batch of webhook events (usable as a WebhookReceiver handler)
+
+            Each device or user named in the batch is fetched at most once, after the
+            last event about it, however many events mention it. A fetch that fails
+            does not stop the rest of the batch: it is counted in
+            counters['fetch_failures'] and tried again with the next batch, or
+            dropped by the next load().
+
+        :param events: A list of webhook event dicts
+
+        """
+
+        with self._lock:
+            devices = dict.fromkeys(self._stale_devices, None)
+            users = dict.fromkeys(self._stale_users, None)
+            self._stale_devices.clear()
+            self._stale_users.clear()
+
+        for event in events:
+            event_type = event.get('type')
+            data = event.get('data') or {}
+            if event_type in DEVICE_EVENTS or event_type == DEVICE_DELETED:
+                devices[data.get('nodeID')] = event_type
+            elif event_type in USER_EVENTS or event_type == USER_DELETED:
+                users[data.get('user')] = event_type
+            else:
+                self._count('ignored')
+
+        for node_id, event_type in devices.items():
+            if not node_id:
+                continue
+            if event_type == DEVICE_DELETED:
+                self.remove_device(node_id)
+            else:
+                self._refetch(self.fetch_device, node_id, self._stale_devices)
+
+        for login_name, event_type in users.items():
+            if not login_name:
+                continue
+            if event_type == USER_DELETED:
+                self.remove_user(login_name)
+            else:
+                self._refetch(self.fetch_user, login_name, self._stale_users)
+
+
+    def _refetch(self, fetch, key, stale):
+
+        try:
+            fetch(key)
+        except Exception:
+            with self._lock:
+                stale.add(key)
+                self.counters['fetch_failures'] += 1
+
+
+    def apply(self, event):
+        """ Apply a single webhook event
+
+        :param event: A webhook event dict
+
+        """
+
+        self.handle([event])
+
+
+    def fetch_device(self, device_id):
+        """ Fetch one device from the API and store it, or drop it if the API no longer has it
+
+        :param device_id: The device's nodeId or id
+
+        :return: The device dict, or None if it no longer exists
+
+        """
+
+        response = self._client.get_device(device_id)
+        self._count('device_fetches')
+        if response.status_code == 404:
+            self.remove_device(device_id)
+            return None
+        response.raise_for_status()
+        device = response.json()
+
+        with self._lock:
+            self._devices[device['nodeId']] = device
+            self._device_keys[device['id']] = device['nodeId']
+
+        return device
+
+
+    def remove_device(self, device_id):
+        """ Drop a device from the inventory
+
+        :param device_id: The device's nodeId or id
+
+        """
+
+        with self._lock:
+            device = self._devices.pop(self._device_keys.get(device_id, device_id), None)
+            if device is not None:
+                self._device_keys.pop(device['id'], None)
+                self.counters['removals'] += 1
+
+
+    def fetch_user(self, user_id):
+        """ Fetch one user from the API and store it, or drop it if the API no longer has it
+
+            Webhook events name users by loginName. A user not yet in the inventory
+            has no known id, so the user list is fetched again instead.
+
+        :param user_id: The user's id or loginName
+
+        :return: The user dict, or None if it does not exist
+
+        """
+
+        with self._lock:
+            known_id = self._user_keys.get(user_id, user_id if user_id in self._users else None)
+        if known_id is None:
+            self._load_users()
+            self._count('user_fetches')
+            return self.user(user_id)
+
+        response = self._client.get_user(known_id)
+        self._count('user_fetches')
+        if response.status_code == 404:
+            self.remove_user(known_id)
+            return None
+        response.raise_for_status()
+        user = response.json()
+
+        with self._lock:
+            self._users[user['id']] = user
+            self._user_keys[user['loginName']] = user['id']
+
+        return user
+
+
+    def remove_user(self, user_id):
+        """ Drop a user from the inventory
+
+        :param user_id: The user's id or loginName
+
+        """
+
+        with self._lock:
+            user = self._users.pop(self._user_keys.get(user_id, user_id), None)
+            if user is not None:
+                self._user_keys.pop(user['loginName'], None)
+                self.counters['removals'] += 1
+
+
+    def _count(self, name):
+
+        with self._lock:
+            self.counters[name] += 1
+
+
+class UserDirectory:
+    """ Users of a tailnet indexed by id, loginName, role, status and type """
+
+    # Fields the indexes need; a listed user without them is fetched with get_user()
+    DETAIL_FIELDS = ('role', 'status', 'type')
+
+    def __init__(self, client, max_workers=8):
+        """ Constructor for the UserDirectory class
+
+        :param client: The Tailscale client used to list and fetch users
+        :param max_workers: Maximum number of get_user() calls to run at once
+
+        """
+
+        self._client = client
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._listed = {}
+        self._users = {}
+        self._logins = {}
+        self._indexes = {field: {} for field in self.DETAIL_FIELDS}
+        self.counters = dict.fromkeys(('lists', 'hydrations', 'failures'), 0)
+
+
+    def __repr__(self):
+
+        return f'UserDirectory(users={len(self._users)})'
+
+
+    def __len__(self):
+
+        return len(self._users)
+
+
+    def __iter__(self):
+
+        return iter(self.users())
+
+
+    def load(self):
+        """ Load every user, fetching details the list lacks
+
+        :return: The directory
+
+        """
+
+        self.refresh(rehydrate=True)
+
+        return self
+
+
+    def refresh(self, rehydrate=False):
+        """ List the users again and apply only what changed
+
+            A user whose list entry is unchanged keeps the details fetched for it
+            before; new and changed users are fetched again if the list lacks details.
+
+        :param rehydrate: Fetch the details of every user that lacks them, changed or not
+
+        :return: A dict with the 'added', 'removed' and 'changed' user ids
+
+        """
+
+        response = self._client.get_users()
+        response.raise_for_status()
+        listed = {user['id']: user for user in response.json()['users']}
+
+        with self._lock:
+            previous = self._listed
+            self.counters['lists'] += 1
+        added = [user_id for user_id in listed if user_id not in previous]
+        removed = [user_id for user_id in previous if user_id not in listed]
+        changed = [user_id for user_id in listed if user_id in previous and listed[user_id] != previous[user_id]]
+        stale = set(listed) if rehydrate else set(added) | set(changed)
+
+        # Unchanged users keep their hydrated records; the rest start from their list entry
+        records = {}
+        with self._lock:
+            for user_id, entry in listed.items():
+                records[user_id] = self._users.get(user_id, entry) if user_id not in stale else entry
+        records.update(self._hydrate([records[user_id] for user_id in stale
+                                      if any(field not in records[user_id] for field in self.DETAIL_FIELDS)]))
+
+        with self._lock:
+            self._listed = listed
+            for user_id in removed:
+                self._unindex(self._users.pop(user_id))
+            for user_id in stale:
+                if user_id in self._users:
+                    self._unindex(self._users[user_id])
+                self._users[user_id] = records[user_id]
+                self._index(records[user_id])
+
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+
+    def _hydrate(self, users):
+        """ Fetch the full records of users concurrently
+
+        :return: A dict of user id to record; users that could not be fetched keep their list entry
+
+        """
+
+        if not users:
+            return {}
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(user):
+            try:
+                response = self._client.get_user(user['id'])
+            except Exception:
+                return None
+            return {**user, **response.json()} if response.status_code == 200 else None
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            records = list(executor.map(fetch, users))
+
+        with self._lock:
+            self.counters['hydrations'] += len(users)
+            self.counters['failures'] += records.count(None)
+
+        return {user['id']: record if record is not None else user for user, record in zip(users, records)}
+
+
+    def _index(self, user):
+
+        self._logins[user.get('loginName')] = user['id']
+        for field, index in self._indexes.items():
+            index.setdefault(user.get(field), set()).add(user['id'])
+
+
+    def _unindex(self, user):
+
+        if self._logins.get(user.get('loginName')) == user['id']:
+            del self._logins[user.get('loginName')]
+        for field, index in self._indexes.items():
+            ids = index.get(user.get(field))
+            if ids is not None:
+                ids.discard(user['id'])
+                if not ids:
+                    del index[user.get(field)]
+
+
+    def get(self, user_id):
+        """ Get a user by id or loginName
+
+        :return: The user dict, or None if there is no such user
+
+        """
+
+        with self._lock:
+            return self._users.get(self._logins.get(user_id, user_id))
+
+
+    def users(self):
+        """ List every user in the directory
+
+        :return: A list of user dicts
+
+        """
+
+        with self._lock:
+            return list(self._users.values())
+
+
+    def find(self, role=None, status=None, type=None):
+        """ Find users matching every given field
+
+        :param role: Optional role, e.g. 'admin'
+        :param status: Optional status, e.g. 'active' or 'suspended'
+        :param type: Optional type, 'member' or 'shared'
+
+        :return: A list of matching user dicts
+
+        """
+
+        wanted = {'role': role, 'status': status, 'type': type}
+        with self._lock:
+            matches = None
+            for field, value in wanted.items():
+                if value is None:
+                    continue
+                ids = self._indexes[field].get(value, set())
+                matches = set(ids) if matches is None else matches & ids
+            if matches is None:
+                return list(self._users.values())
+
+            return [self._users[user_id] for user_id in sorted(matches)]
+
+
+    def count_by(self, field):
+        """ Count users by the value of one indexed field
+
+        :param field: 'role', 'status' or 'type'
+
+        :return: A dict of field value to number of users
+
+        """
+
+        with self._lock:
+            return {value: len(ids) for value, ids in self._indexes[field].items()}
+
+
+def _expiry(key):
+
+    try:
+        return datetime.fromisoformat(key['expires']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class KeyIndex:
+    """ Auth keys of a tailnet ordered by expiry and indexed by creator """
+
+    def __init__(self, client, max_workers=8):
+        """ Constructor for the KeyIndex class
+
+        :param client: The Tailscale client used to list and fetch keys
+        :param max_workers: Maximum number of get_key() calls to run at once
+
+        """
+
+        self._client = client
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._listed = {}
+        self._keys = {}
+        self._expiry = []
+        self._creators = {}
+        self.counters = dict.fromkeys(('lists', 'hydrations', 'failures'), 0)
+
+
+    def __repr__(self):
+
+        return f'KeyIndex(keys={len(self._keys)})'
+
+
+    def __len__(self):
+
+        return len(self._keys)
+
+
+    def __iter__(self):
+
+        return iter(self.keys())
+
+
+    def load(self):
+        """ Load every key with its details
+
+        :return: The index
+
+        """
+
+        self.refresh(rehydrate=True)
+
+        return self
+
+
+    def refresh(self, rehydrate=False):
+        """ List the keys again and fetch only the ones that are new or changed
+
+            Key details do not change once a key is created, so an unchanged key keeps
+            the details fetched for it before. Keys that are revoked or deleted drop out
+            of the list and out of the index.
+
+        :param rehydrate: Fetch every key again, changed or not
+
+        :return: A dict with the 'added', 'removed' and 'changed' key ids
+
+        """
+
+        response = self._client.get_authorization_keys()
+        response.raise_for_status()
+        listed = {key['id']: key for key in response.json()['keys']}
+
+        with self._lock:
+            previous = self._listed
+            self.counters['lists'] += 1
+        added = [key_id for key_id in listed if key_id not in previous]
+        removed = [key_id for key_id in previous if key_id not in listed]
+        changed = [key_id for key_id in listed if key_id in previous and listed[key_id] != previous[key_id]]
+        stale = list(listed) if rehydrate else added + changed
+        hydrated = self._hydrate(stale)
+
+        with self._lock:
+            self._listed = listed
+            for key_id in removed:
+                self._unindex(self._keys.pop(key_id, None))
+            for key_id in stale:
+                # A key that could not be fetched keeps its list entry, or its last known details
+                record = hydrated.get(key_id) or self._keys.get(key_id) or {**listed[key_id]}
+                self._unindex(self._keys.get(key_id))
+                self._keys[key_id] = record
+                self._index(record)
+
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+
+    def _hydrate(self, key_ids):
+        """ Fetch the details of keys concurrently
+
+        :return: A dict of key id to key; keys that could not be fetched are left out
+
+        """
+
+        if not key_ids:
+            return {}
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(key_id):
+            try:
+                response = self._client.get_key(key_id)
+            except Exception:
+                return None
+            return response.json() if response.status_code == 200 else None
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            hydrated = {key_id: key for key_id, key in zip(key_ids, executor.map(fetch, key_ids)) if key is not None}
+
+        with self._lock:
+            self.counters['hydrations'] += len(key_ids)
+            self.counters['failures'] += len(key_ids) - len(hydrated)
+
+        return hydrated
+
+
+    def _index(self, key):
+
+        expires = _expiry(key)
+        if expires is not None:
+            bisect.insort(self._expiry, (expires, key['id']))
+        self._creators.setdefault(key.get('userId'), set()).add(key['id'])
+
+
+    def _unindex(self, key):
+
+        if key is None:
+            return
+        expires = _expiry(key)
+        if expires is not None:
+            i = bisect.bisect_left(self._expiry, (expires, key['id']))
+            if i < len(self._expiry) and self._expiry[i] == (expires, key['id']):
+                del self._expiry[i]
+        ids = self._creators.get(key.get('userId'))
+        if ids is not None:
+            ids.discard(key['id'])
+            if not ids:
+                del self._creators[key.get('userId')]
+
+
+    def get(self, key_id):
+        """ Get a key by id
+
+        :return: The key dict, or None if there is no such key
+
+        """
+
+        with self._lock:
+            return self._keys.get(key_id)
+
+
+    def keys(self):
+        """ List every key in the index
+
+        :return: A list of key dicts
+
+        """
+
+        with self._lock:
+            return list(self._keys.values())
+
+
+    def expiring_between(self, start, end):
+        """ Find the keys that expire in a time range
+
+        :param start: Start of the range, in seconds since the epoch (inclusive)
+        :param end: End of the range, in seconds since the epoch (exclusive)
+
+        :return: A list of key dicts, soonest to expire first
+
+        """
+
+        with self._lock:
+            first = bisect.bisect_left(self._expiry, (start,))
+            last = bisect.bisect_left(self._expiry, (end,))
+
+            return [self._keys[key_id] for _, key_id in self._expiry[first:last]]
+
+
+    def expiring_within(self, seconds, now=None):
+        """ Find the keys that have not expired yet but will within a number of seconds
+
+        :param seconds: Length of the window, e.g. 72 * 3600
+        :param now: Optional current time in seconds since the epoch (default: time.time())
+
+        :return: A list of key dicts, soonest to expire first
+
+        """
+
+        now = time.time() if now is None else now
+
+        return self.expiring_between(now, now + seconds)
+
+
+    def expired(self, now=None):
+        """ Find the keys that have already expired
+
+        :param now: Optional current time in seconds since the epoch (default: time.time())
+
+        :return: A list of key dicts, longest expired first
+
+        """
+
+        return self.expiring_between(float('-inf'), time.time() if now is None else now)
+
+
+    def by_creator(self, user_id):
+        """ Find the keys created by a user
+
+        :param user_id: The creator's user id
+
+        :return: A list of key dicts, sorted by id
+
+        """
+
+        with self._lock:
+            return [self._keys[key_id] for key_id in sorted(self._creators.get(user_id, ()))]
+
+
+    def count_by_creator(self):
+        """ Count keys by creator
+
+        :return: A dict of user id to number of keys
+
+        """
+
+        with self._lock:
+            return {user_id: len(ids) for user_id, ids in self._creators.items()}
@@ -0,0 +1,309 @@
+"""
+A durable write-behind queue for device and user writes.
+
+A WriteJournal records each write in a local SQLite file and returns at once, while
+background workers send the writes through the client, under its rate limiter and
+retries. If the process dies, the writes not yet confirmed are still in the file and
+are sent when the journal is opened again:
+
+    with WriteJournal(client, 'writes.db') as journal:
+        journal.submit('authorize_device', device_id)
+        journal.submit('update_device_tags', device_id, ['tag:web'])
+        journal.wait()          # optional: block until everything is written
+
+Only writes that set state (rather than create something) can be journaled, so
+sending one twice, as can happen when the process dies between sending a write and
+recording that it succeeded, has the same effect as sending it once. Writes about the
+same device or user are sent in the order they were submitted.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+
+# Client methods that are safe to send again: each sets state to a given value. expire_device_key
+# is left out: replayed after the device has reauthenticated, it would expire the new key too
+IDEMPOTENT_METHODS = frozenset((
+    'authorize_device', 'delete_device', 'set_device_name', 'update_device_key',
+    'set_device_ipv4', 'update_device_tags', 'set_device_routes', 'set_device_posture_attribute',
+    'delete_device_posture_attribute', 'batch_update_device_posture_attributes',
+    'update_user_role', 'approve_user', 'suspend_user', 'restore_user', 'delete_user',
+))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    method TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    status INTEGER,
+    error TEXT
+)
+'''
+
+
+class WriteJournal:
+    """ Writes recorded in a SQLite file and sent in the background, surviving restarts """
+
+    def __init__(self, client, path, workers=2, max_attempts=5, retry_delay=1.0, clock=time.time):
+        """ Constructor for the WriteJournal class
+
+            Writes left pending by an earlier run are sent once the journal is started.
+
+        :param client: The Tailscale client used to send the writes
+        :param path: The SQLite file to keep the journal in
+        :param workers: Number of writes sent at once
+        :param max_attempts: Attempts before a write that keeps failing with a 429, a server
+            error or an exception is marked failed
+        :param retry_delay: Seconds before the first retry; each retry waits twice as long
+        :param clock: Function returning the current time in seconds since the epoch
+
+        """
+
+        self._client = client
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._clock = clock
+        self._path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(_SCHEMA)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._in_flight = set()
+        self._threads = []
+        self._running = False
+        self.counters = dict.fromkeys(('submitted', 'written', 'retried', 'failed'), 0)
+
+
+    def __repr__(self):
+
+        return f'WriteJournal(path={str(self._path)!r})'
+
+
+    def __enter__(self):
+
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+    # ---------------------------------------------------------------------------
+    # Submitting
+    # ---------------------------------------------------------------------------
+
+    def submit(self, method, *args, **kwargs):
+        """ Record a write to send in the background, and return without waiting for it
+
+            The write is on disk when submit() returns.
+
+        :param method: Name of the client method, e.g. 'update_device_tags'; see IDEMPOTENT_METHODS
+        :param args: Positional arguments for the method; they must be JSON-serialisable
+        :param kwargs: Keyword arguments for the method
+
+        :return: The id of the journal entry
+
+        """
+
+        if method not in IDEMPOTENT_METHODS:
+            raise ValueError(f'{method!r} cannot be journaled; it is not a write that is safe to repeat')
+
+        # Writes about the same device or user share a key, and are sent one at a time in order
+        key = str(args[0]) if args and method != 'batch_update_device_posture_attributes' else ''
+        row = (method, json.dumps(args), json.dumps(kwargs), key, self._clock())
+
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO writes (method, args, kwargs, key, submitted) '
+                                      'VALUES (?, ?, ?, ?, ?)', row)
+            self.counters['submitted'] += 1
+            self._changed.notify_all()
+
+        return cursor.lastrowid
+
+
+    def pending(self):
+        """ Number of writes not yet sent successfully or given up on """
+
+        with self._lock:
+            return self._count_pending()
+
+
+    def failures(self):
+        """ List the writes that were given up on
+
+        :return: A list of dicts with the id, method, args, kwargs, attempts, status and error of each
+
+        """
+
+        with self._lock:
+            rows = self._db.execute("SELECT id, method, args, kwargs, attempts, status, error FROM writes "
+                                    "WHERE state = 'failed' ORDER BY id").fetchall()
+
+        return [{'id': row[0], 'method': row[1], 'args': json.loads(row[2]), 'kwargs': json.loads(row[3]),
+                 'attempts': row[4], 'status': row[5], 'error': row[6]} for row in rows]
+
+
+    def discard_failures(self):
+        """ Delete the writes that were given up on
+
+        :return: The number of writes deleted
+
+        """
+
+        with self._lock:
+            return self._db.execute("DELETE FROM writes WHERE state = 'failed'").rowcount
+
+
+    # ---------------------------------------------------------------------------
+    # Sending
+    # ---------------------------------------------------------------------------
+
+    def start(self):
+        """ Start the workers that send the journaled writes
+
+        :return: The journal
+
+        """
+
+        with self._lock:
+            if self._running:
+                return self
+            self._running = True
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, name=f'tailscale-journal-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return self
+
+
+    def wait(self, timeout=None):
+        """ Block until every pending write has been sent or given up on
+
+        :param timeout: Optional most seconds to wait
+
+        :return: True if nothing is pending, False if the timeout passed first
+
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._count_pending():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+
+        return True
+
+
+    def close(self, drain=True, timeout=None):
+        """ Stop the workers and close the journal file
+
+            Writes still pending stay in the file and are sent the next time it is opened.
+
+        :param drain: Whether to wait for the pending writes first
+        :param timeout: Optional most seconds to wait for them
+
+        """
+
+        if drain and self._running:
+            self.wait(timeout)
+
+        with self._lock:
+            self._running = False
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        with self._lock:
+            self._db.close()
+
+
+    def _count_pending(self):
+
+        return self._db.execute("SELECT COUNT(*) FROM writes WHERE state = 'pending'").fetchone()[0]
+
+
+    def _claim(self):
+        """ Take the oldest write that is due and whose device or user has no earlier write outstanding
+
+        :return: A (id, method, args, kwargs, key, attempts) row, and the seconds until the next write is due
+
+        """
+
+        now = self._clock()
+        blocked = set(self._in_flight)
+        next_due = None
+        for row in self._db.execute("SELECT id, method, args, kwargs, key, attempts, next_attempt FROM writes "
+                                    "WHERE state = 'pending' ORDER BY id"):
+            key, due = row[4], row[6]
+            if key in blocked:
+                continue
+            blocked.add(key)
+            if due <= now:
+                self._in_flight.add(key)
+                return row[:6], None
+            next_due = due if next_due is None else min(next_due, due)
+
+        return None, None if next_due is None else next_due - now
+
+
+    def _work(self):
+
+        while True:
+            with self._lock:
+                while True:
+                    if not self._running:
+                        return
+                    row, wait = self._claim()
+                    if row is not None:
+                        break
+                    self._changed.wait(wait)
+
+            entry_id, method, args, kwargs, key, attempts = row
+            try:
+                response, error = getattr(self._client, method)(*json.loads(args), **json.loads(kwargs)), None
+            except Exception as e:
+                response, error = None, e
+
+            with self._lock:
+                self._in_flight.discard(key)
+                self._record(entry_id, method, attempts + 1, response, error)
+                self._changed.notify_all()
+
+
+    def _record(self, entry_id, method, attempts, response, error):
+        """ Store the outcome of one attempt: delete a write that succeeded, retry or fail the rest """
+
+        status = response.status_code if response is not None else None
+        if status is not None and (200 <= status < 300 or (status == 404 and method.startswith('delete_'))):
+            # Already gone counts as deleted, which is what a replayed delete sees
+            self._db.execute('DELETE FROM writes WHERE id = ?', (entry_id,))
+            self.counters['written'] += 1
+            return
+
+        retryable = status is None or status == 429 or status >= 500
+        detail = repr(error) if error is not None else response.text[:500]
+        if retryable and attempts < self._max_attempts:
+            next_attempt = self._clock() + self._retry_delay * 2 ** (attempts - 1)
+            self._db.execute('UPDATE writes SET attempts = ?, next_attempt = ?, status = ?, error = ? WHERE id = ?',
+                             (attempts, next_attempt, status, detail, entry_id))
+            self.counters['retried'] += 1
+        else:
+            self._db.execute("UPDATE writes SET state = 'failed', attempts = ?, status = ?, error = ? WHERE id = ?",
+                             (attempts, status, detail, entry_id))
+            self.counters['failed'] += 1
@@ -0,0 +1,314 @@
+"""
+Auth keys created ahead of time, so provisioning a device does not wait on the API.
+
+An AuthKeyPool keeps a few ready keys for each capability profile. A background
+thread tops the pool up after keys are taken, and deletes unused keys shortly before
+they expire so the pool never hands out a key that is about to stop working:
+
+    pool = AuthKeyPool(client, size=5, expiry_seconds=3600)
+    pool.add_profile('web', tags=['tag:web'], ephemeral=True)
+    pool.start()
+
+    key = pool.take('web')['key']      # no API call while the pool has keys
+
+    pool.stop()                        # deletes the keys nobody took
+
+When a profile runs dry, take() creates a key on the spot, as calling
+create_authorization_key() directly would.
+"""
+
+import threading
+import time
+import warnings
+
+from collections import deque, namedtuple
+
+
+# A ready key: the create_authorization_key() response, and the clock reading at which the pool retires it
+PooledKey = namedtuple('PooledKey', ['key', 'retire_at'])
+
+
+class AuthKeyPool:
+    """ Ready-made auth keys per capability profile, refilled and retired in the background """
+
+    def __init__(self, client, size=5, expiry_seconds=3600, retire_margin=300, refill_interval=5.0,
+                 max_workers=4, clock=time.monotonic):
+        """ Constructor for the AuthKeyPool class
+
+        :param client: The Tailscale client used to create and delete keys
+        :param size: Number of ready keys kept for each profile, unless the profile sets its own
+        :param expiry_seconds: Lifetime of each key created
+        :param retire_margin: How many seconds before expiry an unused key is deleted
+        :param refill_interval: Most seconds between checks for expiring keys and failed refills
+        :param max_workers: Maximum number of keys created at once while refilling
+        :param clock: Function returning the current time in seconds
+
+        """
+
+        if retire_margin >= expiry_seconds:
+            raise ValueError('retire_margin must be shorter than expiry_seconds')
+
+        self._client = client
+        self._size = size
+        self._expiry_seconds = expiry_seconds
+        self._retire_margin = retire_margin
+        self._refill_interval = refill_interval
+        self._max_workers = max_workers
+        self._clock = clock
+        self._profiles = {}
+        self._ready = {}
+        self._expiring = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._running = False
+        self.counters = dict.fromkeys(('hits', 'misses', 'created', 'retired', 'failures'), 0)
+
+
+    def __repr__(self):
+
+        with self._lock:
+            ready = {name: len(keys) for name, keys in self._ready.items()}
+
+        return f'AuthKeyPool(ready={ready})'
+
+
+    def __enter__(self):
+
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+    # ---------------------------------------------------------------------------
+    # Profiles
+    # ---------------------------------------------------------------------------
+
+    def add_profile(self, name, tags=None, ephemeral=False, preauthorized=True, reusable=False, size=None):
+        """ Declare a kind of key to keep ready
+
+        :param name: Name used to take keys of this profile
+        :param tags: Optional list of tags applied to devices using the key
+        :param ephemeral: Whether devices using the key are ephemeral
+        :param preauthorized: Whether devices using the key are authorized without approval
+        :param reusable: Whether the key can register more than one device
+        :param size: Number of ready keys to keep (default: the pool's size)
+
+        :return: The pool
+
+        """
+
+        create = {'reusable': reusable, 'ephemeral': ephemeral, 'preauthorized': preauthorized}
+        if tags:
+            create['tags'] = list(tags)
+
+        with self._lock:
+            self._profiles[name] = ({'devices': {'create': create}}, self._size if size is None else size)
+            self._ready.setdefault(name, deque())
+            self._wakeup.notify_all()
+
+        return self
+
+
+    def ready(self, name):
+        """ Number of keys ready for a profile """
+
+        with self._lock:
+            return len(self._ready[name])
+
+
+    # ---------------------------------------------------------------------------
+    # Taking keys
+    # ---------------------------------------------------------------------------
+
+    def take(self, name):
+        """ Hand out a key of a profile, creating one on the spot if none is ready
+
+            Keys are handed out oldest first, so each is used well before it is retired.
+            A key is only ever handed out once.
+
+        :param name: The profile name
+
+        :return: The key dict from create_authorization_key(), with the secret in 'key'
+
+        """
+
+        with self._lock:
+            if name not in self._profiles:
+                raise KeyError(name)
+            keys = self._ready[name]
+            now = self._clock()
+            while keys and keys[0].retire_at <= now:
+                # Too close to expiring to hand out; the refill thread deletes it
+                self._expiring.append(keys.popleft().key)
+            self._wakeup.notify_all()
+            if keys:
+                self.counters['hits'] += 1
+                return keys.popleft().key
+            self.counters['misses'] += 1
+            capabilities = self._profiles[name][0]
+
+        response = self._create(name, capabilities)
+        response.raise_for_status()
+
+        return response.json()
+
+
+    # ---------------------------------------------------------------------------
+    # Refilling and retiring
+    # ---------------------------------------------------------------------------
+
+    def start(self):
+        """ Start the background thread that keeps the pool full
+
+        :return: The pool
+
+        """
+
+        with self._lock:
+            if self._thread is not None:
+                return self
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='tailscale-keypool', daemon=True)
+        self._thread.start()
+
+        return self
+
+
+    def stop(self, revoke=True):
+        """ Stop refilling the pool
+
+        :param revoke: Whether to delete the keys still in the pool, so none is left usable
+
+        """
+
+        with self._lock:
+            self._running = False
+            self._wakeup.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+        if revoke:
+            with self._lock:
+                unused = [pooled.key for keys in self._ready.values() for pooled in keys] + self._expiring
+                self._expiring = []
+                for keys in self._ready.values():
+                    keys.clear()
+            self._delete(unused)
+
+
+    def _run(self):
+
+        while True:
+            with self._lock:
+                if not self._running:
+                    return
+            self.retire()
+            failed = self.refill()
+
+            with self._lock:
+                if not self._running:
+                    return
+                if failed:
+                    # Back off after a failure rather than retrying in a tight loop
+                    self._wakeup.wait(self._refill_interval)
+                elif not self._deficit() and not self._expiring:
+                    # Sleep until the next key is due to be retired, or a key is taken
+                    timeout = self._refill_interval
+                    retire_at = [keys[0].retire_at for keys in self._ready.values() if keys]
+                    if retire_at:
+                        timeout = max(0.0, min(timeout, min(retire_at) - self._clock()))
+                    self._wakeup.wait(timeout)
+
+
+    def _deficit(self):
+
+        return {name: size - len(self._ready[name]) for name, (_, size) in self._profiles.items()
+                if len(self._ready[name]) < size}
+
+
+    def refill(self):
+        """ Create keys until every profile has its full number ready
+
+        :return: The number of keys that could not be created
+
+        """
+
+        with self._lock:
+            wanted = [(name, self._profiles[name][0]) for name, missing in self._deficit().items()
+                      for _ in range(missing)]
+        if not wanted:
+            return 0
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def create(item):
+            name, capabilities = item
+            try:
+                response = self._create(name, capabilities)
+            except Exception as e:
+                return name, None, e
+            if response.status_code != 200:
+                return name, None, response.status_code
+            return name, response.json(), None
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            for name, key, error in executor.map(create, wanted):
+                with self._lock:
+                    if key is None:
+                        failed += 1
+                        self.counters['failures'] += 1
+                        continue
+                    self._ready[name].append(PooledKey(key, self._clock() + self._expiry_seconds
+                                                       - self._retire_margin))
+        if failed:
+            warnings.warn(f'AuthKeyPool could not create {failed} of {len(wanted)} keys', RuntimeWarning)
+
+        return failed
+
+
+    def retire(self):
+        """ Delete the ready keys that are within retire_margin of expiring
+
+        :return: The number of keys retired
+
+        """
+
+        now = self._clock()
+        with self._lock:
+            expiring, self._expiring = self._expiring, []
+            for keys in self._ready.values():
+                # Keys are appended as they are created, so the oldest are first
+                while keys and keys[0].retire_at <= now:
+                    expiring.append(keys.popleft().key)
+        self._delete(expiring)
+
+        return len(expiring)
+
+
+    def _create(self, name, capabilities):
+
+        response = self._client.create_authorization_key(capabilities, expiry_seconds=self._expiry_seconds,
+                                                         description=f'keypool {name}')
+        if response.status_code == 200:
+            with self._lock:
+                self.counters['created'] += 1
+
+        return response
+
+
+    def _delete(self, keys):
+
+        for key in keys:
+            try:
+                response = self._client.delete_key(key['id'])
+            except Exception:
+                continue
+            if response.status_code in (200, 404):
+                with self._lock:
+                    self.counters['retired'] += 1
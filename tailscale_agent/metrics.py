@@ -0,0 +1,233 @@
+"""
+Client-side metrics for Tailscale API calls, in the Prometheus text format.
+
+A MetricsCollector attached to one or more clients keeps counters, latency
+histograms and in-flight gauges labelled by endpoint template (for example
+/device/{id}/routes), HTTP verb and status class:
+
+    collector = MetricsCollector()
+    collector.attach(client)
+    collector.serve(port=9464)   # GET http://host:9464/metrics
+
+Only the standard library is used, so no Prometheus client package is needed.
+"""
+
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _status_class(event):
+
+    if event.status is None:
+        return 'error'
+
+    return f'{event.status // 100}xx'
+
+
+def _escape(value):
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsCollector:
+    """ Counters, histograms and gauges for the API calls of the clients it is attached to """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace='tailscale_api'):
+        """ Constructor for the MetricsCollector class
+
+        :param buckets: Upper bounds in seconds of the request duration histogram buckets
+        :param namespace: Prefix for the metric names
+
+        """
+
+        self._buckets = tuple(sorted(buckets))
+        self._namespace = namespace
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._durations = {}
+        self._in_flight = {}
+        self._rate_limit_wait = {}
+        self._retries = {}
+        self._request_bytes = {}
+        self._response_bytes = {}
+        self._cache = {}
+
+
+    def __repr__(self):
+
+        return f'MetricsCollector(namespace={self._namespace}, buckets={self._buckets})'
+
+
+    def attach(self, client):
+        """ Start collecting metrics for a client's calls
+
+        :param client: A Tailscale client
+
+        :return: The client
+
+        """
+
+        client.add_hook(self.observe, on_start=self.request_started)
+
+        return client
+
+
+    def detach(self, client):
+        """ Stop collecting metrics for a client's calls
+
+        :param client: A Tailscale client the collector was attached to
+
+        """
+
+        client.remove_hook(self.observe)
+
+
+    def request_started(self, verb, endpoint):
+        """ Count a call as in flight (called by the client when a call starts)
+
+        :param verb: The HTTP verb
+        :param endpoint: The endpoint template
+
+        """
+
+        key = (endpoint, verb)
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+
+    def observe(self, event):
+        """ Record a finished call (called by the client with a RequestEvent)
+
+        :param event: The RequestEvent for the call
+
+        """
+
+        key = (event.endpoint, event.verb)
+        with self._lock:
+            if key in self._in_flight:
+                self._in_flight[key] -= 1
+
+            counter_key = key + (_status_class(event),)
+            self._requests[counter_key] = self._requests.get(counter_key, 0) + 1
+
+            histogram = self._durations.get(key)
+            if histogram is None:
+                histogram = self._durations[key] = [[0] * len(self._buckets), 0, 0.0]
+            for i, bound in enumerate(self._buckets):
+                if event.total_time <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += event.total_time
+
+            self._rate_limit_wait[key] = self._rate_limit_wait.get(key, 0.0) + event.rate_limit_wait
+            self._retries[key] = self._retries.get(key, 0) + event.retries
+            self._request_bytes[key] = self._request_bytes.get(key, 0) + (event.request_bytes or 0)
+            self._response_bytes[key] = self._response_bytes.get(key, 0) + (event.response_bytes or 0)
+            if event.cache is not None:
+                cache_key = key + (event.cache,)
+                self._cache[cache_key] = self._cache.get(cache_key, 0) + 1
+
+
+    def render(self):
+        """ Render every metric in the Prometheus text exposition format
+
+        :return: The metrics as a string
+
+        """
+
+        ns = self._namespace
+        endpoint_labels = ('endpoint', 'verb')
+        lines = []
+
+        def family(name, kind, help_text, samples, label_names):
+            lines.append(f'# HELP {ns}_{name} {help_text}')
+            lines.append(f'# TYPE {ns}_{name} {kind}')
+            for labels, value in sorted(samples.items()):
+                lines.append(f'{ns}_{name}{_labels(label_names, labels)} {_number(value)}')
+
+        with self._lock:
+            family('requests_total', 'counter', 'API calls by endpoint, verb and status class.',
+                   self._requests, endpoint_labels + ('status_class',))
+
+            lines.append(f'# HELP {ns}_request_duration_seconds API call duration including retries and waits.')
+            lines.append(f'# TYPE {ns}_request_duration_seconds histogram')
+            for key, (counts, count, total) in sorted(self._durations.items()):
+                for bound, bucket_count in zip(self._buckets + (float('inf'),), counts + [count]):
+                    labels = _labels(endpoint_labels, key, f'le="{_number(bound)}"')
+                    lines.append(f'{ns}_request_duration_seconds_bucket{labels} {bucket_count}')
+                lines.append(f'{ns}_request_duration_seconds_sum{_labels(endpoint_labels, key)} {_number(total)}')
+                lines.append(f'{ns}_request_duration_seconds_count{_labels(endpoint_labels, key)} {count}')
+
+            family('requests_in_flight', 'gauge', 'API calls currently in progress.',
+                   self._in_flight, endpoint_labels)
+            family('rate_limit_wait_seconds_total', 'counter', 'Time spent waiting on the client rate limiter.',
+                   self._rate_limit_wait, endpoint_labels)
+            family('retries_total', 'counter', 'Requests retried after throttling or server errors.',
+                   self._retries, endpoint_labels)
+            family('request_bytes_total', 'counter', 'Request body bytes sent.',
+                   self._request_bytes, endpoint_labels)
+            family('response_bytes_total', 'counter', 'Response body bytes received.',
+                   self._response_bytes, endpoint_labels)
+            family('cache_total', 'counter', 'Calls that could be served from a cache, by result.',
+                   self._cache, endpoint_labels + ('result',))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        """ Serve the metrics over HTTP at /metrics from a background thread
+
+        :param port: Port to listen on (0 picks a free port)
+        :param host: Address to listen on. Use '0.0.0.0' to allow scraping from other hosts
+
+        :return: The http.server instance; call its shutdown() method to stop serving
+
+        """
+
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = collector.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='tailscale-metrics', daemon=True).start()
+
+        return server
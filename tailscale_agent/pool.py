@@ -0,0 +1,142 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from tailscale_agent.tailscale_agent import AdaptiveConcurrency, Tailscale, _run_bulk
+from tailscale_agent.token_cache import MemoryTokenCache
+
+
+class TailscalePool:
+    """ Clients for many tailnets that share one connection pool, rate limit and token cache
+
+        Each tailnet keeps its own credentials, but every client sends its requests
+        through the same requests.Session, waits on the same RateLimiter and stores its
+        OAuth tokens in the same token cache.
+
+    """
+
+    def __init__(self, base_url, rate_limiter=None, token_cache=None, max_workers=16, max_retries=2):
+        """ Constructor for the TailscalePool class
+
+        :param base_url: The tailscale API url and path shared by every tailnet
+        :param rate_limiter: Optional RateLimiter shared by every client
+        :param token_cache: Optional token cache for OAuth tokens (default: a MemoryTokenCache)
+        :param max_workers: Most concurrent requests made by map(), which adapts its
+            concurrency below that, and the number of pooled connections kept open
+        :param max_retries: How many times each client retries throttled or failed requests
+
+        """
+
+        self._base_url = base_url
+        self._rate_limiter = rate_limiter
+        self._token_cache = token_cache if token_cache is not None else MemoryTokenCache()
+        self._max_workers = max_workers
+        self._max_retries = max_retries
+        self._clients = {}
+        # Shared by every map() call, so they learn the API's limits from each other
+        self._concurrency = AdaptiveConcurrency(initial=min(4, max_workers), maximum=max_workers)
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+
+    def __repr__(self):
+
+        return (f'TailscalePool(self._base_url={self._base_url},'
+                f'self._tailnets={list(self._clients)},'
+                f'self._rate_limiter={self._rate_limiter})')
+
+
+    def __getitem__(self, tailnet):
+
+        return self._clients[tailnet]
+
+
+    def __contains__(self, tailnet):
+
+        return tailnet in self._clients
+
+
+    def __iter__(self):
+
+        return iter(self._clients)
+
+
+    def __len__(self):
+
+        return len(self._clients)
+
+
+    def add_tailnet(self, tailnet, api_key=None, oauth_client_id=None, oauth_client_secret=None,
+                    scopes=None, headers=None):
+        """ Add a tailnet to the pool with either an API key or OAuth client credentials
+
+        :param tailnet: The tailnet name
+        :param api_key: API key for the tailnet
+        :param oauth_client_id: OAuth client ID for the tailnet, used instead of api_key
+        :param oauth_client_secret: OAuth client secret matching oauth_client_id
+        :param scopes: Optional list of OAuth scopes to request
+        :param headers: Optional additional headers for this tailnet's requests
+
+        :return: The Tailscale client for the tailnet
+
+        """
+
+        client = Tailscale(api_key or '', self._base_url, tailnet, headers=headers, session=self._session,
+                           rate_limiter=self._rate_limiter, max_retries=self._max_retries)
+
+        if oauth_client_id is not None:
+            client.get_oauth_token(oauth_client_id, oauth_client_secret, auto_refresh=True,
+                                   scopes=scopes, token_cache=self._token_cache)
+
+        self._clients[tailnet] = client
+
+        return client
+
+
+    def remove_tailnet(self, tailnet):
+        """ Remove a tailnet from the pool and stop its background work
+
+        :param tailnet: The tailnet name
+
+        """
+
+        self._clients.pop(tailnet).close()
+
+
+    def map(self, method_name, *args, tailnets=None, **kwargs):
+        """ Call the same client method for every tailnet concurrently
+
+            Results are yielded as soon as each call completes. An exception raised for
+            one tailnet is reported in its result and does not stop the others. Calls
+            share the pool's AdaptiveConcurrency, which backs off when the API answers
+            429 or slows down, and closing the generator early stops starting new calls.
+
+        :param method_name: Name of the Tailscale method to call, e.g. 'get_devices'
+        :param args: Positional arguments for the method
+        :param tailnets: Optional iterable of tailnets to call (default: all of them)
+        :param kwargs: Keyword arguments for the method
+
+        :return: A generator of BulkResult(item, response, error) tuples, item being the tailnet
+
+        """
+
+        if method_name.startswith('_') or not callable(getattr(Tailscale, method_name, None)):
+            raise ValueError(f'{method_name!r} is not a public Tailscale method')
+
+        def call(tailnet):
+            return getattr(self._clients[tailnet], method_name)(*args, **kwargs)
+
+        return _run_bulk(call, list(self._clients) if tailnets is None else tailnets, self._concurrency)
+
+
+    def close(self):
+        """ Stop every client's background work and close the shared connections
+
+        """
+
+        for client in self._clients.values():
+            client.close()
+        self._session.close()
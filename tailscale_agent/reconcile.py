@@ -0,0 +1,292 @@
+"""
+Bring devices to a declared state, writing only what differs.
+
+A DeviceReconciler reads the current state of the devices once, compares it with the
+desired state and makes only the writes needed, several devices at a time:
+
+    reconciler = DeviceReconciler(client)
+    desired = {
+        'n1234CNTRL': {'name': 'web-1', 'tags': ['tag:web'], 'routes': ['10.0.0.0/24'],
+                       'keyExpiryDisabled': True, 'attributes': {'custom:tier': 'prod'}},
+    }
+
+    plan = reconciler.plan(desired)            # a dry run: nothing is written
+    print(format_plan(plan))
+    results = reconciler.apply(plan)
+
+Devices are named by id, nodeId or machine name (the first label of the device name).
+Only the fields given for a device are managed, and within 'attributes' only the keys
+given; an attribute set to None is removed.
+"""
+
+import threading
+
+from collections import namedtuple
+
+from tailscale_agent.tailscale_agent import BulkResult
+
+
+# One field of one device that differs from the desired state
+DeviceChange = namedtuple('DeviceChange', ['device_id', 'field', 'current', 'desired'])
+
+# The changes needed, and the desired device keys that matched no device (or more than one)
+Plan = namedtuple('Plan', ['changes', 'unmatched'])
+
+# The client method that writes each field
+WRITERS = {
+    'name': 'set_device_name',
+    'tags': 'update_device_tags',
+    'routes': 'set_device_routes',
+    'keyExpiryDisabled': 'update_device_key',
+}
+
+FIELDS = tuple(WRITERS) + ('attributes',)
+
+
+def _machine_name(name):
+
+    return (name or '').split('.', 1)[0]
+
+
+def format_plan(plan):
+    """ Describe a plan, one change per line
+
+    :param plan: A Plan from DeviceReconciler.plan()
+
+    :return: A string
+
+    """
+
+    lines = [f'{change.device_id}: {change.field} {change.current!r} -> {change.desired!r}'
+             for change in plan.changes]
+    lines.extend(f'{key}: no such device' for key in plan.unmatched)
+    if not lines:
+        return 'No changes'
+
+    return '\n'.join(lines)
+
+
+class DeviceReconciler:
+    """ Plans and makes the device writes needed to reach a desired state """
+
+    def __init__(self, client, max_workers=8, posture_comment=None):
+        """ Constructor for the DeviceReconciler class
+
+        :param client: The Tailscale client used to read and write devices
+        :param max_workers: Maximum number of devices read or written at once
+        :param posture_comment: Optional audit log reason sent with posture attribute writes
+
+        """
+
+        self._client = client
+        self._max_workers = max_workers
+        self._posture_comment = posture_comment
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(('reads', 'writes', 'failures'), 0)
+
+
+    def __repr__(self):
+
+        return f'DeviceReconciler(max_workers={self._max_workers})'
+
+
+    # ---------------------------------------------------------------------------
+    # Planning
+    # ---------------------------------------------------------------------------
+
+    def plan(self, desired):
+        """ Compare the desired state with the tailnet, without writing anything
+
+            The device list is read once. Routes are read per device only when the list
+            lacks them, and posture attributes only for devices that manage some; those
+            reads run concurrently. Unknown fields, or two keys naming the same device,
+            raise ValueError.
+
+        :param desired: A dict of device id, nodeId or machine name to a dict of the
+            fields to manage: 'name', 'tags', 'routes', 'keyExpiryDisabled', 'attributes'
+
+        :return: A Plan(changes, unmatched) tuple
+
+        """
+
+        for key, fields in desired.items():
+            unknown = set(fields) - set(FIELDS)
+            if unknown:
+                raise ValueError(f'{key}: unknown fields {sorted(unknown)}')
+
+        response = self._client.get_devices()
+        self._count('reads')
+        response.raise_for_status()
+        devices = response.json()['devices']
+
+        matched, unmatched = self._match(devices, desired)
+
+        routes = self._read('get_device_routes', [device['id'] for device, fields in matched
+                                                  if 'routes' in fields and 'enabledRoutes' not in device])
+        attributes = self._read('get_device_posture_attributes', [device['id'] for device, fields in matched
+                                                                  if fields.get('attributes')])
+
+        changes = []
+        for device, fields in matched:
+            device_id = device['id']
+            if 'name' in fields and _machine_name(fields['name']) != _machine_name(device.get('name')):
+                changes.append(DeviceChange(device_id, 'name', device.get('name'), fields['name']))
+            if 'tags' in fields and sorted(fields['tags']) != sorted(device.get('tags') or ()):
+                changes.append(DeviceChange(device_id, 'tags', device.get('tags') or [], list(fields['tags'])))
+            if 'routes' in fields:
+                current = routes.get(device_id, device).get('enabledRoutes') or []
+                if sorted(fields['routes']) != sorted(current):
+                    changes.append(DeviceChange(device_id, 'routes', current, list(fields['routes'])))
+            if 'keyExpiryDisabled' in fields and bool(fields['keyExpiryDisabled']) != bool(
+                    device.get('keyExpiryDisabled')):
+                changes.append(DeviceChange(device_id, 'keyExpiryDisabled', bool(device.get('keyExpiryDisabled')),
+                                            bool(fields['keyExpiryDisabled'])))
+            if fields.get('attributes'):
+                current = (attributes.get(device_id) or {}).get('attributes') or {}
+                patch = {key: value for key, value in fields['attributes'].items() if current.get(key) != value}
+                if patch:
+                    changes.append(DeviceChange(device_id, 'attributes',
+                                                {key: current.get(key) for key in patch}, patch))
+
+        return Plan(changes, unmatched)
+
+
+    def _match(self, devices, desired):
+        """ Find the device each desired key names
+
+        :return: A list of (device, fields) pairs, and a list of the keys that matched no single device
+
+        """
+
+        by_key, by_name = {}, {}
+        for device in devices:
+            by_key[device['id']] = by_key[device['nodeId']] = device
+            by_name.setdefault(_machine_name(device.get('name')), []).append(device)
+
+        matched, unmatched, seen = [], [], {}
+        for key, fields in desired.items():
+            device = by_key.get(key)
+            if device is None and len(by_name.get(key, ())) == 1:
+                device = by_name[key][0]
+            if device is None:
+                unmatched.append(key)
+                continue
+            if device['id'] in seen:
+                raise ValueError(f'device {device["id"]} is named more than once: {seen[device["id"]]!r} and {key!r}')
+            seen[device['id']] = key
+            matched.append((device, fields))
+
+        return matched, unmatched
+
+
+    def _read(self, method, device_ids):
+        """ Call a per-device read concurrently; a failed read raises, since planning without it would guess
+
+        :return: A dict of device id to response JSON
+
+        """
+
+        if not device_ids:
+            return {}
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        read = getattr(self._client, method)
+
+        def fetch(device_id):
+            response = read(device_id)
+            response.raise_for_status()
+            return response.json()
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            results = dict(zip(device_ids, executor.map(fetch, device_ids)))
+
+        with self._lock:
+            self.counters['reads'] += len(device_ids)
+
+        return results
+
+
+    # ---------------------------------------------------------------------------
+    # Applying
+    # ---------------------------------------------------------------------------
+
+    def apply(self, plan):
+        """ Make the writes in a plan
+
+            Each device's writes are made in order, and devices are written concurrently.
+            Posture attribute changes for every device go in one
+            batch_update_device_posture_attributes call. A failed write does not stop
+            the others.
+
+        :param plan: A Plan from plan(), or a desired state dict to plan first
+
+        :return: A list of BulkResult(item, response, error) tuples, item being the DeviceChange
+
+        """
+
+        if not isinstance(plan, Plan):
+            plan = self.plan(plan)
+
+        per_device = {}
+        posture = []
+        for change in plan.changes:
+            if change.field == 'attributes':
+                posture.append(change)
+            else:
+                per_device.setdefault(change.device_id, []).append(change)
+
+        results = []
+        if posture:
+            results.extend(self._write_posture(posture))
+        if per_device:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                for device_results in executor.map(self._write_device, per_device.values()):
+                    results.extend(device_results)
+
+        with self._lock:
+            self.counters['writes'] += sum(map(len, per_device.values())) + bool(posture)
+            self.counters['failures'] += sum(1 for result in results if not _succeeded(result))
+
+        return results
+
+
+    def _write_device(self, changes):
+
+        results = []
+        for change in changes:
+            write = getattr(self._client, WRITERS[change.field])
+            try:
+                results.append(BulkResult(change, write(change.device_id, change.desired), None))
+            except Exception as e:
+                results.append(BulkResult(change, None, e))
+
+        return results
+
+
+    def _write_posture(self, changes):
+
+        nodes = {}
+        for change in changes:
+            nodes.setdefault(change.device_id, {}).update(
+                {key: None if value is None else {'value': value} for key, value in change.desired.items()})
+        try:
+            response, error = self._client.batch_update_device_posture_attributes(
+                nodes, comment=self._posture_comment), None
+        except Exception as e:
+            response, error = None, e
+
+        return [BulkResult(change, response, error) for change in changes]
+
+
+    def _count(self, name):
+
+        with self._lock:
+            self.counters[name] += 1
+
+
+def _succeeded(result):
+
+    return result.error is None and result.response is not None and 200 <= result.response.status_code < 300
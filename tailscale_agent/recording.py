@@ -0,0 +1,300 @@
+"""
+Record API traffic to a file and replay it later without network access.
+
+A RecordingSession sits between a Tailscale client and its requests.Session and
+writes every request/response pair, with its timing, to a JSON Lines file
+(gzip-compressed when the name ends in .gz). Credentials never reach the file:
+request headers are not recorded, and secrets in bodies (OAuth client secrets and
+tokens, auth keys, webhook secrets, ...) are replaced with REDACTED.
+
+    client.record('run.jsonl.gz')
+    ... make calls ...
+    client.stop_recording()
+
+A ReplaySession serves a recording back to a client, at the recorded speed, faster,
+or without delays:
+
+    client = Tailscale('tskey-replay', base_url, tailnet, session=ReplaySession('run.jsonl.gz', speed=0))
+"""
+
+import base64
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+
+REDACTED = 'REDACTED'
+
+# JSON fields and form parameters whose values are secrets
+SECRET_FIELDS = frozenset((
+    'access_token', 'client_secret', 'clientSecret', 'key', 'secret', 'token', 'password', 'refresh_token',
+))
+
+# Tailscale API keys, auth keys, OAuth tokens and webhook secrets all look like this
+_TSKEY_PATTERN = re.compile(r'tskey-[A-Za-z0-9_-]+')
+
+# Response headers worth keeping; the rest only add size
+_KEPT_HEADERS = ('Content-Type', 'ETag', 'Retry-After', 'Link')
+
+
+def _redact_value(value, fields):
+
+    if isinstance(value, dict):
+        return {k: REDACTED if k in fields and isinstance(v, str) else _redact_value(v, fields)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact_value(v, fields) for v in value]
+
+    return value
+
+
+def redact(body, content_type=None, fields=SECRET_FIELDS):
+    """ Remove secrets from a request or response body
+
+    :param body: The body as a string
+    :param content_type: The body's content type, if known
+    :param fields: Names of JSON fields and form parameters whose values are secret
+
+    :return: The body with secret values replaced by REDACTED
+
+    """
+
+    if not body:
+        return body
+
+    try:
+        body = json.dumps(_redact_value(json.loads(body), fields), separators=(',', ':'))
+    except ValueError:
+        if (content_type and 'form-urlencoded' in content_type) or ('=' in body and ' ' not in body):
+            pairs = parse_qsl(body, keep_blank_values=True)
+            if pairs:
+                body = urlencode([(k, REDACTED if k in fields else v) for k, v in pairs])
+
+    return _TSKEY_PATTERN.sub(f'tskey-{REDACTED}', body)
+
+
+def _encode_body(body):
+    """ Store a body as text, or as base64 when it is not UTF-8 """
+
+    if body is None:
+        return None, None
+    if isinstance(body, str):
+        return body, None
+    try:
+        return body.decode('utf-8'), None
+    except UnicodeDecodeError:
+        return base64.b64encode(body).decode('ascii'), 'base64'
+
+
+def _decode_body(text, encoding):
+
+    if text is None:
+        return b''
+    if encoding == 'base64':
+        return base64.b64decode(text)
+
+    return text.encode('utf-8')
+
+
+def _request_key(method, url):
+
+    parts = urlsplit(url)
+    return method.upper(), parts.path + (f'?{parts.query}' if parts.query else '')
+
+
+def _open(path, mode, compress):
+
+    if compress is None:
+        compress = str(path).endswith('.gz')
+
+    return gzip.open(path, f'{mode}t', encoding='utf-8') if compress else open(path, mode, encoding='utf-8')
+
+
+def load_recording(path):
+    """ Read the entries of a recording file
+
+    :param path: A file written by RecordingSession (.gz files are decompressed)
+
+    :return: A list of entry dicts
+
+    """
+
+    with _open(path, 'r', None) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordingSession:
+    """ A requests.Session stand-in that records every call it passes on """
+
+    def __init__(self, path, session=None, compress=None, redact_fields=()):
+        """ Constructor for the RecordingSession class
+
+        :param path: File to write the recording to. It is gzip-compressed when compress
+            is True, or when compress is None and the name ends in .gz
+        :param session: Optional requests.Session to send the requests through (default: a new one)
+        :param compress: Whether to gzip the file (default: decided by the file name)
+        :param redact_fields: Extra JSON field or form parameter names to redact
+
+        """
+
+        if session is None:
+            import requests
+            session = requests.Session()
+            self._owns_session = True
+        else:
+            self._owns_session = False
+
+        self.session = session
+        self._fields = SECRET_FIELDS | frozenset(redact_fields)
+        self._file = _open(path, 'w', compress)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+    def request(self, method, url, **kwargs):
+        """ Send a request through the wrapped session and record it
+
+        :return: The requests response object
+
+        """
+
+        offset = time.monotonic() - self._started
+        response = self.session.request(method, url, **kwargs)
+
+        request_body = response.request.body if response.request is not None else None
+        if isinstance(request_body, bytes):
+            request_body = request_body.decode('utf-8', 'replace')
+        content_type = response.headers.get('Content-Type', '')
+        body, encoding = _encode_body(response.content)
+        if encoding is None:
+            body = redact(body, content_type, self._fields)
+
+        entry = {
+            'offset': round(offset, 6),
+            'method': method.upper(),
+            'url': url,
+            'request_body': redact(request_body, None, self._fields),
+            'status': response.status_code,
+            'headers': {name: response.headers[name] for name in _KEPT_HEADERS if name in response.headers},
+            'body': body,
+            'elapsed': round(response.elapsed.total_seconds(), 6),
+        }
+        if encoding:
+            entry['encoding'] = encoding
+        # Conditional requests only make sense with their precondition
+        conditions = {k: v for k, v in (kwargs.get('headers') or {}).items() if k in ('If-Match', 'If-None-Match')}
+        if conditions:
+            entry['request_headers'] = conditions
+
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+        return response
+
+
+    def close(self):
+        """ Finish the recording file, and close the session if this object created it
+
+        """
+
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        if self._owns_session:
+            self.session.close()
+
+
+class ReplaySession:
+    """ A requests.Session stand-in that answers from a recording instead of the network
+
+        Requests are matched by HTTP verb and URL path and query. Recorded responses
+        for the same request are served in the order they were recorded, and the last
+        one is repeated once they run out. A request that was never recorded raises
+        LookupError.
+
+    """
+
+    def __init__(self, recording, speed=1.0):
+        """ Constructor for the ReplaySession class
+
+        :param recording: Path of a recording file (a str or os.PathLike), or a list of
+            entries from load_recording
+        :param speed: How fast to replay: 1.0 waits as long as each original response
+            took, 10.0 ten times less, and 0 or None does not wait at all
+
+        """
+
+        entries = load_recording(recording) if isinstance(recording, (str, os.PathLike)) else list(recording)
+
+        self._speed = speed
+        self._queues = {}
+        for entry in entries:
+            self._queues.setdefault(_request_key(entry['method'], entry['url']), []).append(entry)
+        self._positions = dict.fromkeys(self._queues, 0)
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+
+        return f'ReplaySession(requests={len(self._queues)}, speed={self._speed})'
+
+
+    def request(self, method, url, **kwargs):
+        """ Return the recorded response for a request
+
+        :return: A requests response object built from the recording
+
+        """
+
+        import requests
+
+        key = _request_key(method, url)
+        with self._lock:
+            queue = self._queues.get(key)
+            if not queue:
+                raise LookupError(f'no recorded response for {key[0]} {key[1]}')
+            position = self._positions[key]
+            self._positions[key] = min(position + 1, len(queue) - 1)
+        entry = queue[position]
+
+        if self._speed:
+            time.sleep(entry['elapsed'] / self._speed)
+
+        prepared = requests.PreparedRequest()
+        prepared.method = entry['method']
+        prepared.url = url
+        prepared.headers = requests.structures.CaseInsensitiveDict(kwargs.get('headers') or {})
+        prepared.body = entry.get('request_body')
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response._content = _decode_body(entry['body'], entry.get('encoding'))
+        response.encoding = 'utf-8'
+        response.url = url
+        response.request = prepared
+        response.elapsed = timedelta(seconds=entry['elapsed'])
+
+        return response
+
+
+    def close(self):
+
+        pass
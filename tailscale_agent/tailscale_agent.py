@@ -1,25 +1,525 @@
-import requests
+import base64
+import functools
+import sys
+import threading
+import time
+import warnings
+
+from collections import namedtuple
+
+
+# Heavier modules (requests, json, hashlib, concurrent.futures) are imported inside the
+# functions that need them, so importing this module and constructing a client stay cheap.
+
+def __getattr__(name):
+    # Accessing tailscale_agent.tailscale_agent.requests (e.g. to patch it) imports it on demand
+    if name == 'requests':
+        import requests
+        return requests
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _strip_hujson(text):
+    """ Remove comments and trailing commas so a HuJSON policy parses as standard JSON
+
+    :param text: The HuJSON document as a string
+
+    :return: The equivalent standard JSON string
+
+    """
+
+    def scan(text, handle):
+        out = []
+        i, n = 0, len(text)
+        while i < n:
+            if text[i] == '"':
+                j = i + 1
+                while j < n and text[j] != '"':
+                    j += 2 if text[j] == '\\' else 1
+                out.append(text[i:j + 1])
+                i = j + 1
+            else:
+                i = handle(text, i, out)
+        return ''.join(out)
+
+    def drop_comments(text, i, out):
+        if text.startswith('//', i):
+            end = text.find('\n', i)
+            return len(text) if end == -1 else end
+        if text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            return len(text) if end == -1 else end + 2
+        out.append(text[i])
+        return i + 1
+
+    def drop_trailing_commas(text, i, out):
+        if text[i] == ',':
+            j = i + 1
+            while j < len(text) and text[j].isspace():
+                j += 1
+            if j < len(text) and text[j] in '}]':
+                return i + 1
+        out.append(text[i])
+        return i + 1
+
+    return scan(scan(text, drop_comments), drop_trailing_commas)
+
+
+def _policy_digest(policy):
+    """ Hash a policy file so that formatting, comments and key order do not affect the result
+
+    :param policy: The policy file content as bytes or a string (JSON or HuJSON)
+
+    :return: A hex SHA-256 digest of the normalized policy
+
+    """
+
+    import hashlib
+    import json
+
+    try:
+        if isinstance(policy, bytes):
+            policy = policy.decode('utf-8')
+        canonical = json.dumps(json.loads(_strip_hujson(policy)), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        # Not parseable as (Hu)JSON, so fall back to the raw content
+        canonical = policy.strip() if isinstance(policy, str) else policy.strip().decode('utf-8', 'replace')
+
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Refresh OAuth tokens this many seconds before they expire (at most a quarter of their lifetime)
+_OAUTH_REFRESH_MARGIN = 300
+
+# After a failed refresh, wait this long before trying again, doubling per failure up to the maximum
+_OAUTH_RETRY_DELAY = 10
+_OAUTH_MAX_RETRY_DELAY = 300
+
+# Server errors are only retried for methods that are safe to repeat
+_IDEMPOTENT_METHODS = frozenset(('get', 'put', 'delete'))
+
+
+# One API call as reported to request hooks (see Tailscale.add_hook). Times are in seconds:
+# ttfb is the time until the response headers arrived (last attempt), total_time covers the whole
+# call including retries and rate-limit waits. dns_time, connect_time and tls_time are None
+# because requests does not expose them. cache is 'hit' or 'miss' for calls that can be served
+# from a cache (conditional ACL fetches, ACL previews, OAuth tokens) and None otherwise.
+RequestEvent = namedtuple('RequestEvent', [
+    'method_name', 'endpoint', 'verb', 'url', 'status', 'dns_time', 'connect_time', 'tls_time',
+    'ttfb', 'total_time', 'request_bytes', 'response_bytes', 'retries', 'cache', 'rate_limit_wait',
+    'error'])
+
+# One item of a bulk call (e.g. Tailscale.suspend_users): the item, and either its response or the exception raised
+BulkResult = namedtuple('BulkResult', ['item', 'response', 'error'])
+
+# The outcome of create_user_invites_many / create_device_invites_many: the invites created, in
+# input order, and a BulkResult for each entry that could not be created
+InviteReport = namedtuple('InviteReport', ['created', 'failed'])
+
+# Times a chunk of invites still throttled after the client's own retries is sent again
+_INVITE_CHUNK_RETRIES = 3
+
+# Responses slower than this never count as slow for AdaptiveConcurrency without a latency target
+_MIN_LATENCY_TARGET = 0.05
+
+# Path segments whose following segment is a parameter, and the placeholder that replaces it
+_PATH_PARAMETERS = {
+    'tailnet': '{tailnet}', 'device': '{id}', 'device-invites': '{id}', 'keys': '{id}', 'users': '{id}',
+    'user-invites': '{id}', 'webhooks': '{id}', 'integrations': '{id}', 'attributes': '{key}',
+    'logging': '{log_type}', 'contacts': '{contact_type}', 'aws-external-id': '{id}',
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def _endpoint_template(path):
+    """ Replace the IDs and names in an API path with placeholders
+
+    :param path: The URL path below the base URL, e.g. '/device/12345/routes'
+
+    :return: The endpoint template, e.g. '/device/{id}/routes'
+
+    """
+
+    segments = path.split('/')
+    template = segments[:1]
+    for previous, segment in zip(segments, segments[1:]):
+        placeholder = _PATH_PARAMETERS.get(previous)
+        template.append(placeholder if placeholder and segment != '-' else segment)
+
+    return '/'.join(template)
+
+
+def _nameserver_addresses(nameservers):
+    """ Reduce a list of nameservers to their addresses
+
+    :param nameservers: List of address strings or nameserver dicts with an 'address' key
+
+    :return: List of address strings
+
+    """
+
+    return [ns['address'] if isinstance(ns, dict) else ns for ns in nameservers or ()]
+
+
+def _retry_delay(response, attempt):
+    """ Work out how long to wait before retrying a throttled or failed request
+
+    :param response: The response that is being retried
+    :param attempt: How many retries have been made already
+
+    :return: The delay in seconds, from Retry-After when present, else exponential backoff
+
+    """
+
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            try:
+                import email.utils
+                return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+
+    return min(0.5 * 2 ** attempt, 30)
+
+
+def _token_response(url, token):
+    """ Build a response object for a token served from a token cache
+
+    :param url: The token endpoint URL
+    :param token: The cached token dict
+
+    :return: A requests response object with status 200 and the token as its JSON body
+
+    """
+
+    import json
+    import requests
+
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps(token).encode('utf-8')
+
+    return response
+
+
+class _BasicAuth:
+    """ HTTP Basic auth for requests, usable without importing requests up front """
+
+    def __init__(self, username, password=''):
+        """ Constructor for the _BasicAuth class
+
+        :param username: The username, which for the Tailscale API is the API key or token
+        :param password: The password (unused by the Tailscale API)
+
+        """
+
+        self.username = username
+        self.password = password
+        self._header = None
+
+
+    def __eq__(self, other):
+
+        return (self.username, self.password) == (getattr(other, 'username', None),
+                                                  getattr(other, 'password', None))
+
+
+    def __ne__(self, other):
+
+        return not self == other
+
+
+    __hash__ = None
+
+
+    def __call__(self, r):
+
+        if self._header is None:
+            credentials = f'{self.username}:{self.password}'.encode('latin1')
+            self._header = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        r.headers['Authorization'] = self._header
+
+        return r
+
+
+class RateLimiter:
+    """ A thread-safe token bucket that clients can share to stay within one request budget """
+
+    def __init__(self, rate, burst=None):
+        """ Constructor for the RateLimiter class
+
+        :param rate: Sustained number of requests allowed per second
+        :param burst: Number of requests that may be sent at once before the rate applies (default: rate)
+
+        """
+
+        self._rate = rate
+        self._capacity = burst or max(rate, 1)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+
+        return f'RateLimiter(rate={self._rate}, burst={self._capacity})'
+
+
+    def acquire(self):
+        """ Wait until a request may be sent
+
+        :return: The number of seconds spent waiting
+
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # Reserve a token now; a negative balance is how long the caller must wait
+            self._tokens -= 1
+            wait = max(-self._tokens / self._rate, self._paused_until - now, 0)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+    def pause(self, seconds):
+        """ Hold back every request for a while, e.g. after the API answered 429
+
+        :param seconds: How long to pause for
+
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency:
+    """ A limit on concurrent requests that follows the API's responses (additive increase, multiplicative decrease)
+
+        Each fast, successful response raises the limit by 1/limit, so it grows by about one
+        per round of requests. A 429, or a response slower than the latency target, halves
+        it, at most once per round trip since the responses already in flight were sent at
+        the old limit. Bulk methods such as Tailscale.suspend_users use one, and it can be
+        shared between calls so they learn from each other.
+
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, latency_target=None):
+        """ Constructor for the AdaptiveConcurrency class
+
+        :param initial: Number of concurrent requests to start with
+        :param minimum: Lowest the limit goes
+        :param maximum: Highest the limit goes
+        :param latency_target: Seconds after which a response counts as slow (default: three
+            times the fastest response seen, and at least 50ms)
+
+        """
+
+        self._limit = float(max(minimum, min(initial, maximum)))
+        self._minimum = minimum
+        self._maximum = maximum
+        self._latency_target = latency_target
+        self._fastest = None
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+
+    def __repr__(self):
+
+        return f'AdaptiveConcurrency(limit={self.limit}, minimum={self._minimum}, maximum={self._maximum})'
+
+
+    @property
+    def limit(self):
+        """ The current number of requests allowed at once """
+
+        return int(self._limit)
+
+
+    @property
+    def maximum(self):
+        """ The highest the limit can go """
+
+        return self._maximum
+
+
+    def acquire(self):
+        """ Wait until another request may start
+
+        """
+
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+
+    def release(self, latency=None, throttled=False):
+        """ Finish a request and adjust the limit from how it went
+
+        :param latency: Seconds the request took, or None to adjust nothing
+        :param throttled: Whether the API answered 429
+
+        """
+
+        with self._condition:
+            self._in_flight -= 1
+            if latency is not None:
+                if not throttled and (self._fastest is None or latency < self._fastest):
+                    self._fastest = latency
+                target = self._latency_target
+                if target is None:
+                    target = max(3 * self._fastest, _MIN_LATENCY_TARGET) if self._fastest else latency
+                now = time.monotonic()
+                if throttled or latency > target:
+                    if now - self._last_decrease > latency:
+                        self._limit = max(self._minimum, self._limit / 2)
+                        self._last_decrease = now
+                else:
+                    self._limit = min(self._maximum, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+
+def _run_bulk(call, items, concurrency=None, ordered=False):
+    """ Call a function for every item concurrently and yield the outcomes
+
+        Items are read lazily, so a large iterable is not held in memory. A failing
+        item does not stop the others: its exception is returned in its result.
+        Closing the generator early stops starting new calls.
+
+    :param call: Function called as call(item), usually returning a requests response
+    :param items: Iterable of items
+    :param concurrency: Maximum number of calls at once as an int, or an AdaptiveConcurrency
+        to adjust it from the API's responses (default: a new AdaptiveConcurrency())
+    :param ordered: Yield results in input order instead of as they complete; results
+        that complete early are held until the ones before them arrive
+
+    :return: A generator of BulkResult(item, response, error) tuples
+
+    """
+
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    if concurrency is None:
+        concurrency = AdaptiveConcurrency()
+    elif isinstance(concurrency, int):
+        concurrency = AdaptiveConcurrency(concurrency, concurrency, concurrency)
+
+    results = queue.SimpleQueue()
+    stopped = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=concurrency.maximum)
+    # Held while checking stopped and submitting, and while shutting down, so nothing is
+    # submitted to a shut down executor with a concurrency slot that is never released
+    submitting = threading.Lock()
+
+    def run(index, item):
+        started = time.monotonic()
+        try:
+            response = call(item)
+        except Exception as e:
+            concurrency.release()
+            results.put((index, BulkResult(item, None, e)))
+            return
+        concurrency.release(time.monotonic() - started, getattr(response, 'status_code', None) == 429)
+        results.put((index, BulkResult(item, response, None)))
+
+    def feed():
+        submitted = 0
+        try:
+            for item in items:
+                concurrency.acquire()
+                with submitting:
+                    if stopped.is_set():
+                        concurrency.release()
+                        break
+                    executor.submit(run, submitted, item)
+                submitted += 1
+        finally:
+            # The total tells the consumer when every result has arrived
+            results.put(submitted)
+
+    threading.Thread(target=feed, name='tailscale-bulk', daemon=True).start()
+
+    received, total = 0, None
+    held, next_index = {}, 0
+    try:
+        while total is None or received < total:
+            result = results.get()
+            if isinstance(result, int):
+                total = result
+                continue
+            received += 1
+            index, result = result
+            if not ordered:
+                yield result
+                continue
+            held[index] = result
+            while next_index in held:
+                yield held.pop(next_index)
+                next_index += 1
+    finally:
+        # At most concurrency.limit calls were submitted, and they are all running; let them finish
+        with submitting:
+            stopped.set()
+            executor.shutdown(wait=False)
 
-from requests.auth import HTTPBasicAuth
 
 class Tailscale:
 
-    def __init__(self, api_key, base_url, tailnet=None, headers=None):
+    def __init__(self, api_key, base_url, tailnet=None, headers=None, session=None,
+                 rate_limiter=None, max_retries=0, transport=None):
         """ Constructor for the Tailscale class
         :param api_key: The API key with which to authenticate against the tailscale API
         :param base_url: The tailscale API url and path to use when making calls from this client
         :param tailnet: The tailnet to perform our operations on from this client
         :param headers: Optional additional headers to merge into every request
+        :param session: Optional requests.Session to send requests through, so connections are
+            reused (and can be shared between clients)
+        :param rate_limiter: Optional RateLimiter every request waits on. A 429 response
+            pauses the limiter for the Retry-After period
+        :param max_retries: How many times to retry a 429 response, or a server error for
+            GET/PUT/DELETE, before returning it
+        :param transport: Optional transport to send requests through instead of the requests
+            library, e.g. one from tailscale_agent.transport. It takes the place of session
 
         """
 
+        if session is not None and transport is not None:
+            raise ValueError('pass either session or transport, not both')
+
         self._api_key = api_key
         self._base_url = base_url
         self._tailnet = tailnet
-        self._auth = HTTPBasicAuth(api_key, '')
+        self._auth = _BasicAuth(api_key)
         self._headers = {'Accept': 'application/json'}
         if headers:
             self._headers.update(headers)
+        self._acl_cache = None
+        self._acl_preview_cache = {'digest': None, 'results': {}}
+        self._oauth_credentials = None
+        self._token_cache = None
+        self._token_refresh_at = None
+        self._token_lock = threading.Lock()
+        self._token_timer = None
+        self._token_failures = 0
+        self._session = session if session is not None else transport
+        self._rate_limiter = rate_limiter
+        self._max_retries = max_retries
+        self._hooks = []
+        self._start_hooks = []
+        self._recorder = None
 
 
     def __repr__(self):
@@ -31,6 +531,283 @@ class Tailscale:
                f'self._headers={self._headers})')
 
 
+    def _request(self, method, url, headers=None, **kwargs):
+        """ Send a request to the API using the client's credentials and headers.
+
+            When the client manages an OAuth token (see get_oauth_token with auto_refresh)
+            a token that is about to expire is refreshed before the request is sent, and
+            a 401 response triggers one refresh and retry. Requests wait on the client's
+            rate limiter, and throttled or failed requests are retried up to max_retries times.
+
+        :param method: The HTTP verb, e.g. 'get' or 'post'
+        :param url: The full URL to call
+        :param headers: Optional headers to send instead of the client's default headers
+        :param kwargs: Extra arguments passed through to requests (json, data, ...)
+
+        :return: The requests response object
+
+        """
+
+        if self._oauth_credentials is not None and self._token_refresh_at is not None \
+                and time.monotonic() >= self._token_refresh_at:
+            self._refresh_oauth_token(self._api_key)
+
+        hooks = self._hooks
+        started = time.perf_counter() if hooks else None
+        if self._start_hooks:
+            self._notify_start(method, url)
+        waited = 0.0
+        retries = 0
+        refreshed = False
+        while True:
+            if self._rate_limiter is not None:
+                waited += self._rate_limiter.acquire()
+
+            api_key = self._api_key
+            try:
+                response = self._send(method, url, auth=self._auth, headers=headers or self._headers, **kwargs)
+            except Exception as error:
+                if hooks:
+                    self._emit(method, url, started, retries=retries, rate_limit_wait=waited, error=error)
+                raise
+            status = response.status_code
+
+            if status == 401 and not refreshed and self._oauth_credentials is not None:
+                refreshed = True
+                if self._refresh_oauth_token(api_key):
+                    continue
+
+            if retries < self._max_retries and (
+                    status == 429 or (status >= 500 and method in _IDEMPOTENT_METHODS)):
+                delay = _retry_delay(response, retries)
+                retries += 1
+                if self._rate_limiter is not None and status == 429:
+                    self._rate_limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+
+            if hooks:
+                cache = None
+                if headers and 'If-None-Match' in headers:
+                    cache = 'hit' if status == 304 else 'miss'
+                self._emit(method, url, started, response, retries=retries, rate_limit_wait=waited, cache=cache)
+
+            return response
+
+
+    def _send(self, method, url, **kwargs):
+        """ Send a single HTTP request through the client's session or transport, or plain requests without one
+
+        :param method: The HTTP verb, e.g. 'get' or 'post'
+        :param url: The full URL to call
+        :param kwargs: Arguments passed through to requests
+
+        :return: The requests response object
+
+        """
+
+        if self._session is not None:
+            return self._session.request(method, url, **kwargs)
+
+        import requests
+
+        return getattr(requests, method)(url, **kwargs)
+
+
+    def add_hook(self, hook, on_start=None):
+        """ Register a function to be called after every API call made by this client
+
+            The hook receives a RequestEvent describing the call: the client method,
+            endpoint template, HTTP verb, status, timings, bytes sent and received, retries,
+            cache use and time spent waiting on the rate limiter. Hooks run in the thread
+            that made the call, so they should be quick. An exception raised by a hook is
+            turned into a RuntimeWarning and does not affect the call.
+
+        :param hook: A callable taking a RequestEvent
+        :param on_start: Optional callable taking the HTTP verb and endpoint template, called
+            when a call starts. Every on_start call is followed by a call to hook
+
+        :return: The hook, so this can be used as a decorator
+
+        """
+
+        self._hooks = self._hooks + [hook]
+        if on_start is not None:
+            self._start_hooks = self._start_hooks + [(hook, on_start)]
+
+        return hook
+
+
+    def remove_hook(self, hook):
+        """ Unregister a hook added with add_hook, along with its on_start callable
+
+        :param hook: The hook to remove
+
+        """
+
+        self._hooks = [h for h in self._hooks if h != hook]
+        self._start_hooks = [(h, on_start) for h, on_start in self._start_hooks if h != hook]
+
+
+    def _endpoint(self, url):
+
+        path = url[len(self._base_url):] if url.startswith(self._base_url) else url
+        return _endpoint_template(path.partition('?')[0])
+
+
+    def _notify_start(self, verb, url):
+        """ Call the on_start callables registered with add_hook
+
+        :param verb: The HTTP verb
+        :param url: The URL about to be called
+
+        """
+
+        verb, endpoint = verb.upper(), self._endpoint(url)
+        for hook, on_start in self._start_hooks:
+            try:
+                on_start(verb, endpoint)
+            except Exception as hook_error:
+                warnings.warn(f'request hook {on_start!r} failed: {hook_error!r}', RuntimeWarning, stacklevel=3)
+
+
+    def _emit(self, verb, url, started=None, response=None, retries=0, rate_limit_wait=0.0,
+              cache=None, error=None):
+        """ Build a RequestEvent for a finished call and pass it to every hook
+
+        :param verb: The HTTP verb
+        :param url: The URL called
+        :param started: time.perf_counter() when the call started, or None if no time was spent
+        :param response: The final response, if there was one
+        :param retries: How many times the request was retried
+        :param rate_limit_wait: Seconds spent waiting on the rate limiter
+        :param cache: 'hit', 'miss' or None
+        :param error: The exception raised instead of a response, if any
+
+        """
+
+        total_time = time.perf_counter() - started if started is not None else 0.0
+        if started is None and self._start_hooks:
+            # Served without a request, so the call starts and ends here
+            self._notify_start(verb, url)
+
+        # The client method is the nearest public Tailscale method on the stack
+        frame = sys._getframe(1)
+        while frame is not None and (frame.f_code.co_name[0] in '_<' or
+                                     not hasattr(type(self), frame.f_code.co_name)):
+            frame = frame.f_back
+        method_name = frame.f_code.co_name if frame is not None else None
+
+        endpoint = self._endpoint(url)
+
+        status = ttfb = request_bytes = response_bytes = None
+        if response is not None:
+            status = response.status_code
+            if started is not None:
+                ttfb = response.elapsed.total_seconds()
+            body = response.request.body if response.request is not None else None
+            request_bytes = len(body) if body is not None else 0
+            response_bytes = len(response.content or b'')
+
+        event = RequestEvent(method_name, endpoint, verb.upper(), url, status, None, None, None, ttfb, total_time,
+                             request_bytes, response_bytes, retries, cache, rate_limit_wait, error)
+
+        for hook in self._hooks:
+            try:
+                hook(event)
+            except Exception as hook_error:
+                warnings.warn(f'request hook {hook!r} failed: {hook_error!r}', RuntimeWarning, stacklevel=2)
+
+
+    def record(self, path, compress=None, redact_fields=()):
+        """ Start recording this client's API traffic to a file
+
+            Every request and response is written with its timing, with credentials
+            and other secrets redacted (see tailscale_agent.recording). Replay the file
+            with tailscale_agent.recording.ReplaySession.
+
+        :param path: File to write to; it is gzip-compressed if the name ends in .gz
+        :param compress: Force compression on or off regardless of the file name
+        :param redact_fields: Extra JSON field or form parameter names to redact
+
+        :return: The RecordingSession now used by the client
+
+        """
+
+        from tailscale_agent.recording import RecordingSession
+
+        self.stop_recording()
+        self._recorder = RecordingSession(path, session=self._session, compress=compress,
+                                          redact_fields=redact_fields)
+        self._session = self._recorder
+
+        return self._recorder
+
+
+    def stop_recording(self):
+        """ Stop recording started with record() and close the recording file
+
+        """
+
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            self._session = None if recorder._owns_session else recorder.session
+            recorder.close()
+
+
+    def map(self, method, args, concurrency=None, ordered=False):
+        """ Call a client method once per argument set, concurrently
+
+            Each call goes through the client's rate limiter, retries and hooks like any
+            other. A failing call does not stop the others: its exception is returned
+            in its result. Arguments are read lazily, and closing the generator early
+            stops starting new calls.
+
+            Example: client.map('get_device', device_ids, concurrency=16)
+
+        :param method: Name of a public Tailscale method, or a method bound to this client
+        :param args: Iterable of arguments: a tuple is passed as positional arguments, and
+            anything else as the only argument (wrap a single tuple argument in a 1-tuple)
+        :param concurrency: Maximum number of calls at once as an int, or an AdaptiveConcurrency
+            to adjust it from the API's responses (default: a new AdaptiveConcurrency())
+        :param ordered: Yield results in input order instead of as they complete
+
+        :return: A generator of BulkResult(item, response, error) tuples, item being the arguments
+
+        """
+
+        if isinstance(method, str):
+            if method.startswith('_') or not callable(getattr(type(self), method, None)):
+                raise ValueError(f'{method!r} is not a public Tailscale method')
+            method = getattr(self, method)
+        elif getattr(method, '__self__', None) is not self:
+            raise ValueError(f'{method!r} is not a method of this client')
+
+        def call(item):
+            return method(*item) if isinstance(item, tuple) else method(item)
+
+        return self._bulk(call, args, concurrency, ordered)
+
+
+    def _bulk(self, call, items, concurrency=None, ordered=False):
+        """ Call a function for every item concurrently and yield the outcomes; see _run_bulk """
+
+        return _run_bulk(call, items, concurrency, ordered)
+
+
+    def close(self):
+        """ Stop any background work started by this client, stop refreshing OAuth tokens and finish any recording.
+
+        """
+
+        self._oauth_credentials = None
+        if self._token_timer is not None:
+            self._token_timer.cancel()
+            self._token_timer = None
+        self.stop_recording()
+
+
     # ---------------------------------------------------------------------------
     # ACL / Policy File methods
     # ---------------------------------------------------------------------------
@@ -43,7 +820,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/acl'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -58,29 +835,95 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/acl/validate'
-        response = requests.post(url, auth=self._auth, headers=self._headers, data=acl_json)
+        response = self._request('post', url, data=acl_json)
 
         return(response)
 
 
-    def update_acls(self, acl_json):
+    def update_acls(self, acl_json, skip_unchanged=False):
         """ Update the Access Controls with the specified JSON.
 
             It's worth noting the JSON wants to be posted as --data-binary
             so you'll want to pass it in from f.open() and not json.loads()
 
+            With skip_unchanged the current policy is fetched first (or revalidated
+            against the cached copy with its ETag) and the update is skipped when the
+            normalized content matches. Changed policies are then posted with If-Match,
+            so a concurrent edit makes the API reject the update instead of overwriting it.
+
         :param acl_json: binary representation of the JSON to be passed as binary-data to requests
+        :param skip_unchanged: If True, skip the update when the policy content is unchanged
 
-        :return: The requests response object
+        :return: The requests response object. When the update is skipped this is the
+            response holding the current policy
 
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/acl'
-        response = requests.post(url, auth=self._auth, headers=self._headers, data=acl_json)
+
+        if not skip_unchanged:
+            response = self._request('post', url, data=acl_json)
+            return(response)
+
+        current = self._get_current_acls()
+        if current.status_code != 200:
+            return current
+
+        if _policy_digest(acl_json) == self._acl_cache['digest']:
+            return current
+
+        headers = self._headers
+        if self._acl_cache['etag']:
+            headers = {**self._headers, 'If-Match': self._acl_cache['etag']}
+
+        response = self._request('post', url, headers=headers, data=acl_json)
+
+        if response.status_code == 200:
+            self._remember_acls(response)
+        else:
+            self._acl_cache = None
 
         return(response)
 
 
+    def _get_current_acls(self):
+        """ Fetch the current policy, reusing the cached copy when its ETag is still current
+
+        :return: The requests response object holding the current policy
+
+        """
+
+        url = f'{self._base_url}/tailnet/{self._tailnet}/acl'
+        cache = self._acl_cache
+
+        headers = self._headers
+        if cache and cache['etag']:
+            headers = {**self._headers, 'If-None-Match': cache['etag']}
+
+        response = self._request('get', url, headers=headers)
+
+        if response.status_code == 304 and cache:
+            return cache['response']
+        if response.status_code == 200:
+            self._remember_acls(response)
+
+        return response
+
+
+    def _remember_acls(self, response):
+        """ Cache a policy response along with its ETag and normalized digest
+
+        :param response: A successful response whose body is the current policy
+
+        """
+
+        self._acl_cache = {
+            'etag': response.headers.get('ETag'),
+            'digest': _policy_digest(response.content),
+            'response': response,
+        }
+
+
     def preview_acl_rules(self, policy_json, acl_type, preview_for):
         """ Preview which rules in a policy file apply to a specific resource.
 
@@ -93,11 +936,65 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/acl/preview?type={acl_type}&previewFor={preview_for}'
-        response = requests.post(url, auth=self._auth, headers=self._headers, data=policy_json)
+        response = self._request('post', url, data=policy_json)
 
         return response
 
 
+    def preview_acl_rules_many(self, policy_json, users=None, ipports=None, max_workers=8):
+        """ Preview which rules in a policy file apply to many users and IP:port pairs.
+
+            Duplicate entries are previewed once and the previews run concurrently.
+            Successful results are cached against the normalized policy, so calling this
+            again with an unchanged policy only issues requests for new entries. A preview
+            that raises (a dropped connection, a timeout) does not stop the others.
+
+        :param policy_json: The policy file content (binary/HuJSON) to preview
+        :param users: Optional iterable of user emails to preview
+        :param ipports: Optional iterable of IP:port strings to preview
+        :param max_workers: Maximum number of previews to run at once
+
+        :return: A dict with 'user' and 'ipport' keys, each mapping an entry to its requests
+            response object, and an 'errors' key mapping each (type, entry) pair whose preview
+            raised to the exception; those entries are left out of 'user' and 'ipport'
+
+        """
+
+        digest = _policy_digest(policy_json)
+        if self._acl_preview_cache['digest'] != digest:
+            self._acl_preview_cache = {'digest': digest, 'results': {}}
+        cached = self._acl_preview_cache['results']
+
+        wanted = ([('user', user) for user in dict.fromkeys(users or ())] +
+                  [('ipport', ipport) for ipport in dict.fromkeys(ipports or ())])
+        missing = [entry for entry in wanted if entry not in cached]
+
+        fetched, errors = {}, {}
+        for result in self._bulk(lambda entry: self.preview_acl_rules(policy_json, *entry), missing, max_workers):
+            if result.error is not None:
+                errors[result.item] = result.error
+                continue
+            fetched[result.item] = result.response
+            if result.response.status_code == 200:
+                cached[result.item] = result.response
+
+        results = {'user': {}, 'ipport': {}, 'errors': errors}
+        for entry in wanted:
+            acl_type, preview_for = entry
+            if entry in errors:
+                continue
+            if entry in fetched:
+                results[acl_type][preview_for] = fetched[entry]
+            else:
+                results[acl_type][preview_for] = cached[entry]
+                if self._hooks:
+                    url = (f'{self._base_url}/tailnet/{self._tailnet}/acl/preview'
+                           f'?type={acl_type}&previewFor={preview_for}')
+                    self._emit('post', url, response=cached[entry], cache='hit')
+
+        return results
+
+
     # ---------------------------------------------------------------------------
     # Device methods
     # ---------------------------------------------------------------------------
@@ -110,7 +1007,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/devices'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -125,7 +1022,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -140,7 +1037,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -159,7 +1056,7 @@ class Tailscale:
 
         url = f'{self._base_url}/device/{device_id}/authorized'
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={"authorized": True})
+        response = self._request('post', url, json={"authorized": True})
 
         return(response)
 
@@ -174,7 +1071,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/expire'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -190,7 +1087,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/name'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={'name': name})
+        response = self._request('post', url, json={'name': name})
 
         return response
 
@@ -206,8 +1103,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/key'
-        response = requests.post(url, auth=self._auth, headers=self._headers,
-                                 json={'keyExpiryDisabled': key_expiry_disabled})
+        response = self._request('post', url, json={'keyExpiryDisabled': key_expiry_disabled})
 
         return response
 
@@ -223,7 +1119,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/ip'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={'ipv4': ipv4})
+        response = self._request('post', url, json={'ipv4': ipv4})
 
         return response
 
@@ -244,7 +1140,7 @@ class Tailscale:
 
         url = f'{self._base_url}/device/{device_id}/tags'
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={"tags": tags})
+        response = self._request('post', url, json={"tags": tags})
 
         return(response)
 
@@ -265,7 +1161,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/routes'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -283,7 +1179,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/routes'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={'routes': routes})
+        response = self._request('post', url, json={'routes': routes})
 
         return response
 
@@ -302,7 +1198,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/attributes'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -327,7 +1223,7 @@ class Tailscale:
         if comment is not None:
             body['comment'] = comment
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('post', url, json=body)
 
         return response
 
@@ -343,7 +1239,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/attributes/{attribute_key}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -363,7 +1259,7 @@ class Tailscale:
         if comment is not None:
             body['comment'] = comment
 
-        response = requests.patch(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('patch', url, json=body)
 
         return response
 
@@ -382,7 +1278,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/device-invites'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -401,11 +1297,31 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device/{device_id}/device-invites'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=invites)
+        response = self._request('post', url, json=invites)
 
         return response
 
 
+    def create_device_invites_many(self, device_id, invites, chunk_size=100, concurrency=None):
+        """ Create many share invites for a device in concurrent chunks, isolating invalid entries.
+
+            Invites are sent chunk_size at a time, several chunks at once. A chunk the API
+            rejects is split in half until the invalid entries are isolated, so one bad
+            entry does not fail the rest. A throttled chunk is sent again later.
+
+        :param device_id: ID of the device to share
+        :param invites: Iterable of invite dicts, as for create_device_invites
+        :param chunk_size: Most invites sent in one request
+        :param concurrency: Maximum number of requests at once, or an AdaptiveConcurrency (default: adaptive)
+
+        :return: An InviteReport(created, failed) tuple
+
+        """
+
+        return self._create_invites_many(lambda chunk: self.create_device_invites(device_id, chunk),
+                                         invites, chunk_size, concurrency)
+
+
     def get_device_invite(self, device_invite_id):
         """ Retrieve a specific device invite.
 
@@ -416,7 +1332,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device-invites/{device_invite_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -431,7 +1347,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device-invites/{device_invite_id}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -446,7 +1362,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device-invites/{device_invite_id}/resend'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -461,7 +1377,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/device-invites/-/accept'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={'invite': invite})
+        response = self._request('post', url, json={'invite': invite})
 
         return response
 
@@ -479,7 +1395,7 @@ class Tailscale:
         :return: The requests response object
 
         """
-        import warnings
+
         warnings.warn(
             "get_keys() is deprecated; use get_authorization_keys() instead.",
             DeprecationWarning,
@@ -498,7 +1414,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/keys/{key_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -513,7 +1429,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/keys'
 
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return(response)
 
@@ -543,7 +1459,7 @@ class Tailscale:
         if description is not None:
             body['description'] = description
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('post', url, json=body)
 
         return response
 
@@ -558,7 +1474,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/keys/{key_id}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -596,7 +1512,7 @@ class Tailscale:
         if custom_claim_rules is not None:
             body['customClaimRules'] = custom_claim_rules
 
-        response = requests.put(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('put', url, json=body)
 
         return response
 
@@ -617,7 +1533,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/nameservers'
 
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return(response)
 
@@ -644,7 +1560,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/nameservers'
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=nameservers_data)
+        response = self._request('post', url, json=nameservers_data)
 
         return(response)
 
@@ -661,7 +1577,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/preferences'
 
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return(response)
 
@@ -687,7 +1603,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/preferences'
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=dns_preferences_data)
+        response = self._request('post', url, json=dns_preferences_data)
 
         return(response)
 
@@ -704,7 +1620,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/searchpaths'
 
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return(response)
 
@@ -725,7 +1641,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/searchpaths'
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=dns_searchpaths_data)
+        response = self._request('post', url, json=dns_searchpaths_data)
 
         return(response)
 
@@ -738,7 +1654,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/split-dns'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -754,7 +1670,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/split-dns'
-        response = requests.patch(url, auth=self._auth, headers=self._headers, json=split_dns)
+        response = self._request('patch', url, json=split_dns)
 
         return response
 
@@ -770,7 +1686,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/split-dns'
-        response = requests.put(url, auth=self._auth, headers=self._headers, json=split_dns)
+        response = self._request('put', url, json=split_dns)
 
         return response
 
@@ -783,7 +1699,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/dns/configuration'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -811,11 +1727,81 @@ class Tailscale:
         if preferences is not None:
             body['preferences'] = preferences
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('post', url, json=body)
 
         return response
 
 
+    def apply_dns_configuration(self, nameservers=None, split_dns=None, search_paths=None, preferences=None):
+        """ Bring the DNS configuration to the desired state using only the writes needed.
+
+            The current configuration is read once with get_dns_configuration and compared
+            with the desired state. Sections left as None are not managed. Nameservers and
+            search paths are written only when they differ, split DNS changes are sent as a
+            single update_split_dns PATCH, and a MagicDNS change uses set_dns_preferences.
+            Changes to other preferences have no dedicated endpoint, so in that case the
+            merged configuration is written with one set_dns_configuration call instead.
+
+        :param nameservers: Optional list of global DNS nameserver addresses
+        :param split_dns: Optional dict mapping domains to nameserver lists. Domains not
+            listed are removed
+        :param search_paths: Optional list of DNS search domain strings
+        :param preferences: Optional dict of preferences to enforce (e.g. {'magicDNS': True}).
+            Keys not listed are left as they are
+
+        :return: A list of (method name, requests response object) tuples for each write made.
+            If reading the current configuration fails, the list holds that read instead
+
+        """
+
+        current = self.get_dns_configuration()
+        if current.status_code != 200:
+            return [('get_dns_configuration', current)]
+        config = current.json()
+
+        current_nameservers = _nameserver_addresses(config.get('nameservers'))
+        current_split_dns = {domain: _nameserver_addresses(ns)
+                             for domain, ns in (config.get('splitDNS') or {}).items() if ns}
+        current_preferences = config.get('preferences') or {}
+
+        nameservers_changed = (nameservers is not None and
+                               _nameserver_addresses(nameservers) != current_nameservers)
+        search_paths_changed = (search_paths is not None and
+                                list(search_paths) != list(config.get('searchPaths') or ()))
+
+        split_dns_patch = {}
+        if split_dns is not None:
+            desired_split_dns = {domain: _nameserver_addresses(ns) for domain, ns in split_dns.items() if ns}
+            split_dns_patch = {domain: ns for domain, ns in desired_split_dns.items()
+                               if current_split_dns.get(domain) != ns}
+            split_dns_patch.update({domain: None for domain in current_split_dns
+                                    if domain not in desired_split_dns})
+
+        preferences_patch = {key: value for key, value in (preferences or {}).items()
+                             if current_preferences.get(key) != value}
+
+        if set(preferences_patch) - {'magicDNS'}:
+            response = self.set_dns_configuration(
+                nameservers=nameservers if nameservers is not None else config.get('nameservers') or [],
+                split_dns=split_dns if split_dns is not None else config.get('splitDNS') or {},
+                search_paths=search_paths if search_paths is not None else config.get('searchPaths') or [],
+                preferences={**current_preferences, **preferences_patch},
+            )
+            return [('set_dns_configuration', response)]
+
+        writes = []
+        if nameservers_changed:
+            writes.append(('set_nameservers', self.set_nameservers(_nameserver_addresses(nameservers))))
+        if search_paths_changed:
+            writes.append(('set_dns_searchpaths', self.set_dns_searchpaths(list(search_paths))))
+        if split_dns_patch:
+            writes.append(('update_split_dns', self.update_split_dns(split_dns_patch)))
+        if preferences_patch:
+            writes.append(('set_dns_preferences', self.set_dns_preferences(preferences_patch['magicDNS'])))
+
+        return writes
+
+
     # ---------------------------------------------------------------------------
     # Logs methods
     # ---------------------------------------------------------------------------
@@ -837,7 +1823,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/logs?start={starttime}&end={endtime}'
 
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -866,7 +1852,7 @@ class Tailscale:
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/network-logs?start={starttime}&end={endtime}'
 
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -881,7 +1867,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/logging/{log_type}/stream/status'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -896,7 +1882,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/logging/{log_type}/stream'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -921,7 +1907,7 @@ class Tailscale:
         if token is not None:
             body['token'] = token
 
-        response = requests.put(endpoint_url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('put', endpoint_url, json=body)
 
         return response
 
@@ -936,7 +1922,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/logging/{log_type}/stream'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -955,7 +1941,7 @@ class Tailscale:
         if reusable is not None:
             body['reusable'] = reusable
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('post', url, json=body)
 
         return response
 
@@ -971,7 +1957,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/aws-external-id/{external_id}/validate-aws-trust-policy'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={'roleArn': role_arn})
+        response = self._request('post', url, json={'roleArn': role_arn})
 
         return response
 
@@ -980,7 +1966,8 @@ class Tailscale:
     # OAuth token support
     # ---------------------------------------------------------------------------
 
-    def get_oauth_token(self, client_id, client_secret, client_embed=True):
+    def get_oauth_token(self, client_id, client_secret, client_embed=True, auto_refresh=False,
+                        scopes=None, token_cache=None):
         """
         Use a static oauth client id and secret to generate scoped API tokens
 
@@ -989,12 +1976,30 @@ class Tailscale:
         You can also update the client's self._auth value with the returned token
         by setting client_embed = True
 
+        With auto_refresh the client also keeps the credentials and the token's expiry.
+        A background timer fetches a new token shortly before the current one expires,
+        requests made with an expiring token refresh it first, and a request that gets a
+        401 is retried once after a refresh. Concurrent refreshes are collapsed into one.
+        A refresh that fails keeps the current token, warns with a RuntimeWarning and is
+        retried after a delay that doubles with each failure.
+        Call close() to stop the background timer.
+
+        With a token_cache (see tailscale_agent.token_cache) the token is shared with
+        other clients using the same cache, keyed by client_id and scopes. A valid cached
+        token is used without contacting the API, and the cache lock ensures only one
+        client or process exchanges credentials when it needs replacing.
+
         :param client_id: The OAuth Client ID you generated via the TailScale dashboard
         :param client_secret: The OAuth Client Secret associated with the Client ID above
         :param client_embed: "Should we embed the returned token into the client object
             for subsequent
+        :param auto_refresh: If True (and client_embed is True), keep the token fresh automatically
+        :param scopes: Optional list of scopes to request, narrowing those of the OAuth client
+        :param token_cache: Optional MemoryTokenCache or FileTokenCache to share tokens through.
+            It is remembered for later refreshes
 
-        :return: requests response object
+        :return: requests response object. For a token served from the cache this is a
+            synthesized 200 response with the cached token as its body
 
         """
 
@@ -1002,26 +2007,126 @@ class Tailscale:
             "client_id": client_id,
             "client_secret": client_secret
         }
+        if scopes:
+            oauth_client_data['scope'] = ' '.join(scopes)
 
         url = f'{self._base_url}/oauth/token'
 
-        response = requests.post(url, headers=self._headers, data=oauth_client_data)
+        if token_cache is not None:
+            self._token_cache = token_cache
+
+        started = time.perf_counter() if self._hooks else None
+        if self._start_hooks:
+            self._notify_start('post', url)
+        cache = None
+        if client_embed and self._token_cache is not None:
+            from tailscale_agent.token_cache import token_cache_key
+
+            cache_key = token_cache_key(client_id, scopes)
+            with self._token_cache.lock(cache_key):
+                token = self._token_cache.get(cache_key)
+                # The cached token is reused unless it is the one being replaced
+                if token is not None and token['access_token'] != self._api_key:
+                    response = _token_response(url, token)
+                    cache = 'hit'
+                else:
+                    response = self._send('post', url, headers=self._headers, data=oauth_client_data)
+                    cache = 'miss'
+                    if response.status_code == 200:
+                        try:
+                            self._token_cache.put(cache_key, response.json())
+                        except ValueError:
+                            pass
+        else:
+            response = self._send('post', url, headers=self._headers, data=oauth_client_data)
+
+        if self._hooks:
+            self._emit('post', url, started, response, cache=cache)
 
         if not client_embed:
             return response
 
         try:
-            access_token = response.json()['access_token']
+            token = response.json()
+            access_token = token['access_token']
             self._api_key = access_token
-            self._auth = HTTPBasicAuth(access_token, '')
-        except (KeyError, ValueError):
-            print('I was not able to set the access token.')
-            print('Please ensure you have your OAuth client set '
-                  'correctly and it has the necessary permissions.')
+            self._auth = _BasicAuth(access_token)
+        except (KeyError, TypeError, ValueError):
+            if not auto_refresh:
+                print('I was not able to set the access token.')
+                print('Please ensure you have your OAuth client set '
+                      'correctly and it has the necessary permissions.')
+                return response
+
+            # Keep the current token and try again later, rather than before every request
+            delay = min(_OAUTH_RETRY_DELAY * 2 ** self._token_failures, _OAUTH_MAX_RETRY_DELAY)
+            self._token_failures += 1
+            self._token_refresh_at = time.monotonic() + delay
+            self._oauth_credentials = (client_id, client_secret, scopes)
+            self._schedule_token_refresh(delay)
+            warnings.warn(f'OAuth token refresh failed with status {response.status_code}; '
+                          f'retrying in {delay}s', RuntimeWarning, stacklevel=2)
+            return response
+
+        self._token_failures = 0
+        expires_in = token.get('expires_in')
+        refresh_in = None
+        if expires_in:
+            refresh_in = max(expires_in - min(_OAUTH_REFRESH_MARGIN, expires_in / 4), 0)
+            self._token_refresh_at = time.monotonic() + refresh_in
+        else:
+            self._token_refresh_at = None
+
+        if auto_refresh:
+            self._oauth_credentials = (client_id, client_secret, scopes)
+            self._schedule_token_refresh(refresh_in)
 
         return response
 
 
+    def _schedule_token_refresh(self, delay):
+        """ (Re)start the background timer that refreshes the OAuth token
+
+        :param delay: Seconds until the refresh, or None to only cancel the current timer
+
+        """
+
+        if self._token_timer is not None:
+            self._token_timer.cancel()
+            self._token_timer = None
+
+        if delay is None:
+            return
+
+        self._token_timer = threading.Timer(delay, self._refresh_oauth_token, args=(self._api_key,))
+        self._token_timer.daemon = True
+        self._token_timer.start()
+
+
+    def _refresh_oauth_token(self, stale_key):
+        """ Replace the OAuth token, unless another thread already replaced stale_key
+
+            After a failed exchange nothing is tried until its backoff has passed, so a
+            rejected request is returned to the caller instead of asking for a token again.
+
+        :param stale_key: The token the caller found to be expiring or rejected
+
+        :return: True if the client now holds a different token than stale_key
+
+        """
+
+        with self._token_lock:
+            if self._token_failures and self._token_refresh_at is not None \
+                    and time.monotonic() < self._token_refresh_at:
+                return self._api_key != stale_key
+            if self._api_key == stale_key and self._oauth_credentials is not None:
+                client_id, client_secret, scopes = self._oauth_credentials
+                self.get_oauth_token(client_id, client_secret, client_embed=True, auto_refresh=True,
+                                     scopes=scopes)
+
+            return self._api_key != stale_key
+
+
     # ---------------------------------------------------------------------------
     # Tailnet Settings methods
     # ---------------------------------------------------------------------------
@@ -1034,7 +2139,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/settings'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1088,7 +2193,7 @@ class Tailscale:
         if https_enabled is not None:
             body['httpsEnabled'] = https_enabled
 
-        response = requests.patch(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('patch', url, json=body)
 
         return response
 
@@ -1105,7 +2210,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/contacts'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1121,7 +2226,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/contacts/{contact_type}'
-        response = requests.patch(url, auth=self._auth, headers=self._headers, json={'email': email})
+        response = self._request('patch', url, json={'email': email})
 
         return response
 
@@ -1136,7 +2241,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/contacts/{contact_type}/resend-verification-email'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -1153,7 +2258,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/posture/integrations'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1179,7 +2284,7 @@ class Tailscale:
         if tenant_id is not None:
             body['tenantId'] = tenant_id
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('post', url, json=body)
 
         return response
 
@@ -1194,7 +2299,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/posture/integrations/{integration_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1224,7 +2329,7 @@ class Tailscale:
         if tenant_id is not None:
             body['tenantId'] = tenant_id
 
-        response = requests.patch(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('patch', url, json=body)
 
         return response
 
@@ -1239,7 +2344,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/posture/integrations/{integration_id}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -1256,7 +2361,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/users'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1270,7 +2375,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/users/{user_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1290,7 +2395,7 @@ class Tailscale:
 
         url = f'{self._base_url}/users/{user_id}/role'
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json={"role": role})
+        response = self._request('post', url, json={"role": role})
 
         return response
 
@@ -1305,7 +2410,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/users/{user_id}/approve'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -1320,7 +2425,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/users/{user_id}/suspend'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -1335,7 +2440,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/users/{user_id}/restore'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -1350,11 +2455,95 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/users/{user_id}/delete'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
 
+    def update_user_roles(self, roles, concurrency=None):
+        """ Update the roles of many users concurrently.
+
+            The calls are made as the returned generator is iterated, so nothing is sent
+            until it is consumed; use list() to make every call and keep the results.
+
+        :param roles: Mapping of user ID to role, or an iterable of (user_id, role) pairs
+        :param concurrency: Maximum number of calls at once, or an AdaptiveConcurrency that raises
+            it while responses are fast and backs off on 429s (default: adaptive, starting at 4)
+
+        :return: A generator of BulkResult(item, response, error) tuples, where item is the
+            (user_id, role) pair, in the order the calls complete
+
+        """
+
+        pairs = roles.items() if hasattr(roles, 'items') else roles
+
+        return self._bulk(lambda pair: self.update_user_role(*pair), pairs, concurrency)
+
+
+    def approve_users(self, user_ids, concurrency=None):
+        """ Approve many pending users concurrently.
+
+            The calls are made as the returned generator is iterated, so nothing is sent
+            until it is consumed; use list() to make every call and keep the results.
+
+        :param user_ids: Iterable of user IDs
+        :param concurrency: Maximum number of calls at once, or an AdaptiveConcurrency (default: adaptive, starting at 4)
+
+        :return: A generator of BulkResult(item, response, error) tuples in the order the calls complete
+
+        """
+
+        return self._bulk(self.approve_user, user_ids, concurrency)
+
+
+    def suspend_users(self, user_ids, concurrency=None):
+        """ Suspend many users concurrently.
+
+            The calls are made as the returned generator is iterated, so nothing is sent
+            until it is consumed; use list() to make every call and keep the results.
+
+        :param user_ids: Iterable of user IDs
+        :param concurrency: Maximum number of calls at once, or an AdaptiveConcurrency (default: adaptive, starting at 4)
+
+        :return: A generator of BulkResult(item, response, error) tuples in the order the calls complete
+
+        """
+
+        return self._bulk(self.suspend_user, user_ids, concurrency)
+
+
+    def restore_users(self, user_ids, concurrency=None):
+        """ Restore many suspended users concurrently.
+
+            The calls are made as the returned generator is iterated, so nothing is sent
+            until it is consumed; use list() to make every call and keep the results.
+
+        :param user_ids: Iterable of user IDs
+        :param concurrency: Maximum number of calls at once, or an AdaptiveConcurrency (default: adaptive, starting at 4)
+
+        :return: A generator of BulkResult(item, response, error) tuples in the order the calls complete
+
+        """
+
+        return self._bulk(self.restore_user, user_ids, concurrency)
+
+
+    def delete_users(self, user_ids, concurrency=None):
+        """ Delete many users concurrently.
+
+            The calls are made as the returned generator is iterated, so nothing is sent
+            until it is consumed; use list() to make every call and keep the results.
+
+        :param user_ids: Iterable of user IDs
+        :param concurrency: Maximum number of calls at once, or an AdaptiveConcurrency (default: adaptive, starting at 4)
+
+        :return: A generator of BulkResult(item, response, error) tuples in the order the calls complete
+
+        """
+
+        return self._bulk(self.delete_user, user_ids, concurrency)
+
+
     # ---------------------------------------------------------------------------
     # User Invite methods
     # ---------------------------------------------------------------------------
@@ -1367,7 +2556,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/user-invites'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1384,11 +2573,106 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/user-invites'
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=invites)
+        response = self._request('post', url, json=invites)
 
         return response
 
 
+    def create_user_invites_many(self, invites, chunk_size=100, concurrency=None):
+        """ Create many user invites in concurrent chunks, isolating invalid entries.
+
+            Invites are sent chunk_size at a time, several chunks at once. A chunk the API
+            rejects is split in half until the invalid entries are isolated, so one bad
+            entry does not fail the rest. A throttled chunk is sent again later.
+
+        :param invites: Iterable of invite dicts, as for create_user_invites
+        :param chunk_size: Most invites sent in one request
+        :param concurrency: Maximum number of requests at once, or an AdaptiveConcurrency (default: adaptive)
+
+        :return: An InviteReport(created, failed) tuple
+
+        """
+
+        return self._create_invites_many(self.create_user_invites, invites, chunk_size, concurrency)
+
+
+    def _create_invites_many(self, create, invites, chunk_size, concurrency):
+        """ Send invites in chunks concurrently, bisecting failed chunks down to the entries that fail
+
+            The API rejects a whole request with a 400 when one entry is invalid, so a
+            chunk rejected that way is split in half and each half is sent again, until the
+            invalid entries are sent on their own. A chunk still throttled after the client's
+            own retries is sent again later, up to _INVITE_CHUNK_RETRIES times. Any other
+            failure (an auth error, a missing device, a dropped connection) would fail every
+            entry alike, so it fails the whole chunk without splitting it.
+
+            Every request, halves and retries included, is one item of the bulk runner, so
+            each response (a 429 in particular) adjusts the concurrency.
+
+        :param create: Function that creates a list of invites in one request
+        :param invites: Iterable of invite dicts
+        :param chunk_size: Most invites sent in one request
+        :param concurrency: Maximum number of requests at once, or an AdaptiveConcurrency
+
+        :return: An InviteReport(created, failed) tuple
+
+        """
+
+        import queue
+
+        invites = list(invites)
+        work = queue.SimpleQueue()
+        outstanding = 0
+        for start in range(0, len(invites), chunk_size):
+            work.put((start, invites[start:start + chunk_size], 0, 0.0))
+            outstanding += 1
+        if not outstanding:
+            return InviteReport([], [])
+
+        def pending():
+            # Ends when the consumer below has settled every chunk and posts None
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                delay = item[3] - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                yield item
+
+        outcomes = {}
+        try:
+            for result in self._bulk(lambda item: create(item[1]), pending(), concurrency):
+                start, chunk, retries, _ = result.item
+                response = result.response
+                status = response.status_code if response is not None else None
+                if status == 200:
+                    outcomes[start] = (response.json(), [])
+                elif status == 429 and retries < _INVITE_CHUNK_RETRIES:
+                    work.put((start, chunk, retries + 1, time.monotonic() + _retry_delay(response, retries)))
+                    outstanding += 1
+                elif status in (400, 422) and len(chunk) > 1:
+                    middle = len(chunk) // 2
+                    work.put((start, chunk[:middle], retries, 0.0))
+                    work.put((start + middle, chunk[middle:], retries, 0.0))
+                    outstanding += 2
+                else:
+                    outcomes[start] = ([], [BulkResult(entry, response, result.error) for entry in chunk])
+                outstanding -= 1
+                if not outstanding:
+                    work.put(None)
+        finally:
+            # Lets the feeder finish even if reading a response raised
+            work.put(None)
+
+        created, failed = [], []
+        for start in sorted(outcomes):
+            created.extend(outcomes[start][0])
+            failed.extend(outcomes[start][1])
+
+        return InviteReport(created, failed)
+
+
     def get_user_invite(self, user_invite_id):
         """ Retrieve a specific user invite.
 
@@ -1399,7 +2683,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/user-invites/{user_invite_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1414,7 +2698,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/user-invites/{user_invite_id}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -1429,7 +2713,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/user-invites/{user_invite_id}/resend'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -1446,7 +2730,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/tailnet/{self._tailnet}/webhooks'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1467,7 +2751,7 @@ class Tailscale:
         if provider_type is not None:
             body['providerType'] = provider_type
 
-        response = requests.post(url, auth=self._auth, headers=self._headers, json=body)
+        response = self._request('post', url, json=body)
 
         return response
 
@@ -1482,7 +2766,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/webhooks/{endpoint_id}'
-        response = requests.get(url, auth=self._auth, headers=self._headers)
+        response = self._request('get', url)
 
         return response
 
@@ -1498,8 +2782,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/webhooks/{endpoint_id}'
-        response = requests.patch(url, auth=self._auth, headers=self._headers,
-                                  json={'subscriptions': subscriptions})
+        response = self._request('patch', url, json={'subscriptions': subscriptions})
 
         return response
 
@@ -1514,7 +2797,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/webhooks/{endpoint_id}'
-        response = requests.delete(url, auth=self._auth, headers=self._headers)
+        response = self._request('delete', url)
 
         return response
 
@@ -1529,7 +2812,7 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/webhooks/{endpoint_id}/rotate'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
 
@@ -1544,6 +2827,6 @@ class Tailscale:
         """
 
         url = f'{self._base_url}/webhooks/{endpoint_id}/test'
-        response = requests.post(url, auth=self._auth, headers=self._headers)
+        response = self._request('post', url)
 
         return response
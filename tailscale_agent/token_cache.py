@@ -0,0 +1,238 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to locking within the process only
+    fcntl = None
+
+
+def token_cache_key(client_id, scopes=None):
+    """ Build the cache key for an OAuth client and the scopes it requested
+
+    :param client_id: The OAuth client ID
+    :param scopes: Optional list of requested scopes
+
+    :return: The cache key string
+
+    """
+
+    return f'{client_id}:{" ".join(sorted(scopes or ()))}'
+
+
+def _cache_entry(token):
+    """ Turn a token response body into a cache entry with an absolute expiry
+
+    :param token: The decoded JSON body of an OAuth token response
+
+    :return: The entry dict, or None if the token does not say when it expires
+
+    """
+
+    if not token.get('access_token') or not token.get('expires_in'):
+        return None
+
+    entry = dict(token)
+    entry['expires_at'] = time.time() + token['expires_in']
+
+    return entry
+
+
+def _cached_token(entry, min_ttl):
+    """ Return a cached token with expires_in rebased to now, or None if it is (nearly) expired
+
+    :param entry: A cache entry created by _cache_entry
+    :param min_ttl: Minimum remaining lifetime in seconds for the token to be usable
+
+    :return: The token dict, or None
+
+    """
+
+    if entry is None:
+        return None
+
+    remaining = entry['expires_at'] - time.time()
+    if remaining < min_ttl:
+        return None
+
+    token = {k: v for k, v in entry.items() if k != 'expires_at'}
+    token['expires_in'] = int(remaining)
+
+    return token
+
+
+class _KeyedLocks:
+    """ A lazily created threading.Lock per key """
+
+    def __init__(self):
+
+        self._locks = {}
+        self._guard = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def hold(self, key):
+
+        with self._guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            yield
+
+
+class MemoryTokenCache:
+    """ OAuth token cache shared by the clients of a single process """
+
+    def __init__(self, min_ttl=60):
+        """ Constructor for the MemoryTokenCache class
+
+        :param min_ttl: Tokens with less than this many seconds left are treated as missing
+
+        """
+
+        self._min_ttl = min_ttl
+        self._entries = {}
+        self._locks = _KeyedLocks()
+
+
+    def get(self, key):
+        """ Get a usable token for key
+
+        :param key: The cache key (see token_cache_key)
+
+        :return: The token dict with a current expires_in, or None
+
+        """
+
+        return _cached_token(self._entries.get(key), self._min_ttl)
+
+
+    def put(self, key, token):
+        """ Store a token response body under key
+
+        :param key: The cache key (see token_cache_key)
+        :param token: The decoded JSON body of an OAuth token response
+
+        """
+
+        entry = _cache_entry(token)
+        if entry is not None:
+            self._entries[key] = entry
+
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """ Hold the lock for key so only one caller refreshes its token
+
+        :param key: The cache key (see token_cache_key)
+
+        """
+
+        with self._locks.hold(key):
+            yield
+
+
+class FileTokenCache:
+    """ OAuth token cache shared by every process on a host through files in a directory
+
+        Each key is stored in its own JSON file, written atomically with owner-only
+        permissions. A lock file per key, held with flock, makes sure only one process
+        exchanges credentials while the others wait and then reuse its token.
+
+    """
+
+    def __init__(self, directory=None, min_ttl=60):
+        """ Constructor for the FileTokenCache class
+
+        :param directory: Directory to keep the token files in. Defaults to
+            $XDG_CACHE_HOME/tailscale_agent/tokens (or ~/.cache/tailscale_agent/tokens)
+        :param min_ttl: Tokens with less than this many seconds left are treated as missing
+
+        """
+
+        if directory is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            directory = os.path.join(cache_home, 'tailscale_agent', 'tokens')
+
+        self._directory = directory
+        self._min_ttl = min_ttl
+        self._thread_locks = _KeyedLocks()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+
+    def __repr__(self):
+
+        return f'FileTokenCache(directory={self._directory})'
+
+
+    def _path(self, key, suffix):
+
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self._directory, f'{name}{suffix}')
+
+
+    def get(self, key):
+        """ Get a usable token for key
+
+        :param key: The cache key (see token_cache_key)
+
+        :return: The token dict with a current expires_in, or None
+
+        """
+
+        try:
+            with open(self._path(key, '.json')) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(entry, dict) or 'expires_at' not in entry:
+            return None
+
+        return _cached_token(entry, self._min_ttl)
+
+
+    def put(self, key, token):
+        """ Store a token response body under key
+
+        :param key: The cache key (see token_cache_key)
+        :param token: The decoded JSON body of an OAuth token response
+
+        """
+
+        entry = _cache_entry(token)
+        if entry is None:
+            return
+
+        path = self._path(key, '.json')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """ Hold the lock for key across threads and processes
+
+        :param key: The cache key (see token_cache_key)
+
+        """
+
+        with self._thread_locks.hold(key):
+            if fcntl is None:
+                yield
+                return
+
+            fd = os.open(self._path(key, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
@@ -0,0 +1,220 @@
+"""
+Transports: what a Tailscale client sends its HTTP requests through.
+
+A transport is any object with a requests.Session-style method
+
+    request(method, url, auth=None, headers=None, json=None, data=None, **kwargs)
+
+that returns a requests.Response. Pass one to Tailscale(..., transport=...).
+Without one the client uses the requests library directly.
+
+- RequestsTransport: a pooled requests.Session with an optional default timeout
+- Urllib3Transport: a urllib3.PoolManager, skipping the requests machinery
+- MemoryTransport: calls an in-process handler (such as a FakeTailscaleAPI) directly,
+  so tests and benchmarks measure the client without any network or HTTP parsing
+
+Sessions built on these (RecordingSession, ReplaySession) follow the same interface.
+"""
+
+import json as jsonlib
+import time
+
+from datetime import timedelta
+from urllib.parse import urlencode, urlsplit
+
+
+class _Prepared:
+    """ The request as seen by an auth callable: something with a headers dict """
+
+    def __init__(self, headers):
+
+        self.headers = headers
+
+
+def _encode_request(headers, auth, json, data):
+    """ Build the headers and body for a request the way requests would
+
+    :return: A (headers dict, body bytes or None) tuple
+
+    """
+
+    headers = dict(headers or {})
+    if auth is not None:
+        auth(_Prepared(headers))
+
+    body = None
+    if json is not None:
+        body = jsonlib.dumps(json).encode('utf-8')
+        headers.setdefault('Content-Type', 'application/json')
+    elif isinstance(data, dict):
+        body = urlencode(data).encode('utf-8')
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+    elif isinstance(data, str):
+        body = data.encode('utf-8')
+    elif data is not None:
+        body = data
+
+    return headers, body
+
+
+def _build_response(method, url, request_headers, body, status, headers, content, elapsed, reason=None):
+    """ Wrap a raw HTTP result in a requests response object
+
+    :return: The requests response object
+
+    """
+
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    prepared = requests.PreparedRequest()
+    prepared.method = method.upper()
+    prepared.url = url
+    prepared.headers = CaseInsensitiveDict(request_headers)
+    prepared.body = body
+
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = content
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.reason = reason
+    response.url = url
+    response.request = prepared
+    response.elapsed = timedelta(seconds=elapsed)
+
+    return response
+
+
+class RequestsTransport:
+    """ Send requests through a pooled requests.Session """
+
+    def __init__(self, pool_maxsize=10, timeout=None, session=None):
+        """ Constructor for the RequestsTransport class
+
+        :param pool_maxsize: Number of connections to keep open per host
+        :param timeout: Optional default timeout in seconds for requests that do not set one
+        :param session: Optional existing requests.Session to use instead of a new one
+
+        """
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+        self.session = session
+        self._timeout = timeout
+
+
+    def __repr__(self):
+
+        return f'RequestsTransport(timeout={self._timeout})'
+
+
+    def request(self, method, url, **kwargs):
+
+        if self._timeout is not None:
+            kwargs.setdefault('timeout', self._timeout)
+
+        return self.session.request(method, url, **kwargs)
+
+
+    def close(self):
+
+        self.session.close()
+
+
+class Urllib3Transport:
+    """ Send requests through a urllib3.PoolManager
+
+        urllib3 is already installed as a dependency of requests. Going to it directly
+        avoids the per-request work requests does (hooks, cookies, environment proxy
+        and certificate lookups), which matters for many small calls.
+
+    """
+
+    def __init__(self, pool_maxsize=10, timeout=None, **pool_kwargs):
+        """ Constructor for the Urllib3Transport class
+
+        :param pool_maxsize: Number of connections to keep open per host
+        :param timeout: Optional default timeout in seconds for requests that do not set one
+        :param pool_kwargs: Extra arguments for urllib3.PoolManager (e.g. ca_certs)
+
+        """
+
+        import urllib3
+
+        self._pool = urllib3.PoolManager(maxsize=pool_maxsize, retries=False, **pool_kwargs)
+        self._timeout = timeout
+
+
+    def __repr__(self):
+
+        return f'Urllib3Transport(timeout={self._timeout})'
+
+
+    def request(self, method, url, auth=None, headers=None, json=None, data=None, timeout=None, **kwargs):
+
+        request_headers, body = _encode_request(headers, auth, json, data)
+        timeout = timeout if timeout is not None else self._timeout
+
+        started = time.perf_counter()
+        raw = self._pool.request(method.upper(), url, body=body, headers=request_headers,
+                                 timeout=timeout, redirect=False)
+        elapsed = time.perf_counter() - started
+
+        return _build_response(method, url, request_headers, body, raw.status, raw.headers, raw.data,
+                               elapsed, raw.reason)
+
+
+    def close(self):
+
+        self._pool.clear()
+
+
+class MemoryTransport:
+    """ Hand requests straight to an in-process handler instead of sending them
+
+        The handler is called as handler(method, path, headers, body), where path
+        includes the query string, and returns a (status, headers, body bytes) tuple.
+        A FakeTailscaleAPI (which does not need to be started) can be passed directly.
+
+    """
+
+    def __init__(self, handler):
+        """ Constructor for the MemoryTransport class
+
+        :param handler: The handler callable, or an object with such a handle method
+
+        """
+
+        self._handler = getattr(handler, 'handle', handler)
+
+
+    def __repr__(self):
+
+        return f'MemoryTransport(handler={self._handler!r})'
+
+
+    def request(self, method, url, auth=None, headers=None, json=None, data=None, **kwargs):
+
+        request_headers, body = _encode_request(headers, auth, json, data)
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+
+        started = time.perf_counter()
+        status, response_headers, content = self._handler(method.upper(), path, request_headers, body or b'')
+        elapsed = time.perf_counter() - started
+
+        return _build_response(method, url, request_headers, body, status, response_headers, content, elapsed)
+
+
+    def close(self):
+
+        pass
@@ -0,0 +1,603 @@
+"""
+Receive Tailscale webhook events.
+
+Tailscale POSTs events to a webhook endpoint as a JSON array, signed with the
+endpoint's secret in the Tailscale-Webhook-Signature header (t=<unix time>,v1=<hex
+HMAC-SHA256 of "<t>.<body>">). A WebhookReceiver checks the signature in constant
+time, answers straight away, and hands the events to handler threads in batches:
+
+    def handle(events):
+        for event in events:
+            print(event['type'], event['data'])
+
+    with WebhookReceiver(secret, handle, port=8080) as receiver:
+        receiver.serve_forever()
+
+Events wait in a bounded in-process buffer. When it is full the receiver answers 503
+with Retry-After, and Tailscale delivers the events again later, so a slow handler
+slows deliveries down instead of losing events or growing memory without limit.
+GET /metrics on the same port reports counters in the Prometheus text format.
+
+Tailscale retries a delivery that was not acknowledged, and deliveries can arrive out
+of order. The receiver drops events it has already seen within dedupe_window seconds,
+and sends all events about one device or user to the same worker, sorted by timestamp
+within each batch. So one resource's events are handled one at a time and in order,
+while events about different resources are handled in parallel.
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import warnings
+
+from collections import OrderedDict, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tailscale_agent.metrics import CONTENT_TYPE, _number
+
+
+SIGNATURE_HEADER = 'Tailscale-Webhook-Signature'
+
+# How old a signature timestamp may be, in seconds, before a delivery is rejected as a replay
+DEFAULT_TOLERANCE = 300
+
+
+class SignatureError(ValueError):
+    """ A webhook delivery whose signature is missing, malformed, stale or wrong """
+
+
+def _digest(secret, timestamp, body):
+
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+
+    return hmac.new(secret, f'{timestamp}.'.encode('ascii') + body, hashlib.sha256).hexdigest()
+
+
+def sign(secret, body, timestamp=None):
+    """ Sign a webhook body the way Tailscale does (for tests and local senders)
+
+    :param secret: The webhook endpoint's secret
+    :param body: The request body as bytes
+    :param timestamp: Unix time of the signature (default: now)
+
+    :return: The Tailscale-Webhook-Signature header value
+
+    """
+
+    timestamp = int(time.time() if timestamp is None else timestamp)
+
+    return f't={timestamp},v1={_digest(secret, timestamp, body)}'
+
+
+def verify_signature(secrets, body, header, tolerance=DEFAULT_TOLERANCE, now=None):
+    """ Check a webhook delivery's signature
+
+    :param secrets: The endpoint's secret, or a list of secrets accepted while one is being rotated
+    :param body: The raw request body as bytes
+    :param header: The Tailscale-Webhook-Signature header value
+    :param tolerance: Maximum age of the signature in seconds (None to accept any age)
+    :param now: Current Unix time (default: now)
+
+    :return: The signature's timestamp
+
+    """
+
+    if isinstance(secrets, (str, bytes)):
+        secrets = [secrets]
+
+    timestamp, signatures = None, []
+    for part in (header or '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name == 't':
+            timestamp = value
+        elif name == 'v1':
+            signatures.append(value)
+    if timestamp is None or not timestamp.isdigit() or not signatures:
+        raise SignatureError(f'malformed {SIGNATURE_HEADER} header')
+
+    if tolerance is not None and abs((time.time() if now is None else now) - int(timestamp)) > tolerance:
+        raise SignatureError('signature timestamp outside the tolerance')
+
+    for secret in secrets:
+        expected = _digest(secret, timestamp, body)
+        # Compare against every signature so the time taken does not reveal which one matched
+        matched = [hmac.compare_digest(expected, signature) for signature in signatures]
+        if any(matched):
+            return int(timestamp)
+
+    raise SignatureError('signature does not match')
+
+
+def parse_events(body):
+    """ Decode a webhook body into a list of event dicts
+
+    :param body: The raw request body; an array of events, or a single event
+
+    :return: The list of events
+
+    """
+
+    events = json.loads(body)
+    if isinstance(events, dict):
+        events = [events]
+    if not isinstance(events, list) or not all(isinstance(e, dict) for e in events):
+        raise ValueError('webhook body is not a list of events')
+
+    return events
+
+
+def event_id(event):
+    """ An identifier for a webhook event that is the same in every delivery of it
+
+        Tailscale events have no ID field, so unless the event has an 'id' the
+        identifier is a digest of its content, which a retried delivery repeats.
+
+    :param event: A webhook event dict
+
+    :return: The identifier as a string
+
+    """
+
+    if event.get('id'):
+        return str(event['id'])
+
+    return hashlib.sha1(json.dumps(event, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def resource_key(event):
+    """ The device or user an event is about
+
+    :param event: A webhook event dict
+
+    :return: 'device:<nodeID>', 'user:<loginName>', or None for tailnet-wide events
+
+    """
+
+    data = event.get('data') or {}
+    if data.get('nodeID'):
+        return f'device:{data["nodeID"]}'
+    if data.get('user'):
+        return f'user:{data["user"]}'
+
+    return None
+
+
+def _timestamp(event):
+
+    try:
+        return datetime.fromisoformat(event['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class ExpiringSet:
+    """ A set of keys that forgets each key ttl seconds after it was added, holding at most max_size keys
+
+        Not thread-safe; callers hold their own lock.
+
+    """
+
+    def __init__(self, ttl, max_size=100000, clock=time.monotonic):
+        """ Constructor for the ExpiringSet class
+
+        :param ttl: Seconds a key is remembered
+        :param max_size: Most keys remembered; the oldest are forgotten first beyond it
+        :param clock: Function returning the current time in seconds
+
+        """
+
+        self._ttl = ttl
+        self._max_size = max_size
+        self._clock = clock
+        self._expiries = OrderedDict()
+
+
+    def __repr__(self):
+
+        return f'ExpiringSet(ttl={self._ttl}, max_size={self._max_size}, size={len(self._expiries)})'
+
+
+    def __len__(self):
+
+        self._expire(self._clock())
+
+        return len(self._expiries)
+
+
+    def __contains__(self, key):
+
+        expiry = self._expiries.get(key)
+
+        return expiry is not None and expiry > self._clock()
+
+
+    def add(self, key):
+        """ Remember a key
+
+        :return: True if the key was not already remembered
+
+        """
+
+        now = self._clock()
+        self._expire(now)
+        if key in self._expiries:
+            return False
+
+        self._expiries[key] = now + self._ttl
+        if len(self._expiries) > self._max_size:
+            self._expiries.popitem(last=False)
+
+        return True
+
+
+    def _expire(self, now):
+
+        # Keys are added with the same ttl, so they expire in insertion order
+        while self._expiries:
+            key, expiry = next(iter(self._expiries.items()))
+            if expiry > now:
+                break
+            del self._expiries[key]
+
+
+class WebhookReceiver:
+    """ An HTTP endpoint for Tailscale webhooks that verifies, buffers and batches events """
+
+    def __init__(self, secret, handler, host='127.0.0.1', port=0, path='/', workers=2, batch_size=100,
+                 batch_interval=0.05, max_pending=10000, tolerance=DEFAULT_TOLERANCE, retry_after=5,
+                 dedupe_window=600, dedupe_size=100000):
+        """ Constructor for the WebhookReceiver class
+
+        :param secret: The webhook secret, or a list of secrets to accept during a rotation
+        :param handler: Called as handler(events) from a worker thread with a list of up to
+            batch_size events. All events about one device or user go to the same worker
+        :param host: Address to listen on
+        :param port: Port to listen on (0 picks a free port)
+        :param path: URL path that accepts deliveries
+        :param workers: Number of handler threads
+        :param batch_size: Largest number of events passed to one handler call
+        :param batch_interval: How long in seconds a worker waits for a batch to fill up
+        :param max_pending: Most events buffered before deliveries are refused with a 503
+        :param tolerance: Maximum age in seconds of a delivery's signature
+        :param retry_after: Retry-After value in seconds sent with a 503
+        :param dedupe_window: Seconds an event is remembered, to drop repeated deliveries of it
+            (0 or None to keep duplicates)
+        :param dedupe_size: Most event IDs remembered at once
+
+        """
+
+        self._secrets = [secret] if isinstance(secret, (str, bytes)) else list(secret)
+        self._handler = handler
+        self._host = host
+        self._port = port
+        self._path = path
+        self._workers = workers
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._max_pending = max_pending
+        self._tolerance = tolerance
+        self._retry_after = retry_after
+
+        self._seen = ExpiringSet(dedupe_window, dedupe_size) if dedupe_window else None
+
+        # One queue per worker; events about a resource always go to the same one
+        self._lock = threading.Lock()
+        self._queues = [deque() for _ in range(workers)]
+        self._conditions = [threading.Condition(self._lock) for _ in range(workers)]
+        self._pending = 0
+        self._next_queue = 0
+        self._running = False
+        self._threads = []
+        self._server = None
+        self._counters = dict.fromkeys(('deliveries', 'events_received', 'events_handled', 'events_failed',
+                                        'events_duplicate', 'batches', 'rejected_signature',
+                                        'rejected_malformed', 'rejected_full'), 0)
+        self._handler_seconds = 0.0
+
+
+    def __repr__(self):
+
+        return f'WebhookReceiver(url={self.url}, workers={self._workers}, max_pending={self._max_pending})'
+
+
+    def __enter__(self):
+
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+    @property
+    def url(self):
+        """ The URL deliveries are accepted on, once started """
+
+        if self._server is None:
+            return None
+        host, port = self._server.server_address[:2]
+
+        return f'http://{host}:{port}{self._path}'
+
+
+    def start(self, serve=True):
+        """ Start the handler threads, and the HTTP server in a background thread
+
+        :param serve: Whether to listen for HTTP deliveries; without it, pass deliveries to handle()
+
+        :return: The receiver
+
+        """
+
+        self._running = True
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, args=(i,), name=f'tailscale-webhook-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        if serve:
+            self._server = _Server((self._host, self._port), _Handler)
+            self._server.receiver = self
+            threading.Thread(target=self._server.serve_forever, name='tailscale-webhook-server',
+                             daemon=True).start()
+
+        return self
+
+
+    def serve_forever(self):
+        """ Block until interrupted, then stop """
+
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+    def stop(self, drain=True):
+        """ Stop accepting deliveries and stop the handler threads
+
+        :param drain: Whether to hand the events still buffered to the handler first
+
+        """
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+        with self._lock:
+            self._running = False
+            if not drain:
+                for queue in self._queues:
+                    queue.clear()
+                self._pending = 0
+            for condition in self._conditions:
+                condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+    def handle(self, headers, body):
+        """ Verify and buffer one delivery
+
+        :param headers: The request headers (a dict-like object)
+        :param body: The raw request body as bytes
+
+        :return: A (status, headers dict, body bytes) tuple to answer with
+
+        """
+
+        try:
+            verify_signature(self._secrets, body, headers.get(SIGNATURE_HEADER), self._tolerance)
+        except SignatureError as e:
+            self._count('rejected_signature')
+            return 401, {'Content-Type': 'text/plain'}, str(e).encode('utf-8')
+
+        try:
+            events = parse_events(body)
+        except ValueError as e:
+            self._count('rejected_malformed')
+            return 400, {'Content-Type': 'text/plain'}, str(e).encode('utf-8')
+
+        ids = [event_id(event) for event in events] if self._seen is not None else None
+        keys = [resource_key(event) for event in events]
+
+        with self._lock:
+            if ids is not None:
+                # Keep the first copy of each event not seen before; nothing is remembered until accepted
+                fresh, unique = [], set()
+                for i, identifier in enumerate(ids):
+                    if identifier not in self._seen and identifier not in unique:
+                        unique.add(identifier)
+                        fresh.append(i)
+                duplicates = len(events) - len(fresh)
+                events, keys = [events[i] for i in fresh], [keys[i] for i in fresh]
+                ids = [ids[i] for i in fresh]
+            else:
+                duplicates = 0
+
+            # A delivery is buffered whole or not at all, so a retried delivery is never partly handled
+            if self._pending + len(events) > self._max_pending:
+                self._counters['rejected_full'] += 1
+                return 503, {'Retry-After': str(self._retry_after)}, b''
+
+            woken = set()
+            for i, (event, key) in enumerate(zip(events, keys)):
+                if key is None:
+                    index = self._next_queue = (self._next_queue + 1) % self._workers
+                else:
+                    index = hash(key) % self._workers
+                self._queues[index].append(event)
+                woken.add(index)
+                if ids is not None:
+                    self._seen.add(ids[i])
+            for index in woken:
+                self._conditions[index].notify()
+
+            self._pending += len(events)
+            self._counters['deliveries'] += 1
+            self._counters['events_received'] += len(events)
+            self._counters['events_duplicate'] += duplicates
+
+        return 200, {}, b''
+
+
+    def stats(self):
+        """ Counters for the deliveries and events seen so far
+
+        :return: A dict of counters, the number of events waiting and the total handler time
+
+        """
+
+        with self._lock:
+            return {**self._counters, 'pending': self._pending, 'handler_seconds': self._handler_seconds}
+
+
+    def render(self, namespace='tailscale_webhook'):
+        """ Render the receiver's counters in the Prometheus text exposition format
+
+        :param namespace: Prefix for the metric names
+
+        :return: The metrics as a string
+
+        """
+
+        stats = self.stats()
+        metrics = [
+            ('deliveries_total', 'counter', 'Deliveries accepted.', stats['deliveries']),
+            ('events_received_total', 'counter', 'Events accepted into the buffer.', stats['events_received']),
+            ('events_handled_total', 'counter', 'Events passed to the handler.', stats['events_handled']),
+            ('events_failed_total', 'counter', 'Events whose handler call raised.', stats['events_failed']),
+            ('events_duplicate_total', 'counter', 'Repeated events dropped.', stats['events_duplicate']),
+            ('batches_total', 'counter', 'Handler calls.', stats['batches']),
+            ('handler_seconds_total', 'counter', 'Time spent in the handler.', stats['handler_seconds']),
+            ('events_pending', 'gauge', 'Events waiting for a handler.', stats['pending']),
+        ]
+
+        lines = []
+        for name, kind, help_text, value in metrics:
+            lines.append(f'# HELP {namespace}_{name} {help_text}')
+            lines.append(f'# TYPE {namespace}_{name} {kind}')
+            lines.append(f'{namespace}_{name} {_number(value)}')
+        lines.append(f'# HELP {namespace}_rejected_total Deliveries refused, by reason.')
+        lines.append(f'# TYPE {namespace}_rejected_total counter')
+        for reason in ('signature', 'malformed', 'full'):
+            lines.append(f'{namespace}_rejected_total{{reason="{reason}"}} {stats[f"rejected_{reason}"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def _count(self, name):
+
+        with self._lock:
+            self._counters[name] += 1
+
+
+    def _next_batch(self, index):
+        """ Wait for events on a worker's queue and take up to batch_size of them
+
+        :return: The batch, or None once the receiver is stopped and the queue is drained
+
+        """
+
+        queue, condition = self._queues[index], self._conditions[index]
+        with condition:
+            while not queue:
+                if not self._running:
+                    return None
+                condition.wait()
+
+            # Give a small batch a moment to fill up, unless the receiver is stopping
+            deadline = time.monotonic() + self._batch_interval
+            while self._running and len(queue) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+
+            count = min(len(queue), self._batch_size)
+            self._pending -= count
+            batch = [queue.popleft() for _ in range(count)]
+
+        # Undo reordering in transit; the sort is stable, so events without a timestamp keep their place
+        timestamps = [_timestamp(event) for event in batch]
+        if None not in timestamps:
+            batch = [event for _, event in sorted(zip(timestamps, batch), key=lambda pair: pair[0])]
+
+        return batch
+
+
+    def _work(self, index):
+
+        while True:
+            batch = self._next_batch(index)
+            if batch is None:
+                return
+
+            started = time.perf_counter()
+            failed = False
+            try:
+                self._handler(batch)
+            except Exception as e:
+                failed = True
+                warnings.warn(f'webhook handler {self._handler!r} raised {e!r}', RuntimeWarning)
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['events_failed' if failed else 'events_handled'] += len(batch)
+                self._handler_seconds += elapsed
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Tailscale keeps connections open between deliveries; answer small responses without delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _reply(self, status, headers, body):
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+
+        receiver = self.server.receiver
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.split('?')[0] != receiver._path:
+            self._reply(404, {}, b'')
+            return
+
+        self._reply(*receiver.handle(self.headers, body))
+
+    def do_GET(self):
+
+        if self.path.split('?')[0] != '/metrics':
+            self._reply(404, {}, b'')
+            return
+
+        self._reply(200, {'Content-Type': CONTENT_TYPE}, self.server.receiver.render().encode('utf-8'))
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 256
+    receiver = None
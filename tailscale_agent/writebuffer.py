@@ -0,0 +1,253 @@
+"""
+Coalesce rapid successive writes to the same device into one API call.
+
+Automations that react to events often change a device several times within seconds.
+A WriteBuffer holds tag, route and posture attribute writes for a short window, then
+sends only the result: the latest tags and routes for each device, and every posture
+change made in the window in one batch_update_device_posture_attributes call:
+
+    buffer = WriteBuffer(client, window=2.0)
+    buffer.update_device_tags(device_id, ['tag:web'])
+    buffer.update_device_tags(device_id, ['tag:web', 'tag:prod'])       # replaces the first
+    buffer.set_device_posture_attribute(device_id, 'custom:tier', 'prod')
+    buffer.close()                                                       # writes what is pending
+
+Each method returns a concurrent.futures.Future that resolves to the response of the
+write that carried the change, shared by every change coalesced into it.
+"""
+
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+# The client method that writes each kind of change, other than posture attributes
+WRITERS = {
+    'tags': 'update_device_tags',
+    'routes': 'set_device_routes',
+}
+
+
+class WriteBuffer:
+    """ Device writes held for a short window and merged per device before they are sent """
+
+    def __init__(self, client, window=1.0, max_workers=8, posture_comment=None, clock=time.monotonic):
+        """ Constructor for the WriteBuffer class
+
+        :param client: The Tailscale client used to write
+        :param window: Seconds a change waits, from the first pending change to a device, before it is sent
+        :param max_workers: Maximum number of devices written at once
+        :param posture_comment: Optional audit log reason sent with posture attribute writes
+        :param clock: Function returning the current time in seconds
+
+        """
+
+        self._client = client
+        self._window = window
+        self._max_workers = max_workers
+        self._posture_comment = posture_comment
+        self._clock = clock
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.counters = dict.fromkeys(('changes', 'coalesced', 'writes', 'failures'), 0)
+
+
+    def __repr__(self):
+
+        with self._lock:
+            return f'WriteBuffer(window={self._window}, pending={len(self._pending)})'
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+    # ---------------------------------------------------------------------------
+    # Buffered writes
+    # ---------------------------------------------------------------------------
+
+    def update_device_tags(self, device_id, tags):
+        """ Set a device's tags, replacing any tag change still pending for it
+
+        :param device_id: ID of the device
+        :param tags: List of tags, e.g. ["tag:web"]
+
+        :return: A Future of the requests response object
+
+        """
+
+        return self._put(device_id, 'tags', list(tags))
+
+
+    def set_device_routes(self, device_id, routes):
+        """ Set a device's enabled routes, replacing any route change still pending for it
+
+        :param device_id: ID of the device
+        :param routes: List of routes in CIDR format
+
+        :return: A Future of the requests response object
+
+        """
+
+        return self._put(device_id, 'routes', list(routes))
+
+
+    def set_device_posture_attribute(self, device_id, attribute_key, value, expiry=None):
+        """ Set a posture attribute, merged with the other attribute changes pending for the device
+
+        :param device_id: ID of the device
+        :param attribute_key: The attribute key (e.g. 'custom:myAttribute')
+        :param value: The attribute value (string, number, or boolean)
+        :param expiry: Optional ISO-8601 datetime string after which the attribute is removed
+
+        :return: A Future of the requests response object
+
+        """
+
+        change = {'value': value}
+        if expiry is not None:
+            change['expiry'] = expiry
+
+        return self._put(device_id, 'attributes', {attribute_key: change})
+
+
+    def delete_device_posture_attribute(self, device_id, attribute_key):
+        """ Remove a posture attribute, merged with the other attribute changes pending for the device
+
+        :param device_id: ID of the device
+        :param attribute_key: The attribute key to delete
+
+        :return: A Future of the requests response object
+
+        """
+
+        return self._put(device_id, 'attributes', {attribute_key: None})
+
+
+    def _put(self, device_id, kind, value):
+
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('WriteBuffer is closed')
+            entry = self._pending.get((device_id, kind))
+            if entry is None:
+                entry = self._pending[(device_id, kind)] = [{} if kind == 'attributes' else None, [],
+                                                            self._clock() + self._window]
+                self._wakeup.notify_all()
+            else:
+                self.counters['coalesced'] += 1
+            if kind == 'attributes':
+                entry[0].update(value)
+            else:
+                entry[0] = value
+            entry[1].append(future)
+            self.counters['changes'] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tailscale-writebuffer', daemon=True)
+                self._thread.start()
+
+        return future
+
+
+    # ---------------------------------------------------------------------------
+    # Flushing
+    # ---------------------------------------------------------------------------
+
+    def flush(self):
+        """ Send every pending change now, and wait for the writes to finish """
+
+        with self._lock:
+            due, self._pending = self._pending, {}
+        self._write(due)
+
+
+    def close(self):
+        """ Send every pending change, and stop the background thread
+
+            Changes made after close() raise RuntimeError.
+
+        """
+
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+
+    def _run(self):
+
+        while True:
+            with self._lock:
+                while not self._closed:
+                    now = self._clock()
+                    if any(entry[2] <= now for entry in self._pending.values()):
+                        break
+                    timeout = min((entry[2] for entry in self._pending.values()), default=now + self._window) - now
+                    self._wakeup.wait(timeout)
+                if self._closed:
+                    return
+                now = self._clock()
+                due = {key: entry for key, entry in self._pending.items() if entry[2] <= now}
+                for key in due:
+                    del self._pending[key]
+            self._write(due)
+
+
+    def _write(self, due):
+        """ Write a set of pending changes: posture changes in one batch call, the rest per device """
+
+        if not due:
+            return
+
+        with self._write_lock:
+            posture = {device_id: entry for (device_id, kind), entry in due.items() if kind == 'attributes'}
+            others = [(device_id, kind, entry) for (device_id, kind), entry in due.items() if kind != 'attributes']
+
+            if posture:
+                self._send(lambda: self._client.batch_update_device_posture_attributes(
+                    {device_id: entry[0] for device_id, entry in posture.items()}, comment=self._posture_comment),
+                    [future for entry in posture.values() for future in entry[1]])
+
+            if others:
+                from concurrent.futures import ThreadPoolExecutor
+
+                def write(item):
+                    device_id, kind, entry = item
+                    method = getattr(self._client, WRITERS[kind])
+                    self._send(lambda: method(device_id, entry[0]), entry[1])
+
+                with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                    list(executor.map(write, others))
+
+
+    def _send(self, call, futures):
+
+        try:
+            response = call()
+        except Exception as e:
+            failed = True
+            for future in futures:
+                future.set_exception(e)
+        else:
+            failed = not 200 <= response.status_code < 300
+            for future in futures:
+                future.set_result(response)
+
+        with self._lock:
+            self.counters['writes'] += 1
+            self.counters['failures'] += failed
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from tests.helpers import memory_client
+
+
+@pytest.fixture
+def writes():
+    """ The (method, path, JSON body) of every request other than a GET sent by the client fixture """
+
+    return []
+
+
+@pytest.fixture
+def client(api, writes):
+    """ A client of the module's FakeTailscaleAPI fixture, recording its writes """
+
+    def handler(method, path, headers, body):
+        if method != 'GET':
+            writes.append((method, path, json.loads(body) if body else None))
+        return api.handle(method, path, headers, body)
+
+    return memory_client(handler, api.tailnet)
@@ -0,0 +1,17 @@
+import time
+
+from tailscale_agent.tailscale_agent import Tailscale
+from tailscale_agent.transport import MemoryTransport
+
+
+def memory_client(handler, tailnet='example.com', **kwargs):
+    """ A client whose requests are answered in memory by handler(method, path, headers, body) """
+
+    return Tailscale('tskey-fake', 'http://fake.invalid/api/v2', tailnet, transport=MemoryTransport(handler), **kwargs)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
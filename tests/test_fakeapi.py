@@ -0,0 +1,139 @@
+import random
+import time
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI, latency_distribution, spawn
+from tailscale_agent.tailscale_agent import Tailscale
+
+
+@pytest.fixture(scope='module')
+def api():
+    with FakeTailscaleAPI(devices=50, users=5) as api:
+        yield api
+
+
+@pytest.fixture
+def client(api):
+    return Tailscale('tskey-fake', api.base_url, api.tailnet)
+
+
+def test_lists_synthetic_devices(client):
+    response = client.get_devices()
+
+    assert response.status_code == 200
+    devices = response.json()['devices']
+    assert len(devices) == 50
+    assert {'id', 'nodeId', 'addresses', 'clientConnectivity', 'tags'} <= set(devices[0])
+    assert len({d['id'] for d in devices}) == 50
+
+
+def test_datasets_are_reproducible():
+    assert FakeTailscaleAPI(devices=3, seed=7).devices == FakeTailscaleAPI(devices=3, seed=7).devices
+
+
+def test_device_changes_are_visible_in_listing(client):
+    device = client.get_devices().json()['devices'][0]
+
+    assert client.set_device_name(device['nodeId'], 'renamed').status_code == 200
+    assert client.get_device(device['id']).json()['name'] == 'renamed'
+    assert client.get_devices().json()['devices'][0]['name'] == 'renamed'
+
+
+def test_rejects_missing_credentials(api):
+    assert Tailscale('', api.base_url, api.tailnet).get_users().status_code == 401
+
+
+def test_unknown_ids_return_404(client):
+    assert client.get_device('nope').status_code == 404
+    assert client.get_webhook('nope').status_code == 404
+
+
+def test_acl_etags(client):
+    response = client.get_acls()
+    etag = response.headers['ETag']
+
+    assert response.json()['acls'][0]['action'] == 'accept'
+    assert client.update_acls('{"acls": []}', skip_unchanged=True).status_code == 200
+    assert client.get_acls().headers['ETag'] != etag
+
+    stale = client._request('post', f'{client._base_url}/tailnet/{client._tailnet}/acl',
+                            headers={'If-Match': etag}, data='{"acls": []}')
+    assert stale.status_code == 412
+
+
+def test_dns_configuration_round_trip(client):
+    client.set_dns_configuration(nameservers=['1.1.1.1'], split_dns={'corp.example.com': ['10.0.0.53']})
+
+    assert client.get_nameservers().json() == {'dns': ['1.1.1.1']}
+    assert client.get_split_dns().json() == {'corp.example.com': ['10.0.0.53']}
+
+
+def test_oauth_token_is_accepted_when_keys_are_enforced():
+    with FakeTailscaleAPI(devices=1, api_keys={'tskey-known'}) as api:
+        client = Tailscale('tskey-unknown', api.base_url, api.tailnet)
+        assert client.get_devices().status_code == 401
+
+        client.get_oauth_token('client-id', 'client-secret')
+        assert client.get_devices().status_code == 200
+
+
+@pytest.mark.parametrize('spec, low, high', [
+    ('fixed:20', 0.02, 0.02),
+    ('uniform:10,30', 0.01, 0.03),
+    ('lognormal:40,0.5', 0, 10),
+    ('pareto:5,2', 0.005, 100),
+])
+def test_latency_distributions(spec, low, high):
+    sample = latency_distribution(spec)
+    rng = random.Random(1)
+    assert all(low <= sample(rng) <= high for _ in range(100))
+
+
+@pytest.mark.parametrize('spec', ['fixed', 'uniform:1', 'gamma:1,2', 'fixed:abc'])
+def test_invalid_latency_specs(spec):
+    with pytest.raises(ValueError):
+        latency_distribution(spec)
+
+
+def test_injected_latency():
+    with FakeTailscaleAPI(devices=1, latency='fixed:50') as api:
+        client = Tailscale('tskey-fake', api.base_url, api.tailnet)
+        started = time.monotonic()
+        client.get_devices()
+        assert time.monotonic() - started >= 0.05
+
+
+def test_injected_errors_can_be_switched_off():
+    with FakeTailscaleAPI(devices=1, error_rate=1.0, error_statuses=(503,)) as api:
+        client = Tailscale('tskey-fake', api.base_url, api.tailnet)
+        assert client.get_devices().status_code == 503
+
+        api.error_rate = 0.0
+        assert client.get_devices().status_code == 200
+        assert api.status_counts == {503: 1, 200: 1}
+
+
+def test_rate_limit_answers_429_with_retry_after():
+    with FakeTailscaleAPI(devices=1, rate_limit=2) as api:
+        client = Tailscale('tskey-fake', api.base_url, api.tailnet)
+        statuses = [client.get_devices() for _ in range(3)]
+
+        assert [r.status_code for r in statuses] == [200, 200, 429]
+        assert statuses[2].headers['Retry-After'] == '1'
+
+
+def test_throttle_burst():
+    with FakeTailscaleAPI(devices=1, throttle_burst=(60, 30)) as api:
+        response = Tailscale('tskey-fake', api.base_url, api.tailnet).get_devices()
+
+        assert response.status_code == 429
+        assert 1 <= int(response.headers['Retry-After']) <= 30
+
+
+def test_spawn_runs_the_api_in_a_subprocess():
+    with spawn(devices=3, error_rate=0.0) as api:
+        response = Tailscale('tskey-fake', api.base_url, api.tailnet).get_devices()
+        assert len(response.json()['devices']) == 3
+
+    assert api.process.returncode is not None
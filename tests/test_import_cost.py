@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+
+def test_import_and_construction_defer_requests():
+    script = (
+        'import sys\n'
+        'preloaded = {m for m in ("requests", "urllib3") if m in sys.modules}\n'
+        'from tailscale_agent.tailscale_agent import Tailscale\n'
+        'Tailscale("tskey-test", "https://api.tailscale.com/api/v2", "example.com")\n'
+        'print(" ".join(m for m in ("requests", "urllib3") if m in sys.modules and m not in preloaded))\n'
+    )
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == ''
+
+
+def test_requests_attribute_still_available():
+    import requests
+    import tailscale_agent.tailscale_agent as module
+
+    assert module.requests is requests
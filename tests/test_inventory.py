@@ -0,0 +1,263 @@
+import json
+import time
+
+from datetime import datetime
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.inventory import Inventory, KeyIndex, UserDirectory
+from tailscale_agent.tailscale_agent import Tailscale
+from tailscale_agent.webhooks import WebhookReceiver
+from tests.helpers import memory_client
+
+
+@pytest.fixture
+def api():
+    return FakeTailscaleAPI(devices=5, users=3)
+
+
+def node_event(event_type, device):
+    return {'type': event_type, 'data': {'nodeID': device['nodeId'], 'deviceName': device['name']}}
+
+
+def test_load_indexes_devices_and_users(api, client):
+    inventory = Inventory(client).load()
+
+    device = next(iter(api.devices.values()))
+    user = next(iter(api.users.values()))
+    assert len(inventory.devices()) == 5
+    assert len(inventory.users()) == 3
+    assert inventory.device(device['nodeId']) == inventory.device(device['id']) == device
+    assert inventory.user(user['loginName']) == inventory.user(user['id']) == user
+
+
+def test_device_events_refetch_only_that_device(api, client):
+    inventory = Inventory(client).load()
+    requests_before = api.request_count
+
+    device = next(iter(api.devices.values()))
+    device['authorized'] = False
+    inventory.handle([node_event('nodeNeedsApproval', device)])
+    assert inventory.device(device['nodeId'])['authorized'] is False
+
+    device['authorized'] = True
+    # Several events about one device in a batch cost one fetch
+    inventory.handle([node_event('nodeApproved', device), node_event('nodeKeyExpiringInOneDay', device),
+                      {'type': 'policyUpdate', 'data': {}}])
+    assert inventory.device(device['nodeId'])['authorized'] is True
+
+    assert api.request_count - requests_before == 2
+    assert inventory.counters['device_fetches'] == 2
+    assert inventory.counters['ignored'] == 1
+
+
+def test_failed_fetch_does_not_stop_the_batch(api):
+    broken = set()
+
+    def handler(method, path, headers, body):
+        if path.rsplit('/', 1)[-1] in broken:
+            return 500, {}, b'{"message": "unavailable"}'
+        return api.handle(method, path, headers, body)
+
+    client = memory_client(handler, api.tailnet, max_retries=0)
+    inventory = Inventory(client).load()
+    first, second, third = list(api.devices.values())[:3]
+    for device in (first, second, third):
+        device['tags'] = ['tag:new']
+    broken.add(second['nodeId'])
+
+    inventory.handle([node_event('nodeApproved', device) for device in (first, second, third)])
+    assert inventory.device(first['id'])['tags'] == inventory.device(third['id'])['tags'] == ['tag:new']
+    assert inventory.device(second['id'])['tags'] != ['tag:new']
+    assert inventory.counters['fetch_failures'] == 1
+
+    # The failed device is fetched again with the next batch, even one that does not mention it
+    broken.clear()
+    inventory.handle([])
+    assert inventory.device(second['id'])['tags'] == ['tag:new']
+    assert inventory.counters['device_fetches'] == 4
+
+
+def test_created_and_deleted_devices(api, client):
+    inventory = Inventory(client).load()
+    first, second = list(api.devices.values())[:2]
+
+    inventory.apply(node_event('nodeDeleted', first))
+    assert inventory.device(first['nodeId']) is None
+
+    # A device the API no longer knows is dropped when it is fetched
+    client.delete_device(second['id'])
+    inventory.apply(node_event('nodeCreated', second))
+    assert inventory.device(second['id']) is None
+
+    inventory.apply(node_event('nodeCreated', first))
+    assert inventory.device(first['id']) == first
+    assert len(inventory.devices()) == 4
+
+
+def test_user_events(api, client):
+    inventory = Inventory(client).load()
+    user = next(u for u in api.users.values() if u['role'] != 'owner')
+
+    client.update_user_role(user['id'], 'auditor')
+    inventory.apply({'type': 'userRoleUpdated', 'data': {'user': user['loginName']}})
+    assert inventory.user(user['id'])['role'] == 'auditor'
+
+    inventory.apply({'type': 'userDeleted', 'data': {'user': user['loginName']}})
+    assert inventory.user(user['loginName']) is None
+
+    # An unknown user reloads the user list
+    inventory.apply({'type': 'userCreated', 'data': {'user': user['loginName']}})
+    assert inventory.user(user['loginName'])['role'] == 'auditor'
+    assert inventory.counters['full_loads'] == 3
+
+
+def test_follows_webhook_deliveries():
+    with FakeTailscaleAPI(devices=3) as api:
+        client = Tailscale('tskey-fake', api.base_url, api.tailnet)
+        inventory = Inventory(client).load()
+        webhook = client.create_webhook('http://placeholder.invalid/', ['nodeDeleted']).json()
+        with WebhookReceiver(webhook['secret'], inventory.handle, batch_interval=0) as receiver:
+            api.webhooks[webhook['endpointId']]['endpointUrl'] = receiver.url
+            device = next(iter(api.devices.values()))
+
+            api.emit('nodeDeleted', {'nodeID': device['nodeId']})
+            deadline = time.monotonic() + 2
+            while inventory.device(device['nodeId']) is not None:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+
+    assert len(inventory.devices()) == 2
+
+
+def stripped_users(api, fields=('role', 'status')):
+    """ A handler serving the fake API, with details left out of the user list like some real responses """
+
+    def handler(method, path, headers, body):
+        status, response_headers, content = api.handle(method, path, headers, body)
+        if path.endswith('/users') and status == 200:
+            users = [{k: v for k, v in user.items() if k not in fields} for user in json.loads(content)['users']]
+            content = json.dumps({'users': users}).encode('utf-8')
+        return status, response_headers, content
+
+    return handler
+
+
+def test_user_directory_indexes():
+    api = FakeTailscaleAPI(users=30)
+    client = memory_client(api, api.tailnet)
+    directory = UserDirectory(client).load()
+
+    users = list(api.users.values())
+    admins = sorted(u['id'] for u in users if u['role'] == 'admin' and u['status'] == 'active')
+    assert len(directory) == 30
+    assert [u['id'] for u in directory.find(role='admin', status='active')] == admins
+    assert directory.get(users[3]['loginName']) == users[3]
+    assert sum(directory.count_by('type').values()) == 30
+    assert directory.counters['hydrations'] == 0
+
+
+def test_user_directory_hydrates_missing_details_once():
+    api = FakeTailscaleAPI(users=12)
+    client = memory_client(stripped_users(api), api.tailnet)
+    directory = UserDirectory(client, max_workers=4).load()
+
+    assert directory.counters['hydrations'] == 12
+    assert {u['id']: u['role'] for u in directory} == {u['id']: u['role'] for u in api.users.values()}
+
+    # Nothing changed: no user is fetched again
+    assert directory.refresh() == {'added': [], 'removed': [], 'changed': []}
+    assert directory.counters['hydrations'] == 12
+
+
+def test_user_directory_keeps_list_entries_it_cannot_hydrate():
+    api = FakeTailscaleAPI(users=6)
+    serve = stripped_users(api)
+    broken = list(api.users)[2]
+
+    def handler(method, path, headers, body):
+        if path.endswith(f'/users/{broken}'):
+            raise ConnectionError('reset')
+        return serve(method, path, headers, body)
+
+    client = memory_client(handler, api.tailnet, max_retries=0)
+    directory = UserDirectory(client).load()
+
+    assert len(directory) == 6
+    assert 'role' not in directory.get(broken)
+    assert sum(1 for u in directory if 'role' in u) == 5
+    assert directory.counters['failures'] == 1
+
+
+def test_user_directory_incremental_refresh():
+    api = FakeTailscaleAPI(users=5)
+    client = memory_client(stripped_users(api, fields=('role',)), api.tailnet)
+    directory = UserDirectory(client).load()
+    first, second, third = list(api.users)[1:4]
+
+    status = 'idle' if api.users[first]['status'] == 'suspended' else 'suspended'
+    api.users[first]['status'] = status
+    role = 'admin' if api.users[second]['role'] == 'auditor' else 'auditor'
+    api.users[second]['role'] = role
+    del api.users[third]
+    changes = directory.refresh()
+
+    assert changes == {'added': [], 'removed': [third], 'changed': [first]}
+    assert directory.get(first)['status'] == status
+    assert first in [u['id'] for u in directory.find(status=status)]
+    assert directory.get(third) is None
+    # A role change invisible in the list needs a full rehydration to show up
+    assert directory.get(second)['role'] != role
+    directory.refresh(rehydrate=True)
+    assert directory.get(second)['role'] == role
+
+
+def key_api(keys=20):
+    api = FakeTailscaleAPI(users=3)
+    api.keys.clear()
+    creators = list(api.users)
+    for i in range(keys):
+        key = api._new_key({}, 3600, f'key {i}')
+        key['userId'] = creators[i % 3]
+        key['expires'] = f'2026-01-{1 + i % 28:02d}T{i % 24:02d}:00:00Z'
+    return api
+
+
+def epoch(timestamp):
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def test_key_index_orders_keys_by_expiry():
+    api = key_api()
+    client = memory_client(api, api.tailnet)
+    keys = KeyIndex(client, max_workers=4).load()
+
+    soon = keys.expiring_within(72 * 3600, now=epoch('2026-01-05T00:00:00Z'))
+    assert [k['expires'] for k in soon] == ['2026-01-05T04:00:00Z', '2026-01-06T05:00:00Z', '2026-01-07T06:00:00Z']
+    assert len(keys.expired(now=epoch('2026-01-03T00:00:00Z'))) == 2
+    assert keys.counters['hydrations'] == 20
+
+    creator = list(api.users)[1]
+    assert [k['id'] for k in keys.by_creator(creator)] == sorted(
+        key_id for key_id, key in api.keys.items() if key['userId'] == creator)
+    assert keys.count_by_creator() == {user_id: n for user_id, n in zip(api.users, (7, 7, 6))}
+
+
+def test_key_index_incremental_refresh():
+    api = key_api(keys=5)
+    client = memory_client(api, api.tailnet)
+    keys = KeyIndex(client).load()
+    first = next(iter(api.keys))
+
+    client.delete_key(first)
+    created = client.create_authorization_key({}, expiry_seconds=60).json()
+    changes = keys.refresh()
+
+    assert changes == {'added': [created['id']], 'removed': [first], 'changed': []}
+    # Only the new key was fetched
+    assert keys.counters['hydrations'] == 6
+    assert keys.get(first) is None
+    assert first not in [k['id'] for k in keys.expired(now=epoch('2030-01-01T00:00:00Z'))]
+    assert keys.get(created['id'])['capabilities'] == {}
+    assert len(keys) == 5
@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.journal import WriteJournal
+from tests.helpers import memory_client
+
+
+@pytest.fixture
+def api():
+    return FakeTailscaleAPI(devices=5)
+
+
+def test_writes_are_sent_in_the_background(api, tmp_path):
+    devices = list(api.devices.values())
+    with WriteJournal(memory_client(api), tmp_path / 'writes.db') as journal:
+        for device in devices:
+            journal.submit('update_device_tags', device['id'], ['tag:journaled'])
+        journal.submit('set_device_posture_attribute', devices[0]['id'], 'custom:tier', 'prod', comment='x')
+        assert journal.wait(timeout=5)
+
+    assert all(device['tags'] == ['tag:journaled'] for device in devices)
+    assert api.attributes[devices[0]['id']]['custom:tier']['value'] == 'prod'
+    assert journal.counters['written'] == 6
+
+
+def test_pending_writes_survive_a_restart(api, tmp_path):
+    path = tmp_path / 'writes.db'
+    device = next(iter(api.devices.values()))
+
+    # Never started, as if the process died before sending anything
+    journal = WriteJournal(memory_client(api), path)
+    journal.submit('update_device_tags', device['id'], ['tag:a'])
+    journal.submit('set_device_name', device['id'], 'renamed')
+    journal.close(drain=False)
+    assert device['tags'] != ['tag:a']
+
+    with WriteJournal(memory_client(api), path) as journal:
+        assert journal.wait(timeout=5)
+        assert journal.pending() == 0
+
+    assert (device['tags'], device['name']) == (['tag:a'], 'renamed')
+
+
+def test_replayed_deletes_count_as_written(api, tmp_path):
+    device_id = next(iter(api.devices))
+    client = memory_client(api)
+    client.delete_device(device_id)
+
+    with WriteJournal(client, tmp_path / 'writes.db') as journal:
+        journal.submit('delete_device', device_id)
+        journal.wait(timeout=5)
+
+    assert journal.counters == {'submitted': 1, 'written': 1, 'retried': 0, 'failed': 0}
+
+
+def test_writes_to_one_device_keep_their_order(tmp_path):
+    order = []
+    lock = threading.Lock()
+
+    def handler(method, path, headers, body):
+        with lock:
+            order.append((path, body))
+        return 200, {}, b'{}'
+
+    with WriteJournal(memory_client(handler), tmp_path / 'writes.db', workers=4) as journal:
+        for i in range(20):
+            journal.submit('update_device_tags', f'd{i % 2}', [f'tag:t{i}'])
+        journal.wait(timeout=5)
+
+    for device in ('d0', 'd1'):
+        bodies = [body for path, body in order if path == f'/api/v2/device/{device}/tags']
+        assert bodies == [f'{{"tags": ["tag:t{i}"]}}'.encode() for i in range(20) if f'd{i % 2}' == device]
+
+
+def test_failures_are_retried_then_kept(tmp_path):
+    calls = []
+
+    def handler(method, path, headers, body):
+        calls.append(path)
+        if path.endswith('/bad/tags'):
+            return 400, {}, b'{"message": "invalid tag"}'
+        return (503, {}, b'{}') if calls.count(path) == 1 else (200, {}, b'{}')
+
+    with WriteJournal(memory_client(handler), tmp_path / 'writes.db', retry_delay=0.01) as journal:
+        journal.submit('authorize_device', 'd1')
+        journal.submit('update_device_tags', 'bad', ['tag:x'])
+        assert journal.wait(timeout=5)
+
+        assert calls.count('/api/v2/device/d1/authorized') == 2
+        failures = journal.failures()
+        assert [(f['method'], f['args'], f['status']) for f in failures] == [
+            ('update_device_tags', ['bad', ['tag:x']], 400)]
+        assert 'invalid tag' in failures[0]['error']
+        assert journal.discard_failures() == 1
+
+    assert journal.counters == {'submitted': 2, 'written': 1, 'retried': 1, 'failed': 1}
+
+
+def test_only_repeatable_writes_are_accepted(tmp_path):
+    journal = WriteJournal(memory_client(lambda *request: (200, {}, b'{}')), tmp_path / 'writes.db')
+
+    with pytest.raises(ValueError):
+        journal.submit('create_authorization_key', {})
+    # Expiring a key again after the device has reauthenticated would expire the new key
+    with pytest.raises(ValueError):
+        journal.submit('expire_device_key', 'device-1')
+    journal.close()
@@ -0,0 +1,88 @@
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.keypool import AuthKeyPool
+from tests.helpers import memory_client, wait_for
+
+
+@pytest.fixture
+def api():
+    return FakeTailscaleAPI(devices=1)
+
+
+def pooled_keys(api):
+    return [key_id for key_id, key in api.keys.items() if key['description'].startswith('keypool')]
+
+
+def test_keys_are_ready_before_they_are_taken(api, client):
+    with AuthKeyPool(client, size=3).add_profile('web', tags=['tag:web'], ephemeral=True) as pool:
+        wait_for(lambda: pool.ready('web') == 3)
+        requests_before = api.request_count
+
+        key = pool.take('web')
+        assert api.request_count == requests_before
+        assert key['key'].startswith('tskey-auth-')
+        assert key['capabilities'] == {'devices': {'create': {
+            'reusable': False, 'ephemeral': True, 'preauthorized': True, 'tags': ['tag:web']}}}
+
+        # The pool tops itself up in the background
+        wait_for(lambda: pool.ready('web') == 3)
+
+    assert pool.counters['hits'] == 1
+    assert pool.counters['created'] == 4
+    # Stopping deletes the keys nobody took
+    assert pooled_keys(api) == [key['id']]
+
+
+def test_profiles_are_kept_apart(client):
+    pool = AuthKeyPool(client, size=2)
+    pool.add_profile('web', tags=['tag:web']).add_profile('ci', reusable=True, size=1)
+    assert pool.refill() == 0
+
+    assert (pool.ready('web'), pool.ready('ci')) == (2, 1)
+    assert pool.take('ci')['capabilities']['devices']['create']['reusable'] is True
+    with pytest.raises(KeyError):
+        pool.take('db')
+
+
+def test_empty_profile_creates_a_key_on_the_spot(api, client):
+    pool = AuthKeyPool(client, size=1).add_profile('web')
+
+    key = pool.take('web')
+
+    assert key['id'] in api.keys
+    assert pool.counters['misses'] == 1
+
+
+def test_keys_are_retired_before_they_expire(api, client):
+    now = [0.0]
+    pool = AuthKeyPool(client, size=2, expiry_seconds=100, retire_margin=10, clock=lambda: now[0])
+    pool.add_profile('web').refill()
+    old_ids = {pool.take('web')['id']}
+
+    now[0] = 50.0
+    pool.refill()
+    now[0] = 95.0
+    # The first key is due for retirement and is never handed out
+    fresh = pool.take('web')
+    assert fresh['id'] not in old_ids
+    assert pool.retire() == 1
+    assert pool.counters['retired'] == 1
+    assert len(pooled_keys(api)) == 2
+
+
+def test_refill_failures_are_counted():
+    def handler(method, path, headers, body):
+        return 500, {}, b'{"message": "unavailable"}'
+
+    pool = AuthKeyPool(memory_client(handler), size=2).add_profile('web')
+
+    with pytest.warns(RuntimeWarning, match='could not create 2 of 2'):
+        assert pool.refill() == 2
+    assert pool.counters['failures'] == 2
+    assert pool.ready('web') == 0
+
+
+def test_retire_margin_must_fit_in_expiry(client):
+    with pytest.raises(ValueError):
+        AuthKeyPool(client, expiry_seconds=60, retire_margin=60)
@@ -0,0 +1,91 @@
+import urllib.request
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.metrics import MetricsCollector
+from tailscale_agent.tailscale_agent import RequestEvent, Tailscale
+
+
+def event(endpoint='/device/{id}/routes', verb='GET', status=200, total_time=0.03, **fields):
+    values = dict(method_name='get_device_routes', endpoint=endpoint, verb=verb, url='', status=status,
+                  dns_time=None, connect_time=None, tls_time=None, ttfb=total_time, total_time=total_time,
+                  request_bytes=0, response_bytes=100, retries=0, cache=None, rate_limit_wait=0.0, error=None)
+    values.update(fields)
+    return RequestEvent(**values)
+
+
+@pytest.fixture
+def collector():
+    return MetricsCollector(buckets=(0.05, 0.5))
+
+
+def test_counts_by_status_class(collector):
+    collector.observe(event(status=200))
+    collector.observe(event(status=404))
+    collector.observe(event(status=None, error=ConnectionError()))
+
+    text = collector.render()
+    assert 'tailscale_api_requests_total{endpoint="/device/{id}/routes",verb="GET",status_class="2xx"} 1' in text
+    assert 'status_class="4xx"} 1' in text
+    assert 'status_class="error"} 1' in text
+
+
+def test_latency_histogram_is_cumulative(collector):
+    for seconds in (0.01, 0.1, 2.0):
+        collector.observe(event(total_time=seconds))
+
+    text = collector.render()
+    prefix = 'tailscale_api_request_duration_seconds'
+    labels = 'endpoint="/device/{id}/routes",verb="GET"'
+    assert f'{prefix}_bucket{{{labels},le="0.05"}} 1' in text
+    assert f'{prefix}_bucket{{{labels},le="0.5"}} 2' in text
+    assert f'{prefix}_bucket{{{labels},le="+Inf"}} 3' in text
+    assert f'{prefix}_count{{{labels}}} 3' in text
+    assert f'{prefix}_sum{{{labels}}} 2.11' in text
+
+
+def test_in_flight_gauge_and_waits(collector):
+    collector.request_started('GET', '/tailnet/{tailnet}/devices')
+    collector.request_started('GET', '/tailnet/{tailnet}/devices')
+    collector.observe(event(endpoint='/tailnet/{tailnet}/devices', rate_limit_wait=0.25, retries=2))
+
+    text = collector.render()
+    labels = '{endpoint="/tailnet/{tailnet}/devices",verb="GET"}'
+    assert f'tailscale_api_requests_in_flight{labels} 1' in text
+    assert f'tailscale_api_rate_limit_wait_seconds_total{labels} 0.25' in text
+    assert f'tailscale_api_retries_total{labels} 2' in text
+
+
+def test_label_values_are_escaped(collector):
+    collector.observe(event(endpoint='/a"b\\c'))
+
+    assert 'endpoint="/a\\"b\\\\c"' in collector.render()
+
+
+def test_attached_client_is_measured_and_served():
+    collector = MetricsCollector()
+    with FakeTailscaleAPI(devices=5) as api:
+        client = collector.attach(Tailscale('tskey-fake', api.base_url, api.tailnet))
+        client.get_devices()
+        client.get_device_routes('1000000000000001')
+        client.get_device('missing')
+
+        server = collector.serve(port=0)
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+            with urllib.request.urlopen(url) as response:
+                assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+                text = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        collector.detach(client)
+        client.get_devices()
+
+    assert 'endpoint="/tailnet/{tailnet}/devices",verb="GET",status_class="2xx"} 1' in text
+    assert 'endpoint="/device/{id}/routes",verb="GET",status_class="2xx"} 1' in text
+    assert 'endpoint="/device/{id}",verb="GET",status_class="4xx"} 1' in text
+    assert 'tailscale_api_requests_in_flight{endpoint="/tailnet/{tailnet}/devices",verb="GET"} 0' in text
+    assert 'endpoint="/tailnet/{tailnet}/devices",verb="GET",status_class="2xx"} 1' in collector.render()
@@ -0,0 +1,84 @@
+from unittest.mock import patch
+
+import pytest
+
+from tailscale_agent.pool import TailscalePool
+from tailscale_agent.tailscale_agent import RateLimiter
+from tests.test_tailscale_agent import BASE_URL, mock_response
+
+
+@pytest.fixture
+def pool():
+    pool = TailscalePool(BASE_URL, rate_limiter=RateLimiter(rate=1000), max_workers=4)
+    pool.add_tailnet('a.example.com', api_key='tskey-a')
+    pool.add_tailnet('b.example.com', api_key='tskey-b')
+    yield pool
+    pool.close()
+
+
+def test_clients_share_session_and_limiter(pool):
+    a, b = pool['a.example.com'], pool['b.example.com']
+    assert a._session is b._session is pool._session
+    assert a._rate_limiter is b._rate_limiter
+    assert a._auth.username == 'tskey-a'
+    assert b._auth.username == 'tskey-b'
+    assert len(pool) == 2
+    assert 'a.example.com' in pool
+
+
+def test_map_tags_results_by_tailnet(pool):
+    def fake_request(method, url, **kwargs):
+        return mock_response(json_data={'url': url, 'user': kwargs['auth'].username})
+
+    with patch.object(pool._session, 'request', side_effect=fake_request) as mock_request:
+        results = {r.item: r for r in pool.map('get_devices')}
+
+    assert mock_request.call_count == 2
+    assert results['a.example.com'].error is None
+    assert results['a.example.com'].response.json() == {
+        'url': f'{BASE_URL}/tailnet/a.example.com/devices', 'user': 'tskey-a'}
+    assert results['b.example.com'].response.json()['user'] == 'tskey-b'
+
+
+def test_map_reports_errors_per_tailnet(pool):
+    def fake_request(method, url, **kwargs):
+        if 'a.example.com' in url:
+            raise ConnectionError('boom')
+        return mock_response()
+
+    with patch.object(pool._session, 'request', side_effect=fake_request):
+        results = {r.item: r for r in pool.map('get_devices', tailnets=['a.example.com'])}
+
+    assert list(results) == ['a.example.com']
+    assert isinstance(results['a.example.com'].error, ConnectionError)
+
+
+def test_map_backs_off_when_throttled():
+    pool = TailscalePool(BASE_URL, max_workers=4, max_retries=0)
+    pool.add_tailnet('a.example.com', api_key='tskey-a')
+    pool.add_tailnet('b.example.com', api_key='tskey-b')
+    with patch.object(pool._session, 'request', return_value=mock_response(status_code=429)):
+        results = list(pool.map('get_devices'))
+    pool.close()
+
+    assert [r.response.status_code for r in results] == [429, 429]
+    assert pool._concurrency.limit < 4
+
+
+def test_map_rejects_private_methods(pool):
+    with pytest.raises(ValueError):
+        pool.map('_request')
+
+
+def test_oauth_tokens_go_through_shared_cache():
+    pool = TailscalePool(BASE_URL)
+    token = mock_response(status_code=200, json_data={'access_token': 'oauth-token', 'expires_in': 3600})
+    with patch.object(pool._session, 'request', return_value=token) as mock_request:
+        pool.add_tailnet('a.example.com', oauth_client_id='client-id', oauth_client_secret='secret')
+        pool.add_tailnet('a-copy', oauth_client_id='client-id', oauth_client_secret='secret')
+    try:
+        mock_request.assert_called_once()
+        assert pool['a-copy']._api_key == 'oauth-token'
+    finally:
+        pool.close()
+    assert pool['a.example.com']._token_timer is None
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.reconcile import DeviceChange, DeviceReconciler, format_plan
+from tests.helpers import memory_client
+
+
+@pytest.fixture
+def api():
+    return FakeTailscaleAPI(devices=20)
+
+
+def current_state(api):
+    """ A desired state matching every device as it is now """
+
+    return {device['id']: {'name': device['hostname'], 'tags': list(reversed(device['tags'])),
+                           'routes': device['enabledRoutes'], 'keyExpiryDisabled': device['keyExpiryDisabled']}
+            for device in api.devices.values()}
+
+
+def test_matching_state_needs_no_writes(api, client, writes):
+    reconciler = DeviceReconciler(client)
+
+    plan = reconciler.plan(current_state(api))
+
+    assert plan.changes == [] and plan.unmatched == []
+    assert format_plan(plan) == 'No changes'
+    assert reconciler.apply(plan) == []
+    assert writes == []
+    # The device list answered everything: one read
+    assert reconciler.counters['reads'] == 1
+
+
+def test_only_changed_fields_are_written(api, client, writes):
+    devices = list(api.devices.values())
+    desired = current_state(api)
+    desired[devices[0]['id']]['tags'] = ['tag:reconciled']
+    del desired[devices[1]['id']], desired[devices[2]['id']]
+    desired[devices[1]['nodeId']] = {'name': 'renamed', 'keyExpiryDisabled': not devices[1]['keyExpiryDisabled']}
+    desired[devices[2]['hostname']] = {'routes': ['10.9.0.0/24']}
+    desired['no-such-host'] = {'tags': []}
+
+    reconciler = DeviceReconciler(client, max_workers=4)
+    plan = reconciler.plan(desired)
+
+    assert sorted((c.device_id, c.field) for c in plan.changes) == sorted([
+        (devices[0]['id'], 'tags'), (devices[1]['id'], 'name'), (devices[1]['id'], 'keyExpiryDisabled'),
+        (devices[2]['id'], 'routes')])
+    assert plan.unmatched == ['no-such-host']
+    assert f"{devices[2]['id']}: routes {devices[2]['enabledRoutes']!r} -> ['10.9.0.0/24']" in format_plan(plan)
+    assert writes == []
+
+    results = reconciler.apply(plan)
+
+    assert len(writes) == 4
+    assert all(r.response.status_code == 200 for r in results)
+    assert devices[0]['tags'] == ['tag:reconciled']
+    assert devices[1]['name'] == 'renamed'
+    assert devices[2]['enabledRoutes'] == ['10.9.0.0/24']
+    assert reconciler.plan(desired).changes == []
+
+
+def test_posture_attributes_are_batched(api, client, writes):
+    devices = list(api.devices.values())
+    client.set_device_posture_attribute(devices[0]['id'], 'custom:tier', 'dev')
+    client.set_device_posture_attribute(devices[1]['id'], 'custom:tier', 'prod')
+    client.set_device_posture_attribute(devices[2]['id'], 'custom:legacy', True)
+    writes.clear()
+
+    desired = {device['id']: {'attributes': {'custom:tier': 'prod', 'custom:legacy': None}}
+               for device in devices[:3]}
+    reconciler = DeviceReconciler(client, posture_comment='config repo')
+    plan = reconciler.plan(desired)
+
+    assert sorted(plan.changes) == sorted([
+        DeviceChange(devices[0]['id'], 'attributes', {'custom:tier': 'dev'}, {'custom:tier': 'prod'}),
+        DeviceChange(devices[2]['id'], 'attributes', {'custom:tier': None, 'custom:legacy': True},
+                     {'custom:tier': 'prod', 'custom:legacy': None}),
+    ])
+
+    results = reconciler.apply(desired)
+
+    assert writes == [('PATCH', '/api/v2/tailnet/example.com/device-attributes', {
+        'nodes': {devices[0]['id']: {'custom:tier': {'value': 'prod'}},
+                  devices[2]['id']: {'custom:tier': {'value': 'prod'}, 'custom:legacy': None}},
+        'comment': 'config repo'})]
+    assert len(results) == 2 and results[0].response is results[1].response
+    assert reconciler.plan(desired).changes == []
+
+
+def test_routes_are_read_when_the_list_lacks_them(api):
+    def handler(method, path, headers, body):
+        status, response_headers, content = api.handle(method, path, headers, body)
+        if path.endswith('/devices'):
+            devices = [{k: v for k, v in d.items() if k != 'enabledRoutes'} for d in json.loads(content)['devices']]
+            content = json.dumps({'devices': devices}).encode('utf-8')
+        return status, response_headers, content
+
+    client = memory_client(handler, api.tailnet)
+    device = next(d for d in api.devices.values() if d['enabledRoutes'])
+    reconciler = DeviceReconciler(client)
+
+    assert reconciler.plan({device['id']: {'routes': device['enabledRoutes']}}).changes == []
+    assert reconciler.counters['reads'] == 2
+
+
+def test_unknown_fields_are_rejected(client):
+    with pytest.raises(ValueError, match='ipv4'):
+        DeviceReconciler(client).plan({'d1': {'ipv4': '100.64.0.1'}})
+
+
+def test_a_device_named_twice_is_rejected(api, client):
+    device = next(iter(api.devices.values()))
+
+    with pytest.raises(ValueError, match='named more than once'):
+        DeviceReconciler(client).plan({device['id']: {'tags': []}, device['hostname']: {'tags': ['tag:a']}})
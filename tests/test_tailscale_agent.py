@@ -1,9 +1,15 @@
+import threading
+import time
+
+from datetime import timedelta
 from unittest.mock import patch, MagicMock
 
 import pytest
 
 from tailscale_agent import __version__
-from tailscale_agent.tailscale_agent import Tailscale
+from tailscale_agent.tailscale_agent import AdaptiveConcurrency, RateLimiter, Tailscale, _endpoint_template
+from tailscale_agent.token_cache import FileTokenCache, MemoryTokenCache
+from tests.helpers import memory_client
 
 
 BASE_URL = 'https://api.tailscale.com/api/v2'
@@ -23,6 +29,13 @@ def mock_response(status_code=200, json_data=None):
     return mock
 
 
+def policy_response(content, etag='"v1"', status_code=200):
+    mock = mock_response(status_code)
+    mock.content = content
+    mock.headers = {'ETag': etag} if etag else {}
+    return mock
+
+
 # ---------------------------------------------------------------------------
 # Version
 # ---------------------------------------------------------------------------
@@ -54,6 +67,226 @@ def test_custom_headers_can_override_defaults():
     assert custom._headers['Accept'] == 'text/hcl'
 
 
+
+# ---------------------------------------------------------------------------
+# Sessions, rate limiting and retries
+# ---------------------------------------------------------------------------
+
+class TestTransport:
+    def test_session_is_used_when_given(self):
+        session = MagicMock()
+        session.request.return_value = mock_response()
+        custom = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET, session=session)
+        custom.get_device('device-1')
+        session.request.assert_called_once_with(
+            'get', f'{BASE_URL}/device/device-1', auth=custom._auth, headers=custom._headers)
+
+    @patch('tailscale_agent.tailscale_agent.time.sleep')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_retries_429_using_retry_after(self, mock_get, mock_sleep):
+        throttled = mock_response(status_code=429)
+        throttled.headers = {'Retry-After': '3'}
+        mock_get.side_effect = [throttled, mock_response()]
+        custom = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET, max_retries=2)
+        assert custom.get_devices().status_code == 200
+        mock_sleep.assert_called_once_with(3.0)
+
+    @patch('tailscale_agent.tailscale_agent.time.sleep')
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_server_errors_not_retried_for_post(self, mock_post, mock_sleep):
+        mock_post.return_value = mock_response(status_code=503)
+        mock_post.return_value.headers = {}
+        custom = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET, max_retries=2)
+        assert custom.authorize_device('device-1').status_code == 503
+        mock_post.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch('tailscale_agent.tailscale_agent.time.sleep')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_retries_give_up_after_max_retries(self, mock_get, mock_sleep):
+        mock_get.return_value = mock_response(status_code=502)
+        mock_get.return_value.headers = {}
+        custom = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET, max_retries=2)
+        assert custom.get_devices().status_code == 502
+        assert mock_get.call_count == 3
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [0.5, 1.0]
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_429_pauses_shared_rate_limiter(self, mock_get):
+        throttled = mock_response(status_code=429)
+        throttled.headers = {'Retry-After': '0.05'}
+        mock_get.side_effect = [throttled, mock_response()]
+        limiter = RateLimiter(rate=1000)
+        custom = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET,
+                           rate_limiter=limiter, max_retries=1)
+        custom.get_devices()
+        assert limiter._paused_until > 0
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(rate=100, burst=1)
+    assert limiter.acquire() == 0
+    waited = limiter.acquire()
+    assert 0 < waited <= 0.011
+
+
+def test_adaptive_concurrency_grows_and_backs_off():
+    concurrency = AdaptiveConcurrency(initial=2, maximum=8, latency_target=0.5)
+    for _ in range(20):
+        concurrency.acquire()
+        concurrency.release(0.01)
+    assert concurrency.limit == 6
+
+    concurrency.acquire()
+    concurrency.release(0.01, throttled=True)
+    assert concurrency.limit == 3
+    # Responses in flight during the same round trip do not halve it again
+    concurrency.acquire()
+    concurrency.release(0.01, throttled=True)
+    assert concurrency.limit == 3
+
+    # A response slower than the target also halves it
+    slow = AdaptiveConcurrency(initial=4, latency_target=0.05)
+    slow.acquire()
+    slow.release(0.1)
+    assert slow.limit == 2
+
+
+def test_adaptive_concurrency_limits_callers():
+    concurrency = AdaptiveConcurrency(initial=1, maximum=1)
+    concurrency.acquire()
+    acquired = threading.Event()
+    threading.Thread(target=lambda: (concurrency.acquire(), acquired.set())).start()
+
+    assert not acquired.wait(0.05)
+    concurrency.release()
+    assert acquired.wait(1)
+
+
+def timed_response(status_code=200, content=b'{}', body=None):
+    mock = mock_response(status_code)
+    mock.content = content
+    mock.headers = {}
+    mock.elapsed = timedelta(milliseconds=20)
+    mock.request.body = body
+    return mock
+
+
+class TestHooks:
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_event_describes_the_call(self, mock_post, client):
+        mock_post.return_value = timed_response(content=b'{"enabledRoutes": []}', body=b'{"routes": []}')
+        events = []
+        client.add_hook(events.append)
+
+        client.set_device_routes('12345', [])
+
+        [event] = events
+        assert event.method_name == 'set_device_routes'
+        assert event.endpoint == '/device/{id}/routes'
+        assert event.verb == 'POST'
+        assert event.url == f'{BASE_URL}/device/12345/routes'
+        assert event.status == 200
+        assert event.ttfb == 0.02
+        assert event.total_time >= 0
+        assert (event.request_bytes, event.response_bytes) == (14, 21)
+        assert (event.retries, event.cache, event.error) == (0, None, None)
+        assert event.dns_time is event.connect_time is event.tls_time is None
+
+    @patch('tailscale_agent.tailscale_agent.time.sleep')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_event_counts_retries_and_rate_limit_wait(self, mock_get, mock_sleep):
+        mock_get.side_effect = [timed_response(503), timed_response()]
+        limiter = MagicMock()
+        limiter.acquire.return_value = 0.25
+        custom = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET,
+                           rate_limiter=limiter, max_retries=1)
+        events = []
+        custom.add_hook(events.append)
+
+        custom.get_devices()
+
+        assert [(e.endpoint, e.status, e.retries, e.rate_limit_wait) for e in events] == [
+            ('/tailnet/{tailnet}/devices', 200, 1, 0.5)]
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_conditional_acl_fetch_reports_cache_use(self, mock_get, mock_post, client):
+        acl = b'{"acls": []}'
+        mock_get.return_value = policy_response(acl)
+        mock_get.return_value.elapsed = timedelta(0)
+        events = []
+        client.add_hook(events.append)
+
+        client.update_acls(acl, skip_unchanged=True)
+        mock_get.return_value = policy_response(b'', status_code=304)
+        mock_get.return_value.elapsed = timedelta(0)
+        client.update_acls(acl, skip_unchanged=True)
+
+        assert [(e.method_name, e.cache) for e in events] == [('update_acls', None), ('update_acls', 'hit')]
+        mock_post.assert_not_called()
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_event_reports_transport_errors(self, mock_get, client):
+        mock_get.side_effect = ConnectionError('refused')
+        events = []
+        client.add_hook(events.append)
+
+        with pytest.raises(ConnectionError):
+            client.get_users()
+
+        assert events[0].status is None
+        assert isinstance(events[0].error, ConnectionError)
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_failing_hook_only_warns(self, mock_get, client):
+        mock_get.return_value = timed_response()
+
+        @client.add_hook
+        def broken(event):
+            raise ValueError('oops')
+
+        with pytest.warns(RuntimeWarning, match='oops'):
+            assert client.get_users() is mock_get.return_value
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_on_start_is_paired_with_every_event(self, mock_post, client):
+        mock_post.return_value = timed_response()
+        calls = []
+        client.add_hook(lambda e: calls.append(('end', e.endpoint, e.cache)),
+                        on_start=lambda verb, endpoint: calls.append(('start', endpoint)))
+
+        client.preview_acl_rules_many(b'{"acls": []}', users=['a@example.com'])
+        client.preview_acl_rules_many(b'{"acls": []}', users=['a@example.com'])
+
+        endpoint = '/tailnet/{tailnet}/acl/preview'
+        assert calls == [('start', endpoint), ('end', endpoint, None),
+                         ('start', endpoint), ('end', endpoint, 'hit')]
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_removed_hook_is_not_called(self, mock_get, client):
+        mock_get.return_value = timed_response()
+        events = []
+        client.add_hook(events.append)
+        client.remove_hook(events.append)
+
+        client.get_users()
+
+        assert events == []
+
+    @pytest.mark.parametrize('path, template', [
+        ('/tailnet/example.com/devices', '/tailnet/{tailnet}/devices'),
+        ('/tailnet/example.com/keys/k123', '/tailnet/{tailnet}/keys/{id}'),
+        ('/device/123/attributes/custom:tier', '/device/{id}/attributes/{key}'),
+        ('/device-invites/-/accept', '/device-invites/-/accept'),
+        ('/tailnet/example.com/logging/network/stream/status', '/tailnet/{tailnet}/logging/{log_type}/stream/status'),
+        ('/posture/integrations/pcn1', '/posture/integrations/{id}'),
+        ('/users/u1/role', '/users/{id}/role'),
+    ])
+    def test_endpoint_templates(self, path, template):
+        assert _endpoint_template(path) == template
+
+
 # ---------------------------------------------------------------------------
 # ACL methods
 # ---------------------------------------------------------------------------
@@ -93,6 +326,49 @@ class TestAcls:
             data=acl,
         )
 
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_update_acls_skips_unchanged_policy(self, mock_get, mock_post, client):
+        mock_get.return_value = policy_response(b'{"acls": [{"action": "accept"}], "tagOwners": {}}')
+        acl = b'''{
+            // comments, ordering and trailing commas are ignored
+            "tagOwners": {},
+            "acls": [{"action": "accept",},],
+        }'''
+        resp = client.update_acls(acl, skip_unchanged=True)
+        assert resp is mock_get.return_value
+        mock_post.assert_not_called()
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_update_acls_changed_policy_sends_if_match(self, mock_get, mock_post, client):
+        mock_get.return_value = policy_response(b'{"acls": []}', etag='"v1"')
+        mock_post.return_value = policy_response(b'{"acls": [{"action": "accept"}]}', etag='"v2"')
+        acl = b'{"acls": [{"action": "accept"}]}'
+        client.update_acls(acl, skip_unchanged=True)
+        mock_post.assert_called_once_with(
+            f'{BASE_URL}/tailnet/{TAILNET}/acl',
+            auth=client._auth,
+            headers={**client._headers, 'If-Match': '"v1"'},
+            data=acl,
+        )
+
+        # The next call revalidates the cached policy instead of downloading it again
+        mock_get.return_value = policy_response(b'', status_code=304)
+        resp = client.update_acls(acl, skip_unchanged=True)
+        assert mock_get.call_args.kwargs['headers']['If-None-Match'] == '"v2"'
+        assert resp is mock_post.return_value
+        assert mock_post.call_count == 1
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_update_acls_conflict_clears_cache(self, mock_get, mock_post, client):
+        mock_get.return_value = policy_response(b'{"acls": []}')
+        mock_post.return_value = policy_response(b'', status_code=412)
+        resp = client.update_acls(b'{"acls": [{"action": "accept"}]}', skip_unchanged=True)
+        assert resp.status_code == 412
+        assert client._acl_cache is None
+
     @patch('tailscale_agent.tailscale_agent.requests.post')
     def test_preview_acl_rules(self, mock_post, client):
         mock_post.return_value = mock_response()
@@ -105,6 +381,50 @@ class TestAcls:
             data=acl,
         )
 
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_preview_acl_rules_many_dedupes_and_caches(self, mock_post, client):
+        mock_post.side_effect = lambda url, **kwargs: mock_response(json_data={'url': url})
+        acl = b'{"acls": []}'
+        results = client.preview_acl_rules_many(
+            acl, users=['a@example.com', 'b@example.com', 'a@example.com'], ipports=['100.64.0.1:22'])
+        assert mock_post.call_count == 3
+        assert set(results['user']) == {'a@example.com', 'b@example.com'}
+        assert results['ipport']['100.64.0.1:22'].json()['url'].endswith('type=ipport&previewFor=100.64.0.1:22')
+
+        # Same policy, reformatted: everything is served from the cache
+        again = client.preview_acl_rules_many(b'{ "acls": [ ] }', users=['b@example.com'])
+        assert mock_post.call_count == 3
+        assert again['user']['b@example.com'] is results['user']['b@example.com']
+
+        # A changed policy invalidates the cache
+        client.preview_acl_rules_many(b'{"acls": [{"action": "accept"}]}', users=['b@example.com'])
+        assert mock_post.call_count == 4
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_preview_acl_rules_many_does_not_cache_errors(self, mock_post, client):
+        mock_post.return_value = mock_response(status_code=500)
+        acl = b'{"acls": []}'
+        results = client.preview_acl_rules_many(acl, users=['a@example.com'])
+        assert results['user']['a@example.com'].status_code == 500
+        client.preview_acl_rules_many(acl, users=['a@example.com'])
+        assert mock_post.call_count == 2
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_preview_acl_rules_many_reports_exceptions_per_entry(self, mock_post, client):
+        def fake_post(url, **kwargs):
+            if 'b@example.com' in url:
+                raise ConnectionError('reset')
+            return mock_response(json_data={'url': url})
+
+        mock_post.side_effect = fake_post
+        results = client.preview_acl_rules_many(
+            b'{"acls": []}', users=['a@example.com', 'b@example.com', 'c@example.com'], ipports=['100.64.0.1:22'])
+
+        assert sorted(results['user']) == ['a@example.com', 'c@example.com']
+        assert list(results['ipport']) == ['100.64.0.1:22']
+        assert list(results['errors']) == [('user', 'b@example.com')]
+        assert isinstance(results['errors'][('user', 'b@example.com')], ConnectionError)
+
 
 # ---------------------------------------------------------------------------
 # Device methods
@@ -336,6 +656,24 @@ class TestDeviceInvites:
             json=invites,
         )
 
+    def test_create_device_invites_many(self):
+        from tailscale_agent.fakeapi import FakeTailscaleAPI
+        api = FakeTailscaleAPI(devices=1)
+        device_id = next(iter(api.devices.values()))['id']
+        client = memory_client(api)
+
+        invites = [{'email': f'friend{i}@example.com'} for i in range(9)] + [{'email': 'nobody'}]
+        report = client.create_device_invites_many(device_id, invites, chunk_size=4)
+
+        assert len(report.created) == 9
+        assert {invite['deviceId'] for invite in report.created} == {device_id}
+        assert [r.item for r in report.failed] == [{'email': 'nobody'}]
+
+        # A missing device fails each chunk once rather than every entry
+        report = client.create_device_invites_many('missing', invites, chunk_size=4)
+        assert len(report.failed) == 10
+        assert {r.response.status_code for r in report.failed} == {404}
+
     @patch('tailscale_agent.tailscale_agent.requests.get')
     def test_get_device_invite(self, mock_get, client):
         mock_get.return_value = mock_response()
@@ -484,6 +822,14 @@ class TestKeys:
         )
 
 
+DNS_CONFIGURATION = {
+    'nameservers': [{'address': '8.8.8.8'}],
+    'splitDNS': {'corp.example.com': [{'address': '10.0.0.53'}]},
+    'searchPaths': ['corp.example.com'],
+    'preferences': {'magicDNS': True},
+}
+
+
 # ---------------------------------------------------------------------------
 # DNS methods
 # ---------------------------------------------------------------------------
@@ -631,6 +977,66 @@ class TestDns:
             json={'nameservers': ['8.8.8.8']},
         )
 
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_apply_dns_configuration_no_changes(self, mock_get, mock_post, client):
+        mock_get.return_value = mock_response(json_data=DNS_CONFIGURATION)
+        writes = client.apply_dns_configuration(
+            nameservers=['8.8.8.8'],
+            split_dns={'corp.example.com': ['10.0.0.53']},
+            search_paths=['corp.example.com'],
+            preferences={'magicDNS': True},
+        )
+        assert writes == []
+        mock_get.assert_called_once()
+        mock_post.assert_not_called()
+
+    @patch('tailscale_agent.tailscale_agent.requests.patch')
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_apply_dns_configuration_minimal_writes(self, mock_get, mock_post, mock_patch, client):
+        mock_get.return_value = mock_response(json_data=DNS_CONFIGURATION)
+        mock_post.return_value = mock_response()
+        mock_patch.return_value = mock_response()
+        writes = client.apply_dns_configuration(
+            nameservers=['8.8.8.8'],
+            split_dns={'lab.example.com': ['10.1.0.53']},
+            preferences={'magicDNS': False},
+        )
+        assert [name for name, _ in writes] == ['update_split_dns', 'set_dns_preferences']
+        mock_patch.assert_called_once_with(
+            f'{BASE_URL}/tailnet/{TAILNET}/dns/split-dns',
+            auth=client._auth,
+            headers=client._headers,
+            json={'lab.example.com': ['10.1.0.53'], 'corp.example.com': None},
+        )
+        mock_post.assert_called_once_with(
+            f'{BASE_URL}/tailnet/{TAILNET}/dns/preferences',
+            auth=client._auth,
+            headers=client._headers,
+            json={'magicDNS': False},
+        )
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_apply_dns_configuration_other_preferences_use_full_write(self, mock_get, mock_post, client):
+        mock_get.return_value = mock_response(json_data=DNS_CONFIGURATION)
+        mock_post.return_value = mock_response()
+        writes = client.apply_dns_configuration(search_paths=[], preferences={'overrideLocalDNS': True})
+        assert [name for name, _ in writes] == ['set_dns_configuration']
+        assert mock_post.call_args.kwargs['json'] == {
+            'nameservers': DNS_CONFIGURATION['nameservers'],
+            'splitDNS': DNS_CONFIGURATION['splitDNS'],
+            'searchPaths': [],
+            'preferences': {'magicDNS': True, 'overrideLocalDNS': True},
+        }
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_apply_dns_configuration_read_failure(self, mock_get, client):
+        mock_get.return_value = mock_response(status_code=403)
+        writes = client.apply_dns_configuration(nameservers=['8.8.8.8'])
+        assert writes == [('get_dns_configuration', mock_get.return_value)]
+
 
 # ---------------------------------------------------------------------------
 # Logs methods
@@ -770,6 +1176,157 @@ class TestOAuth:
         client.get_oauth_token('bad-id', 'bad-secret', client_embed=True)
         assert client._api_key == API_KEY  # unchanged
 
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_get_oauth_token_auto_refresh_schedules_refresh(self, mock_post, client):
+        mock_post.return_value = mock_response(json_data={'access_token': 'new-token', 'expires_in': 3600})
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True)
+        try:
+            assert client._token_timer is not None
+            assert client._token_timer.daemon
+            assert client._token_timer.interval == 3600 - 300
+        finally:
+            client.close()
+        assert client._token_timer is None
+        assert client._oauth_credentials is None
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_401_refreshes_token_and_retries_once(self, mock_post, mock_get, client):
+        mock_post.side_effect = [
+            mock_response(json_data={'access_token': 'token-1'}),
+            mock_response(json_data={'access_token': 'token-2'}),
+        ]
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True)
+        mock_get.side_effect = [mock_response(status_code=401), mock_response()]
+
+        resp = client.get_devices()
+
+        assert resp.status_code == 200
+        assert mock_get.call_count == 2
+        assert mock_get.call_args_list[0].kwargs['auth'].username == 'token-1'
+        assert mock_get.call_args_list[1].kwargs['auth'].username == 'token-2'
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_expiring_token_refreshed_before_request(self, mock_post, mock_get, client):
+        mock_post.side_effect = [
+            mock_response(json_data={'access_token': 'token-1'}),
+            mock_response(json_data={'access_token': 'token-2'}),
+        ]
+        mock_get.return_value = mock_response()
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True)
+        client._token_refresh_at = 0
+
+        client.get_devices()
+
+        assert mock_post.call_count == 2
+        assert mock_get.call_args.kwargs['auth'].username == 'token-2'
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_concurrent_refreshes_are_deduplicated(self, mock_post, client):
+        mock_post.side_effect = [
+            mock_response(json_data={'access_token': 'token-1'}),
+            mock_response(json_data={'access_token': 'token-2'}),
+        ]
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True)
+
+        # Both callers saw token-1 fail; only the first one exchanges credentials
+        assert client._refresh_oauth_token('token-1')
+        assert client._refresh_oauth_token('token-1')
+        assert mock_post.call_count == 2
+        assert client._api_key == 'token-2'
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_failed_refresh_backs_off(self, mock_post, mock_get, client, capsys):
+        mock_post.side_effect = [
+            mock_response(json_data={'access_token': 'token-1', 'expires_in': 3600}),
+            mock_response(status_code=500, json_data={'message': 'unavailable'}),
+            mock_response(status_code=500, json_data={'message': 'unavailable'}),
+        ]
+        mock_get.return_value = mock_response()
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True)
+        client._token_refresh_at = 0
+        try:
+            with pytest.warns(RuntimeWarning, match='retrying in 10s'):
+                for _ in range(5):
+                    client.get_devices()
+            assert mock_post.call_count == 2
+            assert client._token_timer.interval == 10
+
+            # The timer fires once the delay has passed
+            client._token_refresh_at = 0
+            with pytest.warns(RuntimeWarning, match='retrying in 20s'):
+                client._refresh_oauth_token('token-1')
+        finally:
+            client.close()
+
+        # The current token stays in use, and nothing is printed
+        assert mock_get.call_args.kwargs['auth'].username == 'token-1'
+        assert capsys.readouterr().out == ''
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_401s_do_not_bypass_the_refresh_backoff(self, mock_post, mock_get, client):
+        mock_post.side_effect = [mock_response(json_data={'access_token': 'token-1', 'expires_in': 3600})] + [
+            mock_response(status_code=500, json_data={'message': 'unavailable'})] * 5
+        mock_get.return_value = mock_response(status_code=401)
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True)
+        try:
+            with pytest.warns(RuntimeWarning, match='retrying in 10s') as record:
+                statuses = [client.get_devices().status_code for _ in range(5)]
+            # One failed exchange, then each 401 goes back to the caller until the backoff has passed
+            assert statuses == [401] * 5
+            assert mock_post.call_count == 2
+            assert len(record) == 1
+            assert client._token_timer.interval == 10
+        finally:
+            client.close()
+
+    @patch('tailscale_agent.tailscale_agent.requests.get')
+    def test_401_without_oauth_is_returned(self, mock_get, client):
+        mock_get.return_value = mock_response(status_code=401)
+        assert client.get_devices().status_code == 401
+        mock_get.assert_called_once()
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_get_oauth_token_scopes(self, mock_post, client):
+        mock_post.return_value = mock_response(json_data={'access_token': 'new-token'})
+        client.get_oauth_token('client-id', 'client-secret', scopes=['devices:core', 'dns'])
+        assert mock_post.call_args.kwargs['data']['scope'] == 'devices:core dns'
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_get_oauth_token_shared_through_cache(self, mock_post, tmp_path):
+        mock_post.return_value = mock_response(
+            status_code=200, json_data={'access_token': 'shared-token', 'expires_in': 3600})
+        cache = FileTokenCache(tmp_path)
+
+        first = Tailscale(api_key='', base_url=BASE_URL, tailnet=TAILNET)
+        first.get_oauth_token('client-id', 'client-secret', token_cache=cache)
+
+        second = Tailscale(api_key='', base_url=BASE_URL, tailnet=TAILNET)
+        resp = second.get_oauth_token('client-id', 'client-secret', token_cache=cache)
+
+        mock_post.assert_called_once()
+        assert resp.status_code == 200
+        assert second._api_key == 'shared-token'
+        assert second._token_refresh_at is not None
+
+    @patch('tailscale_agent.tailscale_agent.requests.post')
+    def test_refresh_through_cache_replaces_stale_token(self, mock_post, client):
+        mock_post.side_effect = [
+            mock_response(status_code=200, json_data={'access_token': 'token-1', 'expires_in': 3600}),
+            mock_response(status_code=200, json_data={'access_token': 'token-2', 'expires_in': 3600}),
+        ]
+        client.get_oauth_token('client-id', 'client-secret', auto_refresh=True, token_cache=MemoryTokenCache())
+        try:
+            # token-1 is still cached, but it is the token being replaced
+            assert client._refresh_oauth_token('token-1')
+        finally:
+            client.close()
+        assert client._api_key == 'token-2'
+        assert mock_post.call_count == 2
+
 
 # ---------------------------------------------------------------------------
 # Tailnet Settings methods
@@ -979,6 +1536,176 @@ class TestUsers:
         )
 
 
+class TestBulkUsers:
+    def test_results_stream_per_user(self):
+        calls = []
+
+        def handler(method, path, headers, body):
+            calls.append((method, path, body))
+            return (404, {}, b'{}') if 'missing' in path else (200, {}, b'{}')
+
+        results = list(memory_client(handler).suspend_users(['u1', 'missing', 'u3'], concurrency=2))
+
+        assert sorted((r.item, r.response.status_code, r.error) for r in results) == [
+            ('missing', 404, None), ('u1', 200, None), ('u3', 200, None)]
+        assert sorted(path for _, path, _ in calls) == [
+            '/api/v2/users/missing/suspend', '/api/v2/users/u1/suspend', '/api/v2/users/u3/suspend']
+
+    def test_update_user_roles_takes_a_mapping(self):
+        bodies = {}
+
+        def handler(method, path, headers, body):
+            bodies[path] = body
+            return 200, {}, b'{}'
+
+        results = list(memory_client(handler).update_user_roles({'u1': 'admin', 'u2': 'auditor'}))
+
+        assert sorted(r.item for r in results) == [('u1', 'admin'), ('u2', 'auditor')]
+        assert bodies['/api/v2/users/u2/role'] == b'{"role": "auditor"}'
+
+    def test_errors_do_not_stop_the_batch(self):
+        def handler(method, path, headers, body):
+            if 'u2' in path:
+                raise ConnectionError('reset')
+            return 200, {}, b'{}'
+
+        results = {r.item: r for r in memory_client(handler).delete_users(['u1', 'u2', 'u3'])}
+
+        assert isinstance(results['u2'].error, ConnectionError)
+        assert results['u2'].response is None
+        assert results['u1'].response.status_code == results['u3'].response.status_code == 200
+
+    def test_concurrency_follows_throttling(self):
+        active, peak = [0], [0]
+        lock = threading.Lock()
+
+        def handler(method, path, headers, body):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.005)
+            with lock:
+                active[0] -= 1
+            return (429, {'Retry-After': '0'}, b'{}') if path.endswith('7/approve') else (200, {}, b'{}')
+
+        concurrency = AdaptiveConcurrency(initial=2, maximum=6, latency_target=1)
+        results = list(memory_client(handler).approve_users((f'u{i}' for i in range(40)), concurrency))
+
+        assert len(results) == 40
+        assert sum(r.response.status_code == 429 for r in results) == 4
+        assert 2 <= peak[0] <= 6
+
+    def test_closing_the_stream_stops_new_calls(self):
+        calls = []
+
+        def handler(method, path, headers, body):
+            calls.append(path)
+            # Slow enough that the workers cannot race far ahead before the stream is closed
+            time.sleep(0.01)
+            return 200, {}, b'{}'
+
+        stream = memory_client(handler).restore_users((f'u{i}' for i in range(1000)), concurrency=2)
+        next(stream)
+        stream.close()
+        time.sleep(0.05)
+
+        assert len(calls) < 10
+
+    def test_closing_during_a_submit_gives_back_the_slot(self):
+        from concurrent.futures import ThreadPoolExecutor
+        submitting, closed = threading.Event(), threading.Event()
+
+        class SlowSubmitExecutor(ThreadPoolExecutor):
+            submits = 0
+
+            def submit(self, *args, **kwargs):
+                SlowSubmitExecutor.submits += 1
+                if SlowSubmitExecutor.submits == 2:
+                    # The stream is closed between the feeder's stopped check and its submit
+                    submitting.set()
+                    closed.wait(0.2)
+                return super().submit(*args, **kwargs)
+
+        concurrency = AdaptiveConcurrency(initial=4, maximum=4)
+        with patch('concurrent.futures.ThreadPoolExecutor', SlowSubmitExecutor):
+            stream = memory_client(lambda *request: (200, {}, b'{}')).approve_users(['u1', 'u2', 'u3'], concurrency)
+            next(stream)
+            assert submitting.wait(2)
+            stream.close()
+            closed.set()
+
+        deadline = time.monotonic() + 2
+        while concurrency._in_flight:
+            assert time.monotonic() < deadline, 'a concurrency slot leaked'
+            time.sleep(0.005)
+
+
+class TestMap:
+    def test_map_calls_a_method_per_argument(self):
+        def handler(method, path, headers, body):
+            if path.endswith('/gone'):
+                return 404, {}, b'{"message": "not found"}'
+            if 'broken' in path:
+                raise ConnectionError('reset')
+            return 200, {}, ('{"id": "%s"}' % path.rsplit('/', 1)[-1]).encode()
+
+        client = memory_client(handler)
+        results = {r.item: r for r in client.map('get_device', ['d1', 'gone', 'broken', 'd4'], concurrency=2)}
+
+        assert results['d1'].response.json() == {'id': 'd1'}
+        assert results['gone'].response.status_code == 404
+        assert isinstance(results['broken'].error, ConnectionError)
+        assert results['d4'].error is None
+
+    def test_map_unpacks_tuples_and_accepts_bound_methods(self):
+        bodies = []
+
+        def handler(method, path, headers, body):
+            bodies.append((path, body))
+            return 200, {}, b'{}'
+
+        client = memory_client(handler)
+        results = list(client.map(client.update_device_tags, [('d1', ['tag:a']), ('d2', ['tag:b'])]))
+
+        assert sorted(r.item for r in results) == [('d1', ['tag:a']), ('d2', ['tag:b'])]
+        assert sorted(bodies) == [('/api/v2/device/d1/tags', b'{"tags": ["tag:a"]}'),
+                                  ('/api/v2/device/d2/tags', b'{"tags": ["tag:b"]}')]
+
+    def test_map_ordered_yields_in_input_order(self):
+        def handler(method, path, headers, body):
+            # Later devices answer first
+            time.sleep(0.002 * (20 - int(path.rsplit('d', 1)[-1])))
+            return 200, {}, b'{}'
+
+        client = memory_client(handler)
+        ids = [f'd{i}' for i in range(20)]
+
+        assert [r.item for r in client.map('get_device', ids, concurrency=8, ordered=True)] == ids
+
+    def test_map_uses_the_client_retries(self):
+        attempts = []
+
+        def handler(method, path, headers, body):
+            attempts.append(path)
+            return (429, {'Retry-After': '0'}, b'{}') if len(attempts) == 1 else (200, {}, b'{}')
+
+        client = memory_client(handler, max_retries=1)
+        results = list(client.map('get_device', ['d1']))
+
+        assert results[0].response.status_code == 200
+        assert len(attempts) == 2
+
+    @pytest.mark.parametrize('method', ['_request', 'no_such_method', 'close_enough'])
+    def test_map_rejects_unknown_methods(self, client, method):
+        with pytest.raises(ValueError):
+            client.map(method, [])
+
+    def test_map_rejects_methods_of_other_clients(self, client):
+        other = Tailscale(api_key=API_KEY, base_url=BASE_URL, tailnet=TAILNET)
+        with pytest.raises(ValueError):
+            client.map(other.get_device, [])
+
+
 # ---------------------------------------------------------------------------
 # User Invite methods
 # ---------------------------------------------------------------------------
@@ -1036,6 +1763,69 @@ class TestUserInvites:
             headers=client._headers,
         )
 
+    def test_create_user_invites_many_isolates_bad_entries(self):
+        from tailscale_agent.fakeapi import FakeTailscaleAPI
+        api = FakeTailscaleAPI()
+        sizes = []
+
+        def handler(method, path, headers, body):
+            sizes.append(body.count(b'"email"'))
+            return api.handle(method, path, headers, body)
+
+        client = memory_client(handler)
+        invites = [{'role': 'member', 'email': f'user{i}@example.com'} for i in range(25)]
+        invites[7] = {'role': 'member', 'email': 'not-an-address'}
+        invites[20] = {'role': 'superuser', 'email': 'user20@example.com'}
+        report = client.create_user_invites_many(invites, chunk_size=10, concurrency=3)
+
+        assert [invite['email'] for invite in report.created] == [
+            entry['email'] for i, entry in enumerate(invites) if i not in (7, 20)]
+        assert [(r.item, r.response.status_code) for r in report.failed] == [(invites[7], 400), (invites[20], 400)]
+        assert len(api.user_invites) == 23
+        # Three chunks, then log2(10) halvings for each chunk holding a bad entry
+        assert max(sizes) == 10 and len(sizes) < 20
+
+    def test_create_user_invites_many_does_not_split_auth_errors(self):
+        calls = []
+
+        def handler(method, path, headers, body):
+            calls.append(path)
+            return 403, {}, b'{"message": "forbidden"}'
+
+        invites = [{'email': f'user{i}@example.com'} for i in range(6)]
+        report = memory_client(handler).create_user_invites_many(invites, chunk_size=3)
+
+        assert report.created == []
+        assert [r.item for r in report.failed] == invites
+        assert len(calls) == 2
+
+    def test_create_user_invites_many_requeues_throttled_chunks(self):
+        from tailscale_agent.fakeapi import FakeTailscaleAPI
+        from tailscale_agent.tailscale_agent import AdaptiveConcurrency
+        api = FakeTailscaleAPI()
+        throttled = [2]
+        seen = []
+
+        class RecordingConcurrency(AdaptiveConcurrency):
+            def release(self, latency=None, throttled=False):
+                seen.append(throttled)
+                super().release(latency, throttled)
+
+        def handler(method, path, headers, body):
+            if throttled[0]:
+                throttled[0] -= 1
+                return 429, {'Retry-After': '0'}, b'{"message": "rate limited"}'
+            return api.handle(method, path, headers, body)
+
+        client = memory_client(handler, max_retries=0)
+        invites = [{'role': 'member', 'email': f'user{i}@example.com'} for i in range(12)]
+        report = client.create_user_invites_many(invites, chunk_size=3, concurrency=RecordingConcurrency())
+
+        assert [invite['email'] for invite in report.created] == [entry['email'] for entry in invites]
+        assert report.failed == []
+        # Four chunks and two resent ones, and the limiter saw both 429s
+        assert sorted(seen) == [False] * 4 + [True] * 2
+
 
 # ---------------------------------------------------------------------------
 # Webhook methods
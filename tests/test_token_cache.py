@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from tailscale_agent.token_cache import FileTokenCache, MemoryTokenCache, token_cache_key, fcntl
+
+
+TOKEN = {'access_token': 'tok-1', 'token_type': 'Bearer', 'expires_in': 3600}
+
+
+def test_token_cache_key_ignores_scope_order():
+    assert token_cache_key('id', ['dns', 'devices']) == token_cache_key('id', ['devices', 'dns'])
+    assert token_cache_key('id') != token_cache_key('id', ['dns'])
+
+
+@pytest.mark.parametrize('make_cache', [MemoryTokenCache, None])
+def test_put_and_get(tmp_path, make_cache):
+    cache = make_cache() if make_cache else FileTokenCache(tmp_path)
+    assert cache.get('key') is None
+
+    cache.put('key', TOKEN)
+    token = cache.get('key')
+    assert token['access_token'] == 'tok-1'
+    assert 3590 <= token['expires_in'] <= 3600
+    assert 'expires_at' not in token
+
+
+def test_tokens_near_expiry_are_not_returned(tmp_path):
+    cache = FileTokenCache(tmp_path, min_ttl=120)
+    cache.put('key', {**TOKEN, 'expires_in': 60})
+    assert cache.get('key') is None
+
+
+def test_tokens_without_expiry_are_not_cached():
+    cache = MemoryTokenCache()
+    cache.put('key', {'access_token': 'tok-1'})
+    assert cache.get('key') is None
+
+
+def test_file_cache_is_private_and_survives_new_instances(tmp_path):
+    FileTokenCache(tmp_path).put('key', TOKEN)
+    files = [f for f in os.listdir(tmp_path) if f.endswith('.json')]
+    assert len(files) == 1
+    assert os.stat(tmp_path / files[0]).st_mode & 0o077 == 0
+    assert FileTokenCache(tmp_path).get('key')['access_token'] == 'tok-1'
+
+
+def test_file_cache_ignores_corrupt_files(tmp_path):
+    cache = FileTokenCache(tmp_path)
+    cache.put('key', TOKEN)
+    for name in os.listdir(tmp_path):
+        (tmp_path / name).write_text('not json')
+    assert cache.get('key') is None
+
+
+def _fetch_once(directory, log_path):
+    cache = FileTokenCache(directory)
+    with cache.lock('key'):
+        if cache.get('key') is None:
+            time.sleep(0.05)
+            with open(log_path, 'a') as f:
+                f.write('fetch\n')
+            cache.put('key', TOKEN)
+
+
+@pytest.mark.skipif(fcntl is None, reason='cross-process locking needs fcntl')
+def test_only_one_process_fetches(tmp_path):
+    log_path = tmp_path / 'fetches.log'
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_fetch_once, args=(tmp_path / 'cache', log_path)) for _ in range(6)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(10)
+        assert proc.exitcode == 0
+
+    assert log_path.read_text() == 'fetch\n'
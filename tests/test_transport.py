@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.tailscale_agent import Tailscale
+from tailscale_agent.transport import MemoryTransport, RequestsTransport, Urllib3Transport
+from tests.helpers import memory_client
+
+
+@pytest.fixture(scope='module')
+def api():
+    with FakeTailscaleAPI(devices=5, keys=1) as api:
+        yield api
+
+
+def test_memory_transport_serves_fake_api_without_sockets():
+    api = FakeTailscaleAPI(devices=3)
+    client = memory_client(api, api.tailnet)
+
+    devices = client.get_devices()
+    assert devices.status_code == 200
+    assert len(devices.json()['devices']) == 3
+    assert devices.request.method == 'GET'
+    assert devices.url == f'http://fake.invalid/api/v2/tailnet/{api.tailnet}/devices'
+
+    device_id = devices.json()['devices'][0]['id']
+    assert client.set_device_name(device_id, 'renamed').status_code == 200
+    assert client.get_device(device_id).json()['name'].startswith('renamed')
+    assert client.get_device('missing').status_code == 404
+
+
+def test_memory_transport_passes_the_request_to_the_handler():
+    calls = []
+
+    def handler(method, path, headers, body):
+        calls.append((method, path, headers, body))
+        return 200, {'Content-Type': 'application/json; charset=utf-8'}, b'{"ok": true}'
+
+    client = memory_client(handler)
+    response = client.update_device_tags('123', ['tag:a'])
+
+    method, path, headers, body = calls[0]
+    assert (method, path) == ('POST', '/api/v2/device/123/tags')
+    assert headers['Authorization'].startswith('Basic ')
+    assert headers['Content-Type'] == 'application/json'
+    assert json.loads(body) == {'tags': ['tag:a']}
+    assert response.json() == {'ok': True}
+    assert response.encoding == 'utf-8'
+
+
+def test_memory_transport_keeps_query_and_form_bodies():
+    calls = []
+
+    def handler(method, path, headers, body):
+        calls.append((path, body))
+        return 200, {}, b'{}'
+
+    transport = MemoryTransport(handler)
+    transport.request('get', 'http://fake.invalid/api/v2/x?fields=all')
+    transport.request('post', 'http://fake.invalid/api/v2/y', data={'a': '1', 'b': '2'})
+
+    assert calls == [('/api/v2/x?fields=all', b''), ('/api/v2/y', b'a=1&b=2')]
+
+
+def test_memory_transport_retries_server_errors():
+    statuses = iter([503, 200])
+
+    def handler(method, path, headers, body):
+        return next(statuses), {'Retry-After': '0'}, b'{}'
+
+    client = memory_client(handler, max_retries=1)
+
+    assert client.get_users().status_code == 200
+
+
+@pytest.mark.parametrize('transport_class', [RequestsTransport, Urllib3Transport])
+def test_network_transports(api, transport_class):
+    transport = transport_class(timeout=5)
+    client = Tailscale('tskey-fake', api.base_url, api.tailnet, transport=transport)
+    try:
+        devices = client.get_devices()
+        assert devices.status_code == 200
+        assert len(devices.json()['devices']) == 5
+        assert devices.elapsed.total_seconds() > 0
+
+        created = client.create_authorization_key({'capabilities': {'devices': {'create': {}}}})
+        assert created.status_code == 200
+        assert created.request.method == 'POST'
+        assert client.get_device('missing').status_code == 404
+    finally:
+        transport.close()
+
+
+def test_session_and_transport_are_exclusive():
+    with pytest.raises(ValueError):
+        Tailscale('tskey-abc', 'http://fake.invalid/api/v2', session=object(), transport=object())
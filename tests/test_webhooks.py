@@ -0,0 +1,232 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.tailscale_agent import Tailscale
+from tailscale_agent.webhooks import (SIGNATURE_HEADER, ExpiringSet, SignatureError, WebhookReceiver, event_id,
+                                      parse_events, resource_key, sign, verify_signature)
+from tests.helpers import wait_for
+
+
+SECRET = 'tskey-webhook-abc'
+
+
+def delivery(events, secret=SECRET, timestamp=None):
+    body = json.dumps(events).encode('utf-8')
+    return {SIGNATURE_HEADER: sign(secret, body, timestamp)}, body
+
+
+def node_event(node_id='n1', event_type='nodeCreated', timestamp='2025-01-01T00:00:00Z'):
+    return {'timestamp': timestamp, 'version': 1, 'type': event_type, 'tailnet': 'example.com',
+            'message': '', 'data': {'nodeID': node_id}}
+
+
+def test_verify_signature():
+    body = b'[{"type": "test"}]'
+    header = sign(SECRET, body, timestamp=1700000000)
+
+    assert verify_signature(SECRET, body, header, now=1700000010) == 1700000000
+    # Any of several secrets is accepted while a secret is being rotated
+    assert verify_signature(['tskey-webhook-old', SECRET], body, header, now=1700000010) == 1700000000
+
+
+@pytest.mark.parametrize('secret, body, header, now', [
+    ('wrong', b'[]', sign(SECRET, b'[]', 1700000000), 1700000000),
+    (SECRET, b'[1]', sign(SECRET, b'[]', 1700000000), 1700000000),
+    (SECRET, b'[]', sign(SECRET, b'[]', 1700000000), 1700001000),
+    (SECRET, b'[]', 'v1=abc', 1700000000),
+    (SECRET, b'[]', None, 1700000000),
+])
+def test_verify_signature_rejects(secret, body, header, now):
+    with pytest.raises(SignatureError):
+        verify_signature(secret, body, header, now=now)
+
+
+def test_parse_events():
+    assert parse_events(b'{"type": "test"}') == [{'type': 'test'}]
+    with pytest.raises(ValueError):
+        parse_events(b'[1, 2]')
+
+
+def test_events_are_batched():
+    batches = []
+    receiver = WebhookReceiver(SECRET, batches.append, workers=1, batch_size=3, batch_interval=0.2)
+    receiver.start(serve=False)
+    try:
+        for i in range(5):
+            assert receiver.handle(*delivery([node_event(f'n{i}')]))[0] == 200
+        wait_for(lambda: sum(map(len, batches)) == 5)
+    finally:
+        receiver.stop()
+
+    assert [len(b) for b in batches] == [3, 2]
+    assert [e['data']['nodeID'] for b in batches for e in b] == ['n0', 'n1', 'n2', 'n3', 'n4']
+    assert receiver.stats()['batches'] == 2
+
+
+def test_bad_deliveries_are_rejected():
+    receiver = WebhookReceiver(SECRET, lambda events: None)
+
+    assert receiver.handle(*delivery([node_event()], secret='wrong'))[0] == 401
+    assert receiver.handle({SIGNATURE_HEADER: sign(SECRET, b'not json')}, b'not json')[0] == 400
+    assert receiver.handle(*delivery([]))[0] == 200
+
+    stats = receiver.stats()
+    assert (stats['rejected_signature'], stats['rejected_malformed'], stats['deliveries']) == (1, 1, 1)
+
+
+def test_full_buffer_pushes_back():
+    release = threading.Event()
+    receiver = WebhookReceiver(SECRET, lambda events: release.wait(), workers=1, batch_size=1,
+                               batch_interval=0, max_pending=2, retry_after=7)
+    receiver.start(serve=False)
+    try:
+        receiver.handle(*delivery([node_event('n0')]))
+        wait_for(lambda: receiver.stats()['pending'] == 0)
+        assert receiver.handle(*delivery([node_event('n1'), node_event('n2')]))[0] == 200
+        status, headers, _ = receiver.handle(*delivery([node_event('n3')]))
+        assert (status, headers['Retry-After']) == (503, '7')
+    finally:
+        release.set()
+        receiver.stop()
+
+    assert receiver.stats()['events_handled'] == 3
+    assert 'tailscale_webhook_rejected_total{reason="full"} 1' in receiver.render()
+
+
+def test_handler_errors_become_warnings():
+    receiver = WebhookReceiver(SECRET, lambda events: 1 / 0, batch_interval=0)
+    receiver.start(serve=False)
+    with pytest.warns(RuntimeWarning, match='ZeroDivisionError'):
+        receiver.handle(*delivery([node_event()]))
+        receiver.stop()
+
+    assert receiver.stats()['events_failed'] == 1
+
+
+def test_expiring_set():
+    now = [0.0]
+    seen = ExpiringSet(ttl=10, max_size=3, clock=lambda: now[0])
+
+    assert seen.add('a') and not seen.add('a')
+    now[0] = 5
+    assert seen.add('b') and seen.add('c') and seen.add('d')
+    # Over max_size: the oldest key is forgotten first
+    assert 'a' not in seen and len(seen) == 3
+    now[0] = 15.5
+    assert 'b' not in seen and len(seen) == 0
+    assert seen.add('b')
+
+
+def test_event_id_and_resource_key():
+    event = node_event('n1')
+
+    assert event_id(event) == event_id(json.loads(json.dumps(event))) != event_id(node_event('n2'))
+    assert event_id({**event, 'id': 42}) == '42'
+    assert resource_key(event) == 'device:n1'
+    assert resource_key({'type': 'userApproved', 'data': {'user': 'a@example.com'}}) == 'user:a@example.com'
+    assert resource_key({'type': 'policyUpdate', 'data': {}}) is None
+
+
+def test_repeated_deliveries_are_dropped():
+    received = []
+    receiver = WebhookReceiver(SECRET, received.extend, batch_interval=0)
+    receiver.start(serve=False)
+    try:
+        first = delivery([node_event('n1'), node_event('n2')])
+        assert receiver.handle(*first)[0] == 200
+        # A retry of the same delivery, and a delivery repeating one event twice
+        assert receiver.handle(*first)[0] == 200
+        assert receiver.handle(*delivery([node_event('n1'), node_event('n3'), node_event('n3')]))[0] == 200
+        wait_for(lambda: len(received) == 3)
+    finally:
+        receiver.stop()
+
+    assert sorted(e['data']['nodeID'] for e in received) == ['n1', 'n2', 'n3']
+    assert receiver.stats()['events_duplicate'] == 4
+
+
+def test_refused_deliveries_are_not_remembered():
+    release = threading.Event()
+    receiver = WebhookReceiver(SECRET, lambda events: release.wait(), workers=1, batch_size=1,
+                               batch_interval=0, max_pending=1)
+    receiver.start(serve=False)
+    try:
+        receiver.handle(*delivery([node_event('n0')]))
+        wait_for(lambda: receiver.stats()['pending'] == 0)
+        receiver.handle(*delivery([node_event('n1')]))
+        retried = delivery([node_event('n2')])
+        assert receiver.handle(*retried)[0] == 503
+        release.set()
+        wait_for(lambda: receiver.stats()['pending'] == 0)
+        assert receiver.handle(*retried)[0] == 200
+    finally:
+        release.set()
+        receiver.stop()
+
+    assert receiver.stats()['events_handled'] == 3
+
+
+def test_events_about_one_resource_are_handled_in_order():
+    handled = {}
+    active = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def handler(events):
+        for event in events:
+            node = event['data']['nodeID']
+            with lock:
+                if node in active:
+                    overlaps.append(node)
+                active.add(node)
+            time.sleep(0.001)
+            with lock:
+                active.discard(node)
+                handled.setdefault(node, []).append(event['timestamp'])
+
+    receiver = WebhookReceiver(SECRET, handler, workers=4, batch_size=10, batch_interval=0.01)
+    receiver.start(serve=False)
+    try:
+        for second in range(20):
+            # Each delivery arrives with its two events swapped
+            events = [node_event(f'n{second % 5}', timestamp=f'2025-01-01T00:00:{second:02d}.{tick}Z')
+                      for tick in (2, 1)]
+            receiver.handle(*delivery(events))
+        wait_for(lambda: receiver.stats()['events_handled'] == 40)
+    finally:
+        receiver.stop()
+
+    assert overlaps == []
+    for timestamps in handled.values():
+        assert timestamps == sorted(timestamps)
+    assert len(handled) == 5
+
+
+def test_receives_deliveries_from_the_fake_api():
+    received = []
+    with FakeTailscaleAPI(devices=1) as api:
+        client = Tailscale('tskey-fake', api.base_url, api.tailnet)
+        webhook = client.create_webhook('http://placeholder.invalid/', ['nodeCreated']).json()
+        receiver = WebhookReceiver(webhook['secret'], received.extend, batch_interval=0).start()
+        api.webhooks[webhook['endpointId']]['endpointUrl'] = receiver.url
+
+        assert client.test_webhook(webhook['endpointId']).status_code == 200
+        assert api.emit('nodeCreated', {'nodeID': 'n7'}) == {receiver.url: 200}
+        assert api.emit('nodeDeleted', {'nodeID': 'n7'}) == {}
+        wait_for(lambda: len(received) == 2)
+
+        with urllib.request.urlopen(receiver.url + 'metrics') as response:
+            assert 'tailscale_webhook_events_received_total 2' in response.read().decode('utf-8')
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(urllib.request.Request(receiver.url, data=b'[]', method='POST'))
+        assert e.value.code == 401
+        receiver.stop()
+
+    assert [e['type'] for e in received] == ['test', 'nodeCreated']
+    assert received[1]['data'] == {'nodeID': 'n7'}
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from tailscale_agent.fakeapi import FakeTailscaleAPI
+from tailscale_agent.writebuffer import WriteBuffer
+
+
+@pytest.fixture
+def api():
+    return FakeTailscaleAPI(devices=3)
+
+
+def test_successive_changes_become_one_write(api, client, writes):
+    first, second = list(api.devices)[:2]
+    with WriteBuffer(client, window=60) as buffer:
+        futures = [buffer.update_device_tags(first, ['tag:a']),
+                   buffer.update_device_tags(first, ['tag:a', 'tag:b']),
+                   buffer.set_device_routes(first, ['10.0.0.0/24']),
+                   buffer.update_device_tags(second, ['tag:c'])]
+        assert writes == []
+
+    assert sorted(writes) == sorted([
+        ('POST', f'/api/v2/device/{first}/tags', {'tags': ['tag:a', 'tag:b']}),
+        ('POST', f'/api/v2/device/{first}/routes', {'routes': ['10.0.0.0/24']}),
+        ('POST', f'/api/v2/device/{second}/tags', {'tags': ['tag:c']}),
+    ])
+    assert api.devices[first]['tags'] == ['tag:a', 'tag:b']
+    # Coalesced changes share the response of the write that carried them
+    assert futures[0].result() is futures[1].result()
+    assert all(future.result().status_code == 200 for future in futures)
+    assert buffer.counters == {'changes': 4, 'coalesced': 1, 'writes': 3, 'failures': 0}
+
+
+def test_posture_changes_are_merged_into_one_batch(api, client, writes):
+    first, second = list(api.devices)[:2]
+    client.set_device_posture_attribute(first, 'custom:old', 1)
+    writes.clear()
+
+    buffer = WriteBuffer(client, window=60, posture_comment='automation')
+    buffer.set_device_posture_attribute(first, 'custom:tier', 'dev')
+    buffer.set_device_posture_attribute(first, 'custom:tier', 'prod')
+    buffer.delete_device_posture_attribute(first, 'custom:old')
+    buffer.set_device_posture_attribute(second, 'custom:tier', 'prod', expiry='2030-01-01T00:00:00Z')
+    buffer.flush()
+
+    assert writes == [('PATCH', '/api/v2/tailnet/example.com/device-attributes', {
+        'nodes': {first: {'custom:tier': {'value': 'prod'}, 'custom:old': None},
+                  second: {'custom:tier': {'value': 'prod', 'expiry': '2030-01-01T00:00:00Z'}}},
+        'comment': 'automation'})]
+    assert api.attributes[first] == {'custom:tier': {'value': 'prod', 'expiry': None}}
+    buffer.close()
+
+
+def test_changes_are_sent_after_the_window(api, client, writes):
+    device = next(iter(api.devices))
+    buffer = WriteBuffer(client, window=0.05)
+
+    started = time.monotonic()
+    future = buffer.update_device_tags(device, ['tag:a'])
+    buffer.update_device_tags(device, ['tag:b'])
+
+    assert future.result(timeout=2).status_code == 200
+    assert time.monotonic() - started >= 0.05
+    assert writes == [('POST', f'/api/v2/device/{device}/tags', {'tags': ['tag:b']})]
+    buffer.close()
+
+
+def test_failures_reach_the_futures(client):
+    buffer = WriteBuffer(client, window=60)
+    future = buffer.update_device_tags('missing', ['tag:a'])
+    buffer.close()
+
+    assert future.result().status_code == 404
+    assert buffer.counters['failures'] == 1
+    with pytest.raises(RuntimeError):
+        buffer.update_device_tags('missing', ['tag:a'])